@@ -0,0 +1,186 @@
+"""
+Compare element_to_markdown with html2text on a corpus of feedback HTML.
+
+blackboard.markdown.MarkdownWriter converts elements to Markdown
+directly, and falls back to html2text for markup it does not handle.
+This script converts each document of the corpus both ways, reports how
+many were converted directly, and fails if any direct conversion
+differs from html2text's output. It also times both conversions,
+and conversions that are found in a MarkdownCache:
+
+    python benchmarks/markdown.py
+    python benchmarks/markdown.py saved-feedback/*.html
+
+The corpus consists of examples of the markup that Blackboard's text
+editor produces, documents generated from them, and any HTML files
+given on the command line.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+import html5lib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blackboard.elementtext import (  # NOQA
+    element_to_html, element_to_markdown, html_to_markdown)
+from blackboard.markdown import (  # NOQA
+    MarkdownWriter, UnsupportedMarkup, MarkdownCache)
+
+
+NS = {'h': 'http://www.w3.org/1999/xhtml'}
+
+EXAMPLES = [
+    '<p>Godt arbejde.</p>',
+    '<p>Fine work.</p><p>See the comments in the <strong>attached</strong> ' +
+    'file.</p>',
+    '<p><strong>Opgave 1:</strong> Korrekt.</p>' +
+    '<p><strong>Opgave 2:</strong> Mangler analyse af ' +
+    '<em>køretiden</em>.</p>',
+    '<p>Line one<br />Line two<br /><br />Line four</p>',
+    '<ul><li>Correct invariant</li><li>Missing base case</li></ul>',
+    '<p>Comments:</p><ol><li>Good</li><li>Bad</li><li>Ugly</li></ol>' +
+    '<p>Approved.</p>',
+    '<h3>Feedback</h3><p>1. The proof is fine.</p><p>- And so is this.</p>',
+    '<p>See <a href="https://en.wikipedia.org/wiki/Heap_(data_structure)">' +
+    'Wikipedia</a> or <a href="https://www.cs.au.dk/">' +
+    'https://www.cs.au.dk/</a></p>',
+    '<p><span style="font-size: 12pt;">Formatted by the editor</span></p>',
+    '<div><p>Nested</p><div>divs</div></div>',
+    '<p>O(n log n) &amp; O(n<sup>2</sup>) &lt; 3</p>',
+    '<p>' + ' '.join(['A long paragraph that has to be wrapped.'] * 10) +
+    '</p>',
+    '<p>Du har skrevet <u>understreget</u> og <i>kursiv</i> tekst.</p>',
+    # Markup that falls back to html2text
+    '<p><img src="smiley.png" alt=":)" /></p>',
+    '<table><tr><td>1</td><td>2</td></tr></table>',
+    '<pre>for i in range(n):\n    pass</pre>',
+    '<ul><li>Outer<ul><li>Inner</li></ul></li></ul>',
+    '<p>The <strong>key</strong>, not the value.</p>',
+]
+
+
+def feedback_document(rng):
+    """A made-up comment in the style of Blackboard's text editor."""
+    words = ('the proof is correct but the running time analysis ' +
+             'is missing a case and the invariant should be stated ' +
+             'more precisely').split()
+
+    def sentence():
+        s = ' '.join(rng.choice(words) for i in range(rng.randint(3, 15)))
+        r = rng.random()
+        if r < 0.2:
+            s += ' <strong>%s</strong>' % rng.choice(words)
+        elif r < 0.3:
+            s += ' <em>%s</em>' % rng.choice(words)
+        elif r < 0.35:
+            s += ' <a href="https://example.com/%s">%s</a>' % (
+                rng.choice(words), rng.choice(words))
+        return s.capitalize() + '.'
+
+    parts = []
+    for i in range(rng.randint(1, 8)):
+        r = rng.random()
+        if r < 0.1:
+            parts.append('<ul>%s</ul>' % ''.join(
+                '<li>%s</li>' % sentence() for j in range(rng.randint(1, 5))))
+        elif r < 0.15:
+            parts.append('<h4>%s</h4>' % rng.choice(words).capitalize())
+        elif r < 0.25:
+            parts.append('<p>%s<br />%s</p>' % (sentence(), sentence()))
+        elif r < 0.3:
+            parts.append('<p><strong>Opgave %d:</strong> %s</p>' %
+                         (i + 1, sentence()))
+        else:
+            parts.append('<p>%s</p>' % ' '.join(
+                sentence() for j in range(rng.randint(1, 6))))
+    return ''.join(parts)
+
+
+def parse(html):
+    document = html5lib.parse(
+        '<div class="vtbegenerated">%s</div>' % html)
+    return document.find('.//h:div', NS)
+
+
+def old_element_to_markdown(element):
+    return html_to_markdown(element_to_html(element))
+
+
+def measure(function, elements, repeat):
+    times = []
+    for i in range(repeat):
+        t1 = time.perf_counter()
+        for e in elements:
+            function(e)
+        times.append(time.perf_counter() - t1)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='HTML files to add to the corpus')
+    parser.add_argument('--documents', type=int, default=1000,
+                        help='Number of generated documents')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Print the documents that fall back')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    corpus = list(EXAMPLES)
+    corpus += [feedback_document(rng) for i in range(args.documents)]
+    for filename in args.files:
+        with open(filename) as fp:
+            corpus.append(fp.read())
+    elements = [parse(html) for html in corpus]
+
+    direct = []
+    mismatches = []
+    for html, element in zip(corpus, elements):
+        expected = old_element_to_markdown(element)
+        try:
+            result = MarkdownWriter().convert(element)
+        except UnsupportedMarkup as exn:
+            if args.verbose:
+                print('Fallback (%s): %r' % (exn, html[:70]))
+            continue
+        direct.append(element)
+        if result != expected:
+            mismatches.append((html, expected, result))
+
+    print('%d documents: %d converted directly, %d fell back to html2text' %
+          (len(corpus), len(direct), len(corpus) - len(direct)))
+    for name, sample in (('All documents', elements),
+                         ('Converted directly', direct)):
+        old = measure(old_element_to_markdown, sample, args.repeat)
+        new = measure(element_to_markdown, sample, args.repeat)
+        print('%-20s html2text %7.1f ms, element_to_markdown %7.1f ms '
+              '(%.1fx faster)' % (name + ':', 1000 * old, 1000 * new,
+                                  old / new))
+    cache = MarkdownCache(maxsize=len(elements))
+    for e in elements:
+        element_to_markdown(e, cache)
+    cached = measure(lambda e: element_to_markdown(e, cache),
+                     elements, args.repeat)
+    print('%-20s %7.1f ms with all documents in a MarkdownCache' %
+          ('Cached:', 1000 * cached))
+
+    for html, expected, result in mismatches:
+        print('')
+        print('HTML:      %r' % html)
+        print('html2text: %r' % expected)
+        print('direct:    %r' % result)
+    if mismatches:
+        print('%d documents differ' % len(mismatches))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
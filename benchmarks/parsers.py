@@ -0,0 +1,226 @@
+"""
+Benchmark the parsers that bbfetch runs on Blackboard responses.
+
+Inputs are generated by fetching the pages of a synthetic course from
+the stand-in server in standin.py, so their structure follows the real
+endpoints, and their size is set with --students. Each benchmark is run
+--repeat times, and the minimum and median times are written to a JSON
+file that can be compared with the results of another commit:
+
+    python benchmarks/parsers.py --students 600 -o before.json
+    (change something)
+    python benchmarks/parsers.py --students 600 -o after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+import html5lib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blackboard.base import DOMAIN  # NOQA
+from blackboard.session import BlackboardSession  # NOQA
+from standin import SyntheticCourse, StandinServer, install  # NOQA
+from blackboard.backend import fetch_overview, fetch_attempt, fetch_rubric  # NOQA
+from blackboard.datatable import parse_datatable  # NOQA
+from blackboard.dwr import parse_js, js_object_parse, dwr_get_attempts_info  # NOQA
+from blackboard.elementtext import (  # NOQA
+    element_text_content, element_to_markdown)
+
+
+NS = {'h': 'http://www.w3.org/1999/xhtml'}
+
+
+def new_session(course_id):
+    cookiejar = os.path.join(tempfile.mkdtemp(), 'cookies.txt')
+    return BlackboardSession(cookiejar, 'au000000', course_id)
+
+
+class FixtureSession(BlackboardSession):
+    """Session that serves recorded responses without any
+    network access or login handling."""
+
+    def __init__(self, course_id, responses):
+        super().__init__(
+            os.path.join(tempfile.mkdtemp(), 'cookies.txt'),
+            'au000000', course_id)
+        self.responses = responses
+
+    def get(self, url, **kwargs):
+        return self.responses['GET', url]
+
+    def post(self, url, data, **kwargs):
+        return self.responses['POST', url]
+
+
+def record_inputs(students):
+    """Fetch the pages to parse from a stand-in course."""
+    course = SyntheticCourse(students=students, assignments=4, seed=0)
+    server = StandinServer(course)
+    server.start()
+    try:
+        session = new_session(course.course_id)
+        session.scheduler = None
+        install(session, server.url)
+        responses = {}
+        request = session.request
+
+        def record(method, url, **kwargs):
+            response = request(method, url, **kwargs)
+            responses[method, url] = response
+            return response
+
+        session.request = record
+        overview = fetch_overview(session)
+        keys = [(student_id, assignment_id)
+                for student_id, student in overview.students.items()
+                for assignment_id in student['assignments']]
+        dwr_get_attempts_info(session, keys, batch_size=len(keys))
+        groups_url = (
+            'https://%s/webapps/bb-group-mgmt-LEARN/execute/' % DOMAIN +
+            'groupInventoryList?course_id=%s' % course.course_id +
+            '&toggleType=users&chkAllRoles=on' +
+            '&numResults=%d&startIndex=0' % students)
+        session.get(groups_url)
+        # An attempt of a group assignment, which has a rubric
+        attempt_id = next(r['id'] for r in course.attempts.values()
+                          if r['group'])
+        attempt = fetch_attempt(session, attempt_id, True)
+        rubric = attempt['rubric_data']['rubrics'][0]
+        fetch_rubric(session, rubric['assocEntityId'], rubric)
+    finally:
+        server.stop()
+    return dict(course=course, responses=responses, attempt_id=attempt_id,
+                rubric=rubric, groups_url=groups_url, keys=keys)
+
+
+def feedback_html(paragraphs):
+    """Feedback text in the HTML that Blackboard's text editor produces."""
+    parts = []
+    for i in range(paragraphs):
+        parts.append(
+            '<p>Paragraph %d has <strong>bold</strong>, <em>emphasis</em> ' % i +
+            'and a <a href="https://example.com/%d">link</a>.</p>' % i)
+        if i % 5 == 0:
+            parts.append('<ul>' + ''.join('<li>Item %d</li>' % j
+                                          for j in range(5)) + '</ul>')
+    return '<div class="vtbegenerated">%s</div>' % ''.join(parts)
+
+
+def js_objects(n):
+    return ['{"date": "24/11/15", "exempt": false, "id": "_%d_1", ' % i +
+            '"score": %d.0, "status": null, "groupName": "Gruppe %d"}' % (i, i)
+            for i in range(n)]
+
+
+def benchmarks(inputs):
+    """Return a list of (name, function) pairs."""
+    course = inputs['course']
+    responses = inputs['responses']
+    session = FixtureSession(course.course_id, responses)
+    dwr_response = next(r for (method, url), r in responses.items()
+                        if method == 'POST' and 'getAttemptsInfo' in url)
+    groups_response = responses['GET', inputs['groups_url']]
+    groups_document = html5lib.parse(
+        groups_response.content,
+        transport_encoding=groups_response.encoding)
+    cells = groups_document.findall('.//h:table//h:td', NS)
+    objects = js_objects(len(course.students))
+    feedback = html5lib.parse(feedback_html(len(course.students) // 10 + 1))
+    feedback = feedback.find('.//h:div', NS)
+    rubric = inputs['rubric']
+
+    def run_parse_datatable():
+        parse_datatable(groups_response, groups_document,
+                        table_id='userGroupList_datatable')
+
+    return [
+        ('dwr.parse_js', lambda: parse_js(dwr_response.text)),
+        ('dwr.js_object_parse',
+         lambda: [js_object_parse(o) for o in objects]),
+        ('datatable.html5lib_parse', lambda: html5lib.parse(
+            groups_response.content,
+            transport_encoding=groups_response.encoding)),
+        ('datatable.parse_datatable', run_parse_datatable),
+        ('elementtext.element_text_content',
+         lambda: [element_text_content(c) for c in cells]),
+        ('elementtext.element_to_markdown',
+         lambda: element_to_markdown(feedback)),
+        ('backend.fetch_attempt',
+         lambda: fetch_attempt(session, inputs['attempt_id'], True)),
+        ('backend.fetch_rubric',
+         lambda: fetch_rubric(session, rubric['assocEntityId'], rubric)),
+        ('backend.fetch_overview', lambda: fetch_overview(session)),
+    ]
+
+
+def measure(function, repeat):
+    times = []
+    for i in range(repeat):
+        t1 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t1)
+    return dict(min=min(times), median=statistics.median(times),
+                repeat=repeat)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ('git', 'rev-parse', '--short', 'HEAD'),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--students', type=int, default=600)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', metavar='SUBSTRING',
+                        help='Only run benchmarks whose name contains this')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='Write results to FILE as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare with results from another run')
+    args = parser.parse_args()
+
+    inputs = record_inputs(args.students)
+    results = {}
+    for name, function in benchmarks(inputs):
+        if args.only and args.only not in name:
+            continue
+        results[name] = measure(function, args.repeat)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+    for name, r in results.items():
+        line = '%-36s %9.2f ms (median %9.2f ms)' % (
+            name, 1000 * r['min'], 1000 * r['median'])
+        if name in baseline:
+            line += '  %5.2fx' % (r['min'] / baseline[name]['min'])
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(dict(
+                revision=git_revision(),
+                python=platform.python_version(),
+                students=args.students,
+                results=results,
+            ), fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
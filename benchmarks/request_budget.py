@@ -0,0 +1,233 @@
+"""
+Check the number of Blackboard requests made by each command line flow.
+
+Each request to Blackboard takes seconds, so the number of requests is
+what decides how long a run of the grading script takes. This script
+runs Grading.main against a course in the stand-in (standin.py) with the
+command line arguments of each flow in FLOWS, counts the requests by
+endpoint class (see blackboard.endpoints), and compares the counts with
+upper bounds. The exit status is 1 if any flow exceeds its budget,
+so the script can be run in CI:
+
+    python benchmarks/request_budget.py
+
+The flows are run in order in the same directory, so each flow starts
+from the grading.json and downloaded files of the previous ones.
+Budgets are given as functions of the course, since the number of
+attempts to download or upload depends on its size.
+"""
+
+import os
+import io
+import sys
+import argparse
+import tempfile
+import contextlib
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blackboard.grading import Grading  # NOQA
+from blackboard.backend import fetch_overview, upload_csv  # NOQA
+from standin import SyntheticCourse, StandinServer, install  # NOQA
+from blackboard.tracing import Tracer  # NOQA
+
+
+class StandinGrading(Grading):
+    username = 'au000000'
+    student_group_display_regex = (r'Gruppe (\S+) - (\S+)', r'\1-\2')
+    assignment_name_display_regex = (r'Aflevering (\d+)', r'\1')
+    attempt_directory_name = '{assignment}/{class_name}-{group}-{id}'
+    accept_regex = r'fine'
+    rubric_cache_directory = False
+
+    classes = all
+
+    @classmethod
+    def get_password(cls, **kwargs):
+        return 'password'
+
+
+def attempts(course, needs_grading=False):
+    """Attempt records of the course (each group attempt counts once)."""
+    records = {r['id']: r for r in course.attempts.values()}.values()
+    if needs_grading:
+        return [r for r in records if r['score'] is None]
+    return list(records)
+
+
+def files(records):
+    return sum(len(r['files']) for r in records)
+
+
+def columns(course):
+    """Number of assignment columns, each of which has its attempt counts
+    fetched by Gradebook.refresh."""
+    return sum(1 for c in course.columns if c['src'])
+
+
+def dwr_batches(course):
+    """Number of DWR requests needed to fetch the attempt lists of every
+    student and assignment with attempts (see dwr_get_attempts_info)."""
+    return -(-len(course.student_attempts) // 20)
+
+
+def upload_manual_column(grading):
+    """Set the manual column of every student with upload_csv."""
+    session = grading.session
+    overview = fetch_overview(session)
+    column = next(c for c in overview.columns if c['src'] is None)
+    rows = [[s['username'], 'ja'] for s in overview.students.values()]
+    upload_csv(session, ['Username', '%s|%s' % (column['name'], column['id'])],
+               rows, grade_centre=overview)
+
+
+# List of (name, command line arguments, budget), where budget maps an
+# endpoint class to a function of the course that returns the maximum
+# number of requests. Endpoint classes not in the budget may not be
+# requested at all. Budgets are computed before the flow runs.
+# Instead of command line arguments, a flow can be a function
+# that is called with the Grading object.
+FLOWS = [
+    ('refresh', [], {
+        # Checking the course ID and fetching the groups
+        # only happens when there is no grading.json.
+        'other': lambda c: 1,
+        'groups': lambda c: 1,
+        'overview': lambda c: 1,
+        'attempt_counts': columns,
+        'dwr_engine': lambda c: 1,
+        'dwr': dwr_batches,
+    }),
+    ('offline', ['-n'], {}),
+    ('check', ['-n', '-c'], {}),
+    ('download', ['-d'], {
+        'overview': lambda c: 1,
+        'attempt_counts': columns,
+        'groups': lambda c: 1,
+        'attempt': lambda c: len(attempts(c, needs_grading=True)),
+        'download': lambda c: files(attempts(c, needs_grading=True)),
+        'rubric': lambda c: len(c.rubrics),
+    }),
+    ('download all', ['-dd'], {
+        'overview': lambda c: 1,
+        'attempt_counts': columns,
+        'groups': lambda c: 1,
+        # Attempts downloaded by -d are skipped
+        'attempt': lambda c: (len(attempts(c)) -
+                              len(attempts(c, needs_grading=True))),
+        'download': lambda c: (files(attempts(c)) -
+                               files(attempts(c, needs_grading=True))),
+        'rubric': lambda c: len(c.rubrics),
+    }),
+    ('upload', ['-u'], {
+        # Refresh before and after uploading
+        'overview': lambda c: 2,
+        'attempt_counts': lambda c: 2 * columns(c),
+        'dwr_engine': lambda c: 1,
+        'dwr': lambda c: 2 * dwr_batches(c),
+        'attempt': lambda c: len(attempts(c, needs_grading=True)),
+        'submit': lambda c: len(attempts(c, needs_grading=True)),
+        'rubric': lambda c: len(c.rubrics),
+    }),
+    ('upload_csv', upload_manual_column, {
+        'overview': lambda c: 1,
+        # Form, file upload and confirmation
+        'upload': lambda c: 3,
+    }),
+]
+
+
+def write_feedback(grading):
+    """Write comments.txt in the directory of every attempt
+    that needs grading, so that -u has something to upload."""
+    for attempt in grading.get_attempts(visible=None, needs_grading=True):
+        d = grading.get_attempt_directory(attempt, create=False)
+        if d:
+            with open(os.path.join(d, 'comments.txt'), 'w') as fp:
+                fp.write('Fine work\n')
+
+
+def run_flow(course, server, flow):
+    """Run Grading.main with the given arguments (or call the given
+    function) and return the list of requests from the session's tracer."""
+    session = StandinGrading.session_class(
+        'cookies.txt', StandinGrading.username, course.course_id)
+    install(session, server.url)
+    session.tracer = Tracer(maxlen=None)
+    grading = StandinGrading(session)
+    grading.override_get_password(None)
+    grading.load('grading.json')
+    with contextlib.redirect_stdout(io.StringIO()):
+        if callable(flow):
+            flow(grading)
+        else:
+            args = StandinGrading.get_argument_parser().parse_args(flow)
+            if args.upload:
+                write_feedback(grading)
+            grading.main(args, session, grading)
+    grading.save('grading.json')
+    session.save_cookies()
+    return [e for e in session.tracer.entries if not e['from_cache']]
+
+
+@contextlib.contextmanager
+def in_temporary_directory():
+    """Run the body in a new temporary directory, which is removed
+    afterwards."""
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(cwd)
+
+
+def over_budget(counts, limits):
+    """Return a list of (endpoint, count, limit) for the endpoint classes
+    that were requested more often than the limits allow."""
+    return [(endpoint, count, limits.get(endpoint, 0))
+            for endpoint, count in sorted(counts.items())
+            if count > limits.get(endpoint, 0)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--students', type=int, default=30)
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Print the requests of each flow')
+    args = parser.parse_args()
+
+    course = SyntheticCourse(students=args.students, assignments=4, seed=0)
+    server = StandinServer(course)
+    server.start()
+    failed = []
+    try:
+        with in_temporary_directory():
+            for name, flow, budget in FLOWS:
+                limits = {endpoint: f(course)
+                          for endpoint, f in budget.items()}
+                entries = run_flow(course, server, flow)
+                counts = collections.Counter(
+                    e['endpoint'] for e in entries)
+                print('%-14s %-6s %4d requests  %s' % (
+                    name, '' if callable(flow) else ' '.join(flow),
+                    len(entries), ', '.join(
+                        '%s=%d' % kv for kv in sorted(counts.items()))))
+                if args.verbose:
+                    for e in entries:
+                        print('    %s %s' % (e['method'], e['url']))
+                for endpoint, count, limit in over_budget(counts, limits):
+                    print('    %s: %d requests, budget is %d' %
+                          (endpoint, count, limit))
+                    failed.append(name)
+    finally:
+        server.stop()
+    if failed:
+        print('Over budget: %s' % ', '.join(sorted(set(failed))))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,770 @@
+"""
+Local stand-in for the parts of Blackboard that bbfetch uses.
+
+The stand-in serves synthetic, but structurally faithful, versions of
+getJSONData, getJSONUniqueAttemptData, the DWR calls getAttemptsInfo and
+getGroups, dwr/engine.js, gradeAssignmentRedirector and the grade
+submission form, gradeRubric, groupInventoryList, uploadGradebook2,
+and submitted files, for a course of configurable size.
+Grades and Grade Centre uploads are kept in memory.
+
+To send the requests of a BlackboardSession to a stand-in:
+
+>>> from blackboard.session import BlackboardSession
+>>> course = SyntheticCourse(students=4, assignments=2)
+>>> server = StandinServer(course)
+>>> server.start()
+>>> import os, tempfile
+>>> cookiejar = os.path.join(tempfile.mkdtemp(), 'cookies.txt')
+>>> session = BlackboardSession(cookiejar, 'au000000', course.course_id)
+>>> install(session, server.url)
+>>> from blackboard.backend import fetch_overview
+>>> len(fetch_overview(session).students)
+4
+>>> server.stop()
+
+To run a stand-in from the command line, use
+``python benchmarks/standin.py`` (see ``--help``).
+"""
+
+import io
+import os
+import re
+import csv
+import sys
+import html
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+import socketserver
+import collections
+import email.parser
+import email.policy
+import http.server
+
+import requests
+import requests.adapters
+from six.moves.urllib.parse import urlparse, parse_qs, quote, urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blackboard.base import DOMAIN  # NOQA
+
+
+FIRST_NAMES = ('Anna', 'Bo', 'Camilla', 'Dennis', 'Emma', 'Frederik',
+               'Gitte', 'Hans', 'Ida', 'Jens', 'Karen', 'Lars')
+LAST_NAMES = ('Andersen', 'Berg', 'Christensen', 'Dahl', 'Eriksen',
+              'Frandsen', 'Hansen', 'Jensen', 'Larsen', 'Nielsen')
+
+RUBRIC_COLUMNS = ('Not passed', 'Passed with remarks', 'Passed')
+
+
+class SyntheticCourse:
+    """
+    Students, groups, assignments and attempts of a made-up course.
+
+    Every student is in a group of group_size students. Every other
+    assignment is a group assignment, and every group assignment has a
+    rubric. Each student (or group, for group assignments) has
+    between 0 and max_attempts attempts of each assignment, each with
+    files_per_attempt submitted files of file_size bytes.
+    The earlier attempts are graded, and the latest attempt is graded
+    with probability graded_fraction.
+    """
+
+    def __init__(self, students=10, assignments=3, group_size=3,
+                 max_attempts=2, files_per_attempt=1, file_size=4096,
+                 graded_fraction=0.5, seed=0, course_id='_1_1'):
+        self.course_id = course_id
+        self.file_size = file_size
+        rng = random.Random(seed)
+        ids = iter(range(1000, 10 ** 9))
+
+        def new_id():
+            return '_%d_1' % next(ids)
+
+        self.students = collections.OrderedDict()
+        for i in range(students):
+            student = dict(
+                id=new_id(), username='au%06d' % i,
+                first_name=rng.choice(FIRST_NAMES),
+                last_name=rng.choice(LAST_NAMES),
+                student_number='%06d' % (200000 + i))
+            self.students[student['id']] = student
+
+        self.groups = collections.OrderedDict()
+        for i, student in enumerate(self.students.values()):
+            if i % group_size == 0:
+                number = i // group_size + 1
+                group = dict(id=new_id(), members=[],
+                             name='Gruppe C%d - %d' % (number % 4 + 1, number))
+                self.groups[group['id']] = group
+            group['members'].append(student['id'])
+            student['group'] = group['id']
+
+        self.columns = []
+        self.rubrics = {}
+        for i in range(assignments):
+            column = dict(
+                id=str(20000 + i), name='Aflevering %d' % (i + 1), pos=i,
+                src='resource/x-bb-assignment', groupActivity=i % 2 == 1,
+                points=1, vis=True, gbvis=True, type='N')
+            self.columns.append(column)
+            if column['groupActivity']:
+                rubric_id = new_id()
+                self.rubrics[rubric_id] = dict(
+                    id=rubric_id, assoc_id=new_id(),
+                    title='Rubric for %s' % column['name'],
+                    rows=[dict(id=new_id(), title='Criterion %d' % (j + 1),
+                               cells=[new_id() for c in RUBRIC_COLUMNS])
+                          for j in range(3)])
+                column['rubric'] = rubric_id
+        # A manual column that can be set by uploading a CSV file
+        self.columns.append(dict(id=str(20000 + assignments),
+                                 name='Godkendt', pos=assignments, src=None,
+                                 points=0, vis=True, gbvis=True, type='T'))
+
+        # Attempt records by attempt ID; individual attempt IDs of
+        # group attempts refer to the record of the group attempt.
+        self.attempts = {}
+        # Map (student ID, column ID) to list of attempt IDs
+        self.student_attempts = collections.defaultdict(list)
+        self.manual_scores = {}
+        date = time.mktime((2017, 9, 1, 12, 0, 0, 0, 0, -1))
+        for column in self.columns[:assignments]:
+            if column['groupActivity']:
+                owners = [(g['id'], g['members']) for g in self.groups.values()]
+            else:
+                owners = [(s, [s]) for s in self.students]
+            for owner, members in owners:
+                n = rng.randint(0, max_attempts)
+                for k in range(n):
+                    graded = k < n - 1 or rng.random() < graded_fraction
+                    date += rng.randint(60, 3600)
+                    record = dict(
+                        id=new_id(), column=column['id'], owner=owner,
+                        group=column['groupActivity'],
+                        date=time.strftime('%d/%m/%y', time.localtime(date)),
+                        score=rng.choice((0.0, 1.0)) if graded else None,
+                        feedback='Good work.' if graded else '',
+                        feedback_files=[],
+                        text='Submission text %d' % k if k % 2 else None,
+                        files=['handin%d.pdf' % j
+                               for j in range(files_per_attempt)])
+                    self.attempts[record['id']] = record
+                    for student_id in members:
+                        member_attempt = record['id']
+                        if record['group']:
+                            member_attempt = new_id()
+                            self.attempts[member_attempt] = record
+                        self.student_attempts[
+                            student_id, column['id']].append(member_attempt)
+
+    def column(self, column_id):
+        for c in self.columns:
+            if c['id'] == column_id:
+                return c
+
+    def overview(self):
+        """The JSON object returned by getJSONData."""
+        rows = []
+        for student in self.students.values():
+            row = [dict(uid=student['id'], avail=True)]
+            for key, name in (('FN', 'first_name'), ('LN', 'last_name'),
+                              ('UN', 'username'), ('SI', 'student_number')):
+                row.append(dict(c=key, v=student[name]))
+            row.append(dict(c='LA', v=''))
+            for column in self.columns:
+                if column['src'] is None:
+                    v = self.manual_scores.get(
+                        (student['username'], column['id']), '')
+                    row.append(dict(c=column['id'], v=v))
+                    continue
+                attempts = [self.attempts[a] for a in
+                            self.student_attempts[student['id'], column['id']]]
+                if not attempts:
+                    continue
+                scores = [a['score'] for a in attempts
+                          if a['score'] is not None]
+                row.append(dict(
+                    c=column['id'], v=scores[-1] if scores else '',
+                    ng=any(a['score'] is None for a in attempts)))
+            rows.append(row)
+        col_defs = [dict((k, v) for k, v in c.items() if k != 'rubric')
+                    for c in self.columns]
+        return dict(cachedBook=dict(colDefs=col_defs, rows=rows))
+
+    def attempt_counts(self, column_id):
+        """The JSON object returned by getJSONUniqueAttemptData."""
+        records = set(r['id'] for r in self.attempts.values()
+                      if r['column'] == column_id)
+        records = [self.attempts[r] for r in records]
+        return dict(
+            totalStudentsOrGroups=len(set(r['owner'] for r in records)),
+            needsGradingCount=sum(1 for r in records if r['score'] is None),
+            numberOfUniqueAttempts=len(records))
+
+    def attempt_info(self, attempt_id):
+        """The attempt information returned by getAttemptsInfo."""
+        r = self.attempts[attempt_id]
+        status = None if r['score'] is not None else 'ng'
+        score = r['score'] if r['score'] is not None else 0.0
+        info = collections.OrderedDict(
+            date=r['date'], exempt=False, id=attempt_id,
+            override=False, score=score, status=status)
+        if r['group']:
+            info.update(groupAttemptId=r['id'],
+                        groupName=self.groups[r['owner']]['name'],
+                        groupScore=score, groupStatus=status)
+        else:
+            info.update(groupAttemptId=None, groupName=None,
+                        groupScore=None, groupStatus=None)
+        return info
+
+    def file_content(self, attempt_id, filename):
+        if filename in self.attempts[attempt_id]['files']:
+            size = self.file_size
+        else:
+            # A feedback file
+            size = dict(self.attempts[attempt_id]['feedback_files'])[filename]
+        line = ('%s %s\n' % (attempt_id, filename)).encode('ascii')
+        return (line * (size // len(line) + 1))[:size]
+
+
+def page(title, body, content_class='contentPanel'):
+    return ('<!DOCTYPE html>\n<html><head><title>' + html.escape(title) +
+            '</title></head><body>\n' +
+            '<a id="topframe.logout.label" href="/webapps/login/' +
+            '?action=logout">Logout</a>\n' +
+            '<a id="editModeToggleLink" class="read-on" href="#">' +
+            'Edit Mode is: ON</a>\n' +
+            '<div id="contentPanel" class="%s">\n' % content_class +
+            body + '\n</div></body></html>\n')
+
+
+def attr(s):
+    return html.escape(str(s), quote=True)
+
+
+def parse_multipart(content_type, body):
+    """Return the fields of a multipart/form-data body as a list of
+    (name, value) pairs; file parts have value (filename, bytes)."""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin1') + b'\r\n\r\n' +
+        body)
+    fields = []
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        filename = part.get_param('filename', header='content-disposition')
+        content = part.get_payload(decode=True)
+        if filename is None:
+            fields.append((name, content.decode('utf-8')))
+        else:
+            fields.append((name, (filename, content)))
+    return fields
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without TCP_NODELAY,
+    # each keep-alive response would be delayed by the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    # List of (method, path regex, handler method name)
+    routes = [
+        ('GET', r'/webapps/gradebook/do/instructor/getJSONData$',
+         'get_overview'),
+        ('GET', r'/webapps/gradebook/do/instructor/getJSONUniqueAttemptData$',
+         'get_attempt_counts'),
+        ('GET', r'/javascript/dwr/engine\.js$', 'get_dwr_engine'),
+        ('POST', r'/webapps/gradebook/dwr/call/plaincall/' +
+         r'GradebookDWRFacade\.getAttemptsInfo\.dwr$', 'post_attempts_info'),
+        ('POST', r'/webapps/gradebook/dwr/call/plaincall/' +
+         r'GradebookDWRFacade\.getGroups\.dwr$', 'post_groups'),
+        ('GET', r'/webapps/assignment/gradeAssignmentRedirector$',
+         'get_attempt'),
+        ('POST', r'/webapps/assignment//?grade(Group)?Assignment/submit$',
+         'post_grade'),
+        ('GET', r'/webapps/assignment/download$', 'get_file'),
+        ('GET', r'/webapps/rubric/do/course/gradeRubric$', 'get_rubric'),
+        ('GET', r'/webapps/bb-group-mgmt-LEARN/execute/groupInventoryList$',
+         'get_groups'),
+        ('GET', r'/webapps/gradebook/do/instructor/uploadGradebook2$',
+         'get_upload'),
+        ('POST', r'/webapps/gradebook/do/instructor/uploadGradebook2$',
+         'post_upload'),
+        ('GET', r'/webapps/blackboard/', 'get_page'),
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = {k: v[0] for k, v in
+                      parse_qs(url.query, keep_blank_values=True).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length)
+        self.server.delay()
+        for m, pattern, name in self.routes:
+            if m == method and re.match(pattern, url.path):
+                with self.server.lock:
+                    self.server.counts[name] += 1
+                    result = getattr(self, name)()
+                break
+        else:
+            result = 404, 'text/html', page('Not found', 'Not found',
+                                             'contentPanel error')
+        status, content_type, content = result[:3]
+        headers = result[3] if len(result) > 3 else {}
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+            content_type += '; charset=UTF-8'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Set-Cookie', 'JSESSIONID=%s; Path=/webapps/gradebook'
+                         % self.server.jsessionid)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(content)
+
+    @property
+    def course(self):
+        return self.server.course
+
+    def form_data(self):
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            return parse_multipart(content_type, self.body)
+        return [(k, v) for k, vs in parse_qs(
+            self.body.decode('utf-8'), keep_blank_values=True).items()
+            for v in vs]
+
+    def json(self, o):
+        return 200, 'application/json', json.dumps(o)
+
+    def conditional(self, content, content_type):
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()[:16]
+        headers = {'ETag': etag}
+        if self.headers.get('If-None-Match') == etag:
+            return 304, content_type, b'', headers
+        return 200, content_type, content, headers
+
+    def get_overview(self):
+        return self.json(self.course.overview())
+
+    def get_attempt_counts(self):
+        return self.json(self.course.attempt_counts(self.query['itemId']))
+
+    def get_dwr_engine(self):
+        script = ('// DWR engine (stand-in)\n' +
+                  'if (typeof dwr == "undefined") dwr = {};\n' +
+                  'dwr.engine._origScriptSessionId = "%s";\n' %
+                  self.server.script_session_id)
+        return self.conditional(script.encode('ascii'),
+                                'application/javascript')
+
+    def dwr_reply(self, calls):
+        lines = ["throw 'allowScriptTagRemoting is false.';",
+                 '//#DWR-INSERT', '//#DWR-REPLY']
+        n = 0
+        batch_id = dict(self.form_data()).get('batchId', '0')
+        for call_id, value in calls:
+            names = []
+            statements = []
+            items = value.items() if isinstance(value, dict) else value
+            for item in items:
+                key = None
+                if isinstance(value, dict):
+                    key, item = item
+                name = 's%d' % n
+                n += 1
+                if isinstance(item, list):
+                    statements.append('var %s=[];' % name)
+                    statements.extend('%s[%d]=%s;' % (name, i, json.dumps(v))
+                                      for i, v in enumerate(item))
+                else:
+                    statements.append('var %s={};' % name)
+                    statements.extend('%s.%s=%s;' % (name, k, json.dumps(v))
+                                      for k, v in item.items())
+                names.append(name if key is None else
+                             '%s:%s' % (json.dumps(key), name))
+            lines.append(''.join(statements))
+            if isinstance(value, dict):
+                args = '{%s}' % ','.join(names)
+            else:
+                args = '[%s]' % ','.join(names)
+            lines.append("dwr.engine._remoteHandleCallback('%s','%s',%s);" %
+                         (batch_id, call_id, args))
+        return 200, 'text/javascript', '\n'.join(lines) + '\n'
+
+    def post_attempts_info(self):
+        data = dict(self.form_data())
+        calls = []
+        for i in range(int(data['callCount'])):
+            student_id = data['c%d-param1' % i].split(':', 1)[1]
+            column_id = data['c%d-param2' % i].split(':', 1)[1]
+            attempts = self.course.student_attempts.get(
+                (student_id, column_id), ())
+            calls.append((i, [self.course.attempt_info(a) for a in attempts]))
+        return self.dwr_reply(calls)
+
+    def post_groups(self):
+        groups = collections.OrderedDict(
+            (g['id'], list(g['members'])) for g in self.course.groups.values())
+        return self.dwr_reply([(0, groups)])
+
+    def attempt_id(self):
+        return self.query.get('groupAttemptId') or self.query['attempt_id']
+
+    def get_attempt(self):
+        attempt_id = self.attempt_id()
+        try:
+            r = self.course.attempts[attempt_id]
+        except KeyError:
+            return 404, 'text/html', page('Error', 'No such attempt',
+                                          'contentPanel error')
+        download = ('/webapps/assignment/download?course_id=%s' %
+                    self.course.course_id + '&attempt_id=%s&fileName=' %
+                    attempt_id)
+        body = ['<div id="currentAttempt">']
+        if r['text'] is not None:
+            body.append('<div id="submissionTextView"><p>%s</p></div>' %
+                        html.escape(r['text']))
+        body.append('<ul id="currentAttempt_submissionList">')
+        for filename in r['files']:
+            body.append('<li>%s<a class="dwnldBtn" href="%s"></a></li>' %
+                        (html.escape(filename), attr(download + quote(filename))))
+        body.append('</ul></div>')
+        if r['group']:
+            action = '/webapps/assignment//gradeGroupAssignment/submit'
+            id_field = 'groupAttemptId'
+        else:
+            action = '/webapps/assignment//gradeAssignment/submit'
+            id_field = 'attempt_id'
+        body.append('<form id="currentAttempt_form" method="post" ' +
+                    'enctype="multipart/form-data" action="%s">' % action)
+        hidden = [('course_id', self.course.course_id),
+                  (id_field, attempt_id),
+                  ('blackboard.platform.security.NonceUtil.nonce',
+                   uuid.uuid4())]
+        column = self.course.column(r['column'])
+        if column.get('rubric'):
+            hidden.append(('%s_rubricEvaluation' % attempt_id,
+                           quote(json.dumps(self.rubric_evaluation(
+                               attempt_id, column['rubric'])))))
+        for name, value in hidden:
+            body.append('<input type="hidden" id="%s" name="%s" value="%s"/>' %
+                        (attr(name), attr(name), attr(value)))
+        score = '' if r['score'] is None else '%g' % r['score']
+        body.append('<input type="text" id="currentAttempt_grade" ' +
+                    'name="grade" value="%s"/>' % score)
+        body.append('<textarea id="feedbacktext" name="feedbacktext">' +
+                    '%s</textarea>' % html.escape(r['feedback']))
+        body.append('<textarea id="gradingNotestext" ' +
+                    'name="gradingNotestext"></textarea>')
+        body.append('<input type="submit" name="bottom_Submit" ' +
+                    'value="Submit"/></form>')
+        body.append('<table><tbody id="feedbackFiles_table_body">')
+        for filename, size in r['feedback_files']:
+            body.append('<tr><td><a href="%s">%s</a></td></tr>' %
+                        (attr(download + quote(filename)),
+                         html.escape(filename)))
+        body.append('</tbody></table>')
+        return 200, 'text/html', page('Grade Assignment', '\n'.join(body))
+
+    def rubric_evaluation(self, attempt_id, rubric_id):
+        rubric = self.course.rubrics[rubric_id]
+        chosen = self.course.attempts[attempt_id].get('rubric_cells') or {}
+        return dict(
+            evalDataType='blackboard.platform.gradebook2.GroupAttempt',
+            evalEntityId=attempt_id,
+            rubrics=[dict(
+                id=rubric['id'], title=rubric['title'],
+                assocEntityId=rubric['assoc_id'],
+                rows=[dict(row_id=row['id'], cell_id=chosen.get(row['id']))
+                      for row in rubric['rows']])])
+
+    def post_grade(self):
+        data = self.form_data()
+        fields = dict(kv for kv in data if not isinstance(kv[1], tuple))
+        attempt_id = fields.get('groupAttemptId') or fields['attempt_id']
+        r = self.course.attempts[attempt_id]
+        try:
+            r['score'] = float(fields['grade'])
+        except ValueError:
+            return 200, 'text/html', page(
+                'Grade Assignment',
+                '<span id="badMsg1">Grade must be a number</span>')
+        r['feedback'] = fields.get('feedbacktext', '')
+        rubric_input = '%s_rubricEvaluation' % attempt_id
+        if rubric_input in fields:
+            evaluation = json.loads(
+                requests.compat.unquote(fields[rubric_input]))
+            r['rubric_cells'] = {
+                row['row_id']: row['cell_id']
+                for rubric in evaluation['rubrics'] for row in rubric['rows']}
+        for name, value in data:
+            if isinstance(value, tuple) and value[1]:
+                filename, content = value
+                r['feedback_files'].append((filename, len(content)))
+        return 200, 'text/html', page(
+            'Grade Assignment', '<span id="goodMsg1">Success: ' +
+            'Grade and feedback have been saved.</span>')
+
+    def get_file(self):
+        try:
+            content = self.course.file_content(
+                self.query['attempt_id'], self.query['fileName'])
+        except KeyError:
+            return 404, 'text/html', page('Not found', 'No such file',
+                                          'contentPanel error')
+        return self.conditional(content, 'application/octet-stream')
+
+    def get_rubric(self):
+        rubric = self.course.rubrics[self.query['rubricId']]
+        prefix = self.query.get('prefix', '')
+        body = ['<table id="%s_rubricGradingTable"><thead><tr><th></th>' %
+                attr(prefix)]
+        body.extend('<th>%s</th>' % c for c in RUBRIC_COLUMNS)
+        body.append('</tr></thead><tbody>')
+        for row in rubric['rows']:
+            body.append('<tr rubricrowid="%s"><th>%s</th>' %
+                        (row['id'], html.escape(row['title'])))
+            for i, (cell_id, title) in enumerate(
+                    zip(row['cells'], RUBRIC_COLUMNS)):
+                body.append(
+                    '<td rubriccellid="%s"><div class="rubricCellContainer">'
+                    % cell_id +
+                    '<div class="u_controlsWrapper radioLabel">' +
+                    '<input type="radio" name="%s"/></div>' % row['id'] +
+                    '<input type="hidden" class="selectedPercentField" ' +
+                    'value="%s"/>' % (i / (len(RUBRIC_COLUMNS) - 1)) +
+                    '<div class="u_controlsWrapper">%s: %s</div>' %
+                    (html.escape(row['title']), title) +
+                    '<div class="u_controlsWrapper feedback"></div>' +
+                    '</div></td>')
+            body.append('</tr>')
+        body.append('</tbody></table>')
+        return 200, 'text/html', page('Rubric', '\n'.join(body))
+
+    def get_groups(self):
+        """groupInventoryList in the 'users' view, paged by
+        numResults and startIndex like other Blackboard datatables."""
+        course = self.course
+        students = list(course.students.values())
+        start = int(self.query.get('startIndex') or 0)
+        count = int(self.query.get('numResults') or 25)
+        body = ['<table id="userGroupList_datatable"><thead><tr>']
+        for key, title in (('userorgroupname', 'Username'),
+                           ('firstname', 'First Name'),
+                           ('lastname', 'Last Name')):
+            body.append(
+                '<th><a class="sortheader" href="groupInventoryList' +
+                '?course_id=%s&amp;sortCol=%s"><span>%s</span></a></th>' %
+                (course.course_id, key, title))
+        body.append('<th>Role</th><th>Groups</th></tr></thead><tbody>')
+        for s in students[start:start + count]:
+            group = course.groups[s['group']]
+            body.append(
+                '<tr><td><span><a><span class="hideoff">Access the profile ' +
+                'card for user: %s</span></a> %s</span></td>' %
+                (s['username'], s['username']) +
+                '<td>%s</td><td>%s</td>' % (html.escape(s['first_name']),
+                                            html.escape(s['last_name'])) +
+                '<td>Student</td><td><a class="userGroupNameListItemRemove" ' +
+                'id="rmv_%s">%s</a></td></tr>' % (group['id'], group['name']))
+        body.append('</tbody></table>')
+        if start + count < len(students):
+            query = dict(self.query, startIndex=start + count)
+            body.append('<a id="listContainer_nextpage_top" ' +
+                        'href="groupInventoryList?%s">Next</a>' %
+                        attr(urlencode(sorted(query.items()))))
+        return 200, 'text/html', page('Groups', '\n'.join(body))
+
+    def upload_form(self, action, inputs):
+        return ('<form name="uploadGradebookForm2" method="post" ' +
+                'enctype="multipart/form-data" ' +
+                'action="uploadGradebook2?course_id=%s&amp;actionType=%s">'
+                % (self.course.course_id, action) +
+                '<input type="hidden" name="%s" value="%s"/>' % (
+                    'blackboard.platform.security.NonceUtil.nonce',
+                    uuid.uuid4()) +
+                ''.join(inputs) +
+                '<input type="submit" name="bottom_Submit" value="Submit"/>' +
+                '</form>')
+
+    def get_upload(self):
+        form = self.upload_form('parseFile', [
+            '<input type="hidden" name="theFile_attachmentType" value=""/>',
+            '<input type="hidden" name="theFile_linkTitle" value=""/>',
+            '<input type="file" name="theFile_LocalFile0"/>'])
+        return 200, 'text/html', page('Upload Grades', form)
+
+    def post_upload(self):
+        data = self.form_data()
+        if self.query.get('actionType') == 'parseFile':
+            filename, content = dict(data)['theFile_LocalFile0']
+            rows = list(csv.reader(
+                io.StringIO(content.decode('utf-8'), newline='')))
+            self.server.pending_upload = rows
+            items = ['<input type="checkbox" name="items" value="%d" ' % i +
+                     'checked="checked"/>%s' % html.escape(c)
+                     for i, c in enumerate(rows[0][1:])]
+            form = self.upload_form('confirm', items + [
+                '<input type="hidden" name="item_positions" value=""/>'])
+            return 200, 'text/html', page('Upload Grades', form)
+        rows = self.server.pending_upload or [[]]
+        self.server.pending_upload = None
+        positions = set(int(i) for i in
+                        dict(data).get('item_positions', '').split(',') if i)
+        for row in rows[1:]:
+            for i, (column, value) in enumerate(zip(rows[0][1:], row[1:])):
+                if i in positions:
+                    column_id = column.rsplit('|', 1)[1]
+                    self.course.manual_scores[row[0], column_id] = value
+        return 200, 'text/html', page(
+            'Upload Grades', '<span id="goodMsg1">Success: ' +
+            'The file has been uploaded.</span>')
+
+    def get_page(self):
+        # courseMain, manageDashboard.jsp, doCourseMenuAction, ...
+        course_id = self.query.get('course_id') or self.query.get('courseId')
+        if course_id not in (None, self.course.course_id):
+            return 200, 'text/html', page('Error', 'Invalid course',
+                                          'contentPanel error')
+        return 200, 'text/html', page('Course', '<p>Stand-in course</p>')
+
+
+class StandinServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP server for a SyntheticCourse.
+
+    Each response is delayed by latency seconds, or with probability
+    slow_fraction, by slow_latency seconds (to imitate the occasional
+    very slow Blackboard response).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, course, host='127.0.0.1', port=0, latency=0,
+                 slow_fraction=0, slow_latency=0, seed=None, verbose=False):
+        super().__init__((host, port), StandinHandler)
+        self.course = course
+        self.latency = latency
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Number of requests handled by each handler method
+        self.counts = collections.Counter()
+        self.jsessionid = uuid.uuid4().hex.upper()
+        self.script_session_id = uuid.uuid4().hex.upper()
+        self.pending_upload = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def delay(self):
+        with self.lock:
+            slow = self.random.random() < self.slow_fraction
+        t = self.slow_latency if slow else self.latency
+        if t > 0:
+            time.sleep(t)
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class StandinAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter that sends requests for https://blackboard.au.dk/
+    to a stand-in server instead. Responses keep the original URL,
+    so cookies and URL comparisons in BlackboardSession work unchanged.
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        prefix = 'https://%s' % DOMAIN
+        if not request.url.startswith(prefix):
+            raise requests.ConnectionError(
+                "Stand-in cannot serve %s" % request.url)
+        local = request.copy()
+        local.url = self.base_url + request.url[len(prefix):]
+        response = super().send(local, **kwargs)
+        response.url = request.url
+        response.request = request
+        return response
+
+
+def install(session, base_url):
+    """Send all requests of a BlackboardSession to the stand-in at base_url."""
+    session.session.mount('https://%s/' % DOMAIN, StandinAdapter(base_url))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a synthetic Blackboard course for bbfetch')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--students', type=int, default=100)
+    parser.add_argument('--assignments', type=int, default=4)
+    parser.add_argument('--group-size', type=int, default=3)
+    parser.add_argument('--max-attempts', type=int, default=2)
+    parser.add_argument('--file-size', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to delay each response')
+    parser.add_argument('--slow-fraction', type=float, default=0,
+                        help='Fraction of responses delayed by --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=0)
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+    course = SyntheticCourse(
+        students=args.students, assignments=args.assignments,
+        group_size=args.group_size, max_attempts=args.max_attempts,
+        file_size=args.file_size, seed=args.seed)
+    server = StandinServer(
+        course, args.host, args.port, latency=args.latency,
+        slow_fraction=args.slow_fraction, slow_latency=args.slow_latency,
+        verbose=args.verbose)
+    print("Serving course %s with %d students on %s" %
+          (course.course_id, len(course.students), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Time a full grading cycle against courses of increasing size.
+
+For each course size (number of students), this script starts a
+stand-in server (see standin.py) with a fresh synthetic course and runs
+the grading script as a teacher would over a whole handin round:
+a first refresh (no grading.json), downloading all attempts with -ddd
+and uploading feedback for every attempt that needs grading with -u.
+The wall time and number of requests of each step are printed, and can
+be written to a JSON file and compared with the results of another commit:
+
+    python benchmarks/throughput.py -o before.json
+    (change something)
+    python benchmarks/throughput.py -o after.json --compare before.json
+
+The stand-in answers without delay, so the times measure bbfetch itself
+(parsing, bookkeeping and the HTTP stack) rather than Blackboard;
+see request_budget.py for the number of requests of each flow.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standin import SyntheticCourse, StandinServer  # NOQA
+from request_budget import run_flow, in_temporary_directory  # NOQA
+from parsers import git_revision  # NOQA
+
+
+SIZES = (10, 100, 5000)
+
+# (name, command line arguments) of the steps of a cycle, run in order
+CYCLE = [
+    ('refresh', []),
+    ('download all', ['-ddd']),
+    ('upload', ['-u']),
+]
+
+
+def time_cycle(students):
+    """Run CYCLE against a new course with the given number of students
+    and return a dict mapping each step to its seconds and requests."""
+    course = SyntheticCourse(students=students, assignments=4, seed=0)
+    server = StandinServer(course)
+    server.start()
+    results = {}
+    try:
+        with in_temporary_directory():
+            for name, flow in CYCLE:
+                t1 = time.perf_counter()
+                entries = run_flow(course, server, flow)
+                t2 = time.perf_counter()
+                results[name] = dict(seconds=t2 - t1, requests=len(entries))
+    finally:
+        server.stop()
+    results['total'] = dict(
+        seconds=sum(r['seconds'] for r in results.values()),
+        requests=sum(r['requests'] for r in results.values()))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--students', type=int, nargs='+', default=SIZES,
+                        metavar='N', help='Course sizes (default: %s)' %
+                        ' '.join(map(str, SIZES)))
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='Write results to FILE as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare with results from another run')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+    results = {}
+    for students in args.students:
+        results[str(students)] = cycle = time_cycle(students)
+        for name, r in cycle.items():
+            line = '%5d students  %-13s %9.2f s %6d requests' % (
+                students, name, r['seconds'], r['requests'])
+            try:
+                b = baseline[str(students)][name]
+            except KeyError:
+                pass
+            else:
+                line += '  %5.2fx' % (r['seconds'] / b['seconds'])
+            print(line)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(dict(
+                revision=git_revision(),
+                python=platform.python_version(),
+                results=results,
+            ), fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,14 +4,20 @@ import re
 import csv
 import json
 import pprint
+import tempfile
 import html5lib
+import contextlib
 import collections
+import requests
 
 from requests.compat import urljoin, unquote, quote
 
 import blackboard
 from blackboard import logger, ParserError, BlackboardSession, DOMAIN
-from blackboard.datatable import fetch_datatable
+from blackboard.cache import fingerprint
+from blackboard.datatable import (
+    fetch_datatable, get_datatable_pages)
+from blackboard.multipart import MultipartEncoder
 from blackboard.elementtext import (
     element_to_markdown, element_text_content, form_field_value,
     html_to_markdown)
@@ -54,9 +60,7 @@ def fetch_overview(session):
     url = (
         'https://%s/webapps/gradebook/do/instructor/getJSONData' % DOMAIN +
         '?course_id=%s' % session.course_id)
-    l = blackboard.slowlog()
-    response = session.get(url)
-    l("Fetching gradebook took %.1f s")
+    response = session.get(url, hedge=True)
     try:
         o = response.json()
     except JSONDecodeError:
@@ -107,6 +111,7 @@ def fetch_overview(session):
             assignments=user_assignments,
         )
 
+    session.trace_parsed(response)
     return fetch_overview.result(assignments, users, columns)
 
 
@@ -130,9 +135,7 @@ def fetch_attempt(session, attempt_id, is_group_assignment):
                'gradeAssignmentRedirector' +
                '?course_id=%s' % session.course_id +
                '&attempt_id=%s' % attempt_id)
-    l = blackboard.slowlog()
     response = session.get(url)
-    l("Fetching attempt took %.1f s")
     document = html5lib.parse(response.content, transport_encoding=response.encoding)
 
     currentAttempt_container = document.find(
@@ -155,7 +158,7 @@ def fetch_attempt(session, attempt_id, is_group_assignment):
     if comments is not None:
         xpath = './/h:div[@class="vtbegenerated"]'
         comments = [
-            element_to_markdown(e)
+            element_to_markdown(e, session.markdown_cache)
             for e in comments.findall(xpath, NS)
         ]
         if not comments:
@@ -224,7 +227,7 @@ def fetch_attempt(session, attempt_id, is_group_assignment):
     else:
         feedback = form_field_value(feedbacktext_input)
         if '<' in feedback:
-            feedback = html_to_markdown(feedback)
+            feedback = html_to_markdown(feedback, session.markdown_cache)
 
     gradingNotestext_input = document.find(
         './/*[@id="gradingNotestext"]', NS)
@@ -275,6 +278,7 @@ def fetch_attempt(session, attempt_id, is_group_assignment):
                     "Unknown evalDataType %r" % rubric_data['evalDataType'],
                     response)
 
+    session.trace_parsed(response)
     return dict(
         submission=submission_text,
         comments=comments,
@@ -287,6 +291,17 @@ def fetch_attempt(session, attempt_id, is_group_assignment):
     )
 
 
+def rubric_fingerprint(rubric):
+    """
+    Fingerprint of a rubric's structure that can be computed both from
+    a rubric definition returned by fetch_rubric and from an entry in
+    an attempt's rubric_data['rubrics'], without fetching anything.
+    """
+    rows = rubric['rows']
+    row_ids = [row['id'] if 'id' in row else row['row_id'] for row in rows]
+    return fingerprint([rubric['id'], rubric['title'], row_ids])
+
+
 def fetch_rubric(session, assoc_id, rubric_object):
     rubric_id = rubric_object['id']
     rubric_title = rubric_object['title']
@@ -298,9 +313,7 @@ def fetch_rubric(session, assoc_id, rubric_object):
         '&maxValue=1.0&rubricId=%s' % rubric_id +
         '&viewOnly=false&displayGrades=true&type=grading' +
         '&rubricAssoId=%s' % assoc_id)
-    l = blackboard.slowlog()
     response = session.get(url)
-    l("Fetching attempt rubric took %.1f s")
     document = html5lib.parse(response.content, transport_encoding=response.encoding)
 
     def is_desc(div_element):
@@ -346,16 +359,18 @@ def fetch_rubric(session, assoc_id, rubric_object):
                 id=cell_id, desc=desc_text, percentage=percentage))
         rubric_rows.append(dict(
             id=row_id, title=row_title, cells=rubric_row_cells))
+    session.trace_parsed(response)
     return dict(id=rubric_id, title=rubric_title,
                 columns=column_headers, rows=rubric_rows)
 
 
 class Form:
     def __init__(self, session, url, form_xpath):
-        # We need to fetch the page to get the nonce
+        # We need to fetch the page to get the nonce,
+        # so it must not come from the response cache.
         self._session = session
         if isinstance(url, str):
-            response = session.get(url)
+            response = session.get(url, fresh=True)
         else:
             # Presumably a response object
             response = url
@@ -422,7 +437,15 @@ class Form:
             self.files = [('dummy', io.StringIO(''))]
         try:
             data = [d for d in self._data if d is not None]
-            response = self._session.post(post_url, data=data, files=self.files)
+            if self.files:
+                # Stream file parts from disk instead of letting requests
+                # build the entire request body in memory.
+                body = MultipartEncoder(data, self.files)
+                response = self._session.post(
+                    post_url, data=body,
+                    headers={'Content-Type': body.content_type})
+            else:
+                response = self._session.post(post_url, data=data)
         except:
             logger.exception("data=%r files=%r", data, self.files)
             raise
@@ -481,29 +504,68 @@ def submit_grade(session, attempt_id, is_group_assignment,
         rubric_data_str = quote(json.dumps(rubric_data))
         form.set(rubric_input, rubric_data_str)
 
-    for i, filename in enumerate(filenames):
-        base = os.path.basename(filename)
-        form.extend([
-            ('feedbackFiles_attachmentType', 'L'),
-            ('feedbackFiles_fileId', 'new'),
-            ('feedbackFiles_artifactFileId', 'undefined'),
-            ('feedbackFiles_artifactType', 'undefined'),
-            ('feedbackFiles_artifactTypeResourceKey', 'undefined'),
-            ('feedbackFiles_linkTitle', base),
-        ])
-        with open(filename, 'rb') as fp:
-            fdata = fp.read()
-        form.files.append(('feedbackFiles_LocalFile%d' % i, (base, fdata)))
     if is_group_assignment:
         post_url = (
             'https://%s/webapps/assignment//gradeGroupAssignment/submit' % DOMAIN)
     else:
         post_url = (
             'https://%s/webapps/assignment//gradeAssignment/submit' % DOMAIN)
-    response = form.submit(post_url)
+    with contextlib.ExitStack() as stack:
+        for i, filename in enumerate(filenames):
+            base = os.path.basename(filename)
+            form.extend([
+                ('feedbackFiles_attachmentType', 'L'),
+                ('feedbackFiles_fileId', 'new'),
+                ('feedbackFiles_artifactFileId', 'undefined'),
+                ('feedbackFiles_artifactType', 'undefined'),
+                ('feedbackFiles_artifactTypeResourceKey', 'undefined'),
+                ('feedbackFiles_linkTitle', base),
+            ])
+            # The file is read in chunks by MultipartEncoder during the POST.
+            fp = stack.enter_context(open(filename, 'rb'))
+            form.files.append(('feedbackFiles_LocalFile%d' % i, (base, fp)))
+        try:
+            response = form.submit(post_url)
+        except (requests.ConnectionError, requests.Timeout) as exn:
+            # The POST is not retried, since Blackboard may have received
+            # it even though the response was lost. Check instead.
+            if not grade_was_recorded(session, attempt_id,
+                                      is_group_assignment, grade, text):
+                raise
+            logger.warning("Submitting grade for attempt %s failed (%s), " +
+                           "but the grade was recorded", attempt_id, exn)
+            return
     form.require_success_message(response)
 
 
+def grade_was_recorded(session, attempt_id, is_group_assignment, grade, text):
+    """
+    Re-read an attempt after a failed submit_grade to check whether
+    its score and feedback text are what was submitted.
+    """
+    if session.cache is not None:
+        # Don't verify against a response cached before the POST
+        session.cache.invalidate()
+    try:
+        attempt = fetch_attempt(session, attempt_id, is_group_assignment)
+    except (requests.ConnectionError, requests.Timeout, ParserError):
+        logger.exception("Could not re-read attempt %s", attempt_id)
+        return False
+    try:
+        if attempt['score'] != float(grade):
+            return False
+    except (TypeError, ValueError):
+        if attempt['score'] is not None:
+            return False
+
+    def normalize(s):
+        if '<' in s:
+            s = html_to_markdown(s)
+        return ' '.join(s.split())
+
+    return normalize(attempt['feedback'] or '') == normalize(text or '')
+
+
 def fetch_groups(session):
     """
     Computes a mapping from usernames (au123) to dictionaries,
@@ -511,6 +573,30 @@ def fetch_groups(session):
     memberships of the particular user.
     The 'groups' entry is a list of (name, group id) pairs.
     """
+    fingerprint, users = fetch_groups_if_changed(session)
+    return users
+
+
+def fetch_groups_if_changed(session, previous_fingerprint=None):
+    """
+    Like fetch_groups, but returns a pair (fingerprint, users).
+
+    All pages of the group list are fetched and, if their
+    fingerprint (see get_datatable_pages) is equal to
+    previous_fingerprint, (previous_fingerprint, None) is returned
+    without parsing the group list. This saves the parsing,
+    but not any requests.
+    """
+    table_id = 'userGroupList_datatable'
+    url = ('https://%s/webapps/bb-group-mgmt-LEARN/execute/' % DOMAIN +
+           'groupInventoryList?course_id=%s' % session.course_id +
+           '&toggleType=users&chkAllRoles=on')
+    pages, new_fingerprint = get_datatable_pages(
+        session, url, edit_mode=True, hedge=True, table_id=table_id)
+    if (previous_fingerprint is not None and
+            new_fingerprint == previous_fingerprint):
+        return previous_fingerprint, None
+
     def strip_prefix(s, prefix):
         if s.startswith(prefix):
             return s[len(prefix):]
@@ -531,13 +617,9 @@ def fetch_groups(session):
             res.append((name, strip_prefix(i, 'rmv_')))
         return res
 
-    url = ('https://%s/webapps/bb-group-mgmt-LEARN/execute/' % DOMAIN +
-           'groupInventoryList?course_id=%s' % session.course_id +
-           '&toggleType=users&chkAllRoles=on')
-
     response, keys, rows = fetch_datatable(
-        session, url, extract=extract, table_id='userGroupList_datatable',
-        edit_mode=True)
+        session, url, extract=extract, table_id=table_id,
+        prefetched=pages)
     username = keys.index('userorgroupname')
     first_name = keys.index('firstname')
     last_name = keys.index('lastname')
@@ -558,10 +640,10 @@ def fetch_groups(session):
             role=row[role],
             groups=row[groups],
         )
-    return users
+    return new_fingerprint, users
 
 
-def upload_csv(session, columns, rows):
+def upload_csv(session, columns, rows, grade_centre=None):
     '''
     Upload one or more columns to the Grade Centre overview.
 
@@ -571,6 +653,9 @@ def upload_csv(session, columns, rows):
     "|nnnn", where nnnn is the column ID of an existing Grade Centre column.
 
     This function cannot be used to create new columns in the Grade Centre.
+
+    Columns and usernames are validated against 'grade_centre', the result
+    of fetch_overview, which is fetched if it is not given.
     '''
     if columns[0] != 'Username':
         raise ValueError("First column must be Username")
@@ -587,8 +672,8 @@ def upload_csv(session, columns, rows):
         if len(r) != len(columns):
             raise ValueError("Wrong number of cells in row")
 
-    # TODO: Use cached gradebook data instead of fetching directly
-    grade_centre = fetch_overview(session)
+    if grade_centre is None:
+        grade_centre = fetch_overview(session)
 
     # Validate column IDs against getJSONData
     grade_centre_column_ids = [c.get('id') for c in grade_centre.columns]
@@ -611,15 +696,18 @@ def upload_csv(session, columns, rows):
     form.set('theFile_attachmentType', 'L')
     base = 'bbfetch.csv'
     form.set('theFile_linkTitle', base)
-    with io.StringIO() as fp:
-        writer = csv.writer(fp)
+    with tempfile.TemporaryFile() as fp:
+        text_fp = io.TextIOWrapper(fp, encoding='utf-8', newline='')
+        writer = csv.writer(text_fp)
         writer.writerow(columns)
         writer.writerows(rows)
-        fdata = fp.getvalue().encode('utf-8')
-    form.pop('theFile_LocalFile0')
-    form.files.append(('theFile_LocalFile0', (base, fdata)))
+        text_fp.flush()
+        text_fp.detach()
+        fp.seek(0)
+        form.pop('theFile_LocalFile0')
+        form.files.append(('theFile_LocalFile0', (base, fp)))
 
-    response = form.submit()
+        response = form.submit()
     assert response.status_code == 200
     form2 = Form(session, response, './/h:form[@name="uploadGradebookForm2"]')
     form2.set('bottom_Submit', 'Submit')
@@ -79,6 +79,9 @@ def wrapper(fun):
     parser.add_argument('--course')
     parser.add_argument('--cookiejar', default='cookies.txt')
     parser.add_argument('--session-class', default='BlackboardSession')
+    parser.add_argument('--datatable-cache', metavar='DIR',
+                        help='Only parse the pages of datatables that ' +
+                             'changed since they were stored in DIR')
     args = parser.parse_args()
     configure_logging(quiet=args.quiet)
 
@@ -98,6 +101,9 @@ def wrapper(fun):
         raise
 
     session = session_class(args.cookiejar, args.username, args.course)
+    if args.datatable_cache:
+        from blackboard.datatable import DatatableCache
+        session.datatable_cache = DatatableCache(args.datatable_cache)
     try:
         fun(session)
     except ParserError as exn:
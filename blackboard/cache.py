@@ -0,0 +1,64 @@
+import os
+import re
+import json
+import hashlib
+import tempfile
+
+
+def default_cache_directory():
+    """Directory for data shared between courses, e.g. ~/.cache/bbfetch."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'bbfetch')
+
+
+def fingerprint(o):
+    """
+    Short content hash of a JSON-serializable object.
+
+    >>> fingerprint({'b': [1, 2], 'a': None})
+    'a55af08acf8a8caa'
+    >>> fingerprint({'a': None, 'b': [1, 2]})
+    'a55af08acf8a8caa'
+    """
+    s = json.dumps(o, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()[:16]
+
+
+def write_atomic(filename, data):
+    """Write bytes to filename such that readers never see a partial file."""
+    directory = os.path.dirname(filename) or '.'
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class DiskCache:
+    """
+    Directory of JSON files, one file per key.
+
+    Several processes (e.g. grading scripts for different courses)
+    may share the same directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(
+            self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', key) + '.json')
+
+    def get(self, key, default=None):
+        try:
+            with open(self.path(key)) as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return default
+
+    def set(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomic(self.path(key), json.dumps(value).encode('utf-8'))
@@ -0,0 +1,86 @@
+import os
+import json
+
+from blackboard.base import logger
+from blackboard.cache import write_atomic
+
+
+class CellCache:
+    """
+    Rendered cells of the gradebook and the rows that were last printed.
+
+    Each cell is stored together with the inputs it was computed from
+    (see Grading.get_assignment_cell_inputs) and is reused as long as the
+    inputs compare equal. The rows of the last printed gradebook are
+    kept so that the next print can show only the rows that changed.
+    If filename is not None, both are saved there for the next run.
+
+    >>> cache = CellCache()
+    >>> cache.set('u1 a1', [['_1_1', 'ng', None]], '!')
+    >>> cache.get('u1 a1', [['_1_1', 'ng', None]])
+    '!'
+    >>> cache.get('u1 a1', [['_1_1', None, 1.0]]) is None
+    True
+    >>> cache.changed_rows({'u1': ['u1', '!'], 'u2': ['u2', '']})
+    ['u1', 'u2']
+    >>> cache.changed_rows({'u1': ['u1', '\\u2714'], 'u2': ['u2', '']})
+    ['u1']
+    """
+
+    # Increase when Grading.get_assignment_display changes,
+    # so that cells saved by older versions are not used.
+    version = 1
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.hits = self.misses = 0
+        self._cells = {}
+        self._printed = {}
+        self._modified = False
+        if filename is not None:
+            try:
+                with open(filename) as fp:
+                    data = json.load(fp)
+            except (FileNotFoundError, ValueError):
+                data = None
+            if data and data.get('version') == self.version:
+                self._cells = data['cells']
+                self._printed = data['printed']
+
+    def get(self, key, inputs):
+        """Return the cell stored for key if its inputs are unchanged."""
+        entry = self._cells.get(key)
+        if entry is not None and entry[0] == inputs:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+    def set(self, key, inputs, value):
+        self._cells[key] = [inputs, value]
+        self._modified = True
+
+    def changed_rows(self, rows):
+        """
+        Given a dict of rows (lists of strings) by key, return the keys of
+        the rows that differ from when changed_rows was last called,
+        and remember the rows for the next call.
+        """
+        changed = [k for k, row in rows.items()
+                   if self._printed.get(k) != row]
+        if changed:
+            self._printed.update((k, rows[k]) for k in changed)
+            self._modified = True
+        return changed
+
+    def save(self):
+        if self.filename is None or not self._modified:
+            return
+        logger.debug("Gradebook cells: %d reused, %d computed",
+                     self.hits, self.misses)
+        data = dict(version=self.version, cells=self._cells,
+                    printed=self._printed)
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_atomic(self.filename, json.dumps(data).encode('utf-8'))
+        self._modified = False
@@ -0,0 +1,256 @@
+"""
+Export tables column by column, with a type for each column.
+
+A table is an ordered dict that maps column names to lists of values.
+write_table writes it as a Parquet file if pyarrow is installed, and
+otherwise as a NumPy .npz file (written without NumPy), which can be
+read with numpy.load or pandas without parsing text.
+
+The type of each column is one of COLUMN_TYPES and is inferred from
+its values; see column_type. The schema, a list of [name, type] pairs,
+is stored in the Parquet schema or in the '__schema__' entry of the .npz
+file. Missing values (None) are nulls in Parquet; in .npz files they are
+NaN in float64 columns, False in bool columns and empty strings in
+string columns.
+"""
+
+import io
+import ast
+import json
+import struct
+import zipfile
+import collections
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from blackboard.cache import write_atomic
+
+
+COLUMN_TYPES = ('bool', 'int64', 'float64', 'string')
+
+NPY_DESCR = {'bool': '|b1', 'int64': '<i8', 'float64': '<f8'}
+STRUCT_FORMAT = {'bool': '?', 'int64': 'q', 'float64': 'd'}
+ARROW_TYPES = {'bool': 'bool_', 'int64': 'int64', 'float64': 'float64',
+               'string': 'string'}
+
+
+def column_type(values):
+    """
+    Infer the type of a column. Integer columns with missing values
+    are float64, so that they have the same type in .npz files.
+
+    >>> column_type([True, None])
+    'bool'
+    >>> column_type([1, 2])
+    'int64'
+    >>> column_type([1, None]), column_type([1, 2.5])
+    ('float64', 'float64')
+    >>> column_type(['1', 2]), column_type([None])
+    ('string', 'string')
+    """
+    types = set(type(v) for v in values if v is not None)
+    if not types:
+        return 'string'
+    if types == {bool}:
+        return 'bool'
+    if types == {int}:
+        return 'float64' if None in values else 'int64'
+    if types <= {int, float}:
+        return 'float64'
+    return 'string'
+
+
+def string_value(v):
+    """
+    >>> string_value([('Gruppe 1', '_123_1')])
+    '[["Gruppe 1", "_123_1"]]'
+    """
+    if v is None or isinstance(v, str):
+        return v
+    if isinstance(v, (list, tuple, dict)):
+        return json.dumps(v)
+    return str(v)
+
+
+def table_schema(table):
+    return [[name, column_type(values)] for name, values in table.items()]
+
+
+def default_format():
+    return 'npz' if pyarrow is None else 'parquet'
+
+
+def write_table(path, table, format=None):
+    """
+    Write table to path + '.parquet' or path + '.npz' and return the
+    filename. If format is None, Parquet is used if pyarrow is installed.
+    """
+    if format is None:
+        format = default_format()
+    lengths = set(len(values) for values in table.values())
+    if len(lengths) > 1:
+        raise ValueError("Columns have different lengths %r" % (lengths,))
+    schema = table_schema(table)
+    if format == 'parquet':
+        data = parquet_bytes(table, schema)
+    elif format == 'npz':
+        data = npz_bytes(table, schema)
+    else:
+        raise ValueError("Unknown format %r" % (format,))
+    filename = '%s.%s' % (path, format)
+    write_atomic(filename, data)
+    return filename
+
+
+def parquet_bytes(table, schema):
+    if pyarrow is None:
+        raise ImportError("Writing Parquet files requires pyarrow")
+    arrays = []
+    fields = []
+    for name, t in schema:
+        values = table[name]
+        if t == 'string':
+            values = [string_value(v) for v in values]
+        elif t == 'float64':
+            values = [None if v is None else float(v) for v in values]
+        arrow_type = getattr(pyarrow, ARROW_TYPES[t])()
+        arrays.append(pyarrow.array(values, type=arrow_type))
+        fields.append(pyarrow.field(name, arrow_type))
+    arrow_table = pyarrow.Table.from_arrays(
+        arrays, schema=pyarrow.schema(fields))
+    buf = pyarrow.BufferOutputStream()
+    pyarrow.parquet.write_table(arrow_table, buf)
+    return buf.getvalue().to_pybytes()
+
+
+def npy_bytes(values, t):
+    """
+    Contents of a .npy file (format version 1.0) with a one-dimensional
+    array of the given column type, or a 0-d string array if values is
+    a string.
+    """
+    if isinstance(values, str):
+        values = [values]
+        shape = ()
+    else:
+        shape = (len(values),)
+    if t == 'string':
+        values = [string_value(v) or '' for v in values]
+        width = max([len(v) for v in values] + [1])
+        descr = '<U%d' % width
+        data = ''.join(v.ljust(width, '\0') for v in values)
+        data = data.encode('utf-32-le')
+    else:
+        descr = NPY_DESCR[t]
+        if t == 'float64':
+            values = [float('nan') if v is None else v for v in values]
+        data = struct.pack('<%d%s' % (len(values), STRUCT_FORMAT[t]), *values)
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        descr, shape)
+    # Pad the header so that the data is aligned to 64 bytes
+    header_length = len(header) + 1
+    header_length += -(10 + header_length) % 64
+    header = header.ljust(header_length - 1) + '\n'
+    return (b'\x93NUMPY\x01\x00' + struct.pack('<H', header_length) +
+            header.encode('latin1') + data)
+
+
+def npz_bytes(table, schema):
+    """Contents of a .npz file like numpy.savez_compressed writes."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, t in schema:
+            zf.writestr(name + '.npy', npy_bytes(table[name], t))
+        zf.writestr('__schema__.npy', npy_bytes(json.dumps(schema), 'string'))
+    return buf.getvalue()
+
+
+def read_npz_schema(filename):
+    """
+    Return the schema stored in a .npz file written by write_table.
+    """
+    with zipfile.ZipFile(filename) as zf:
+        data = zf.read('__schema__.npy')
+    header_length, = struct.unpack('<H', data[8:10])
+    header = ast.literal_eval(data[10:10 + header_length].decode('latin1'))
+    width = int(header['descr'][2:])
+    s = data[10 + header_length:][:4 * width].decode('utf-32-le')
+    return json.loads(s.rstrip('\0'))
+
+
+def table_columns(keys, rows):
+    """
+    Turn a datatable (e.g. from fetch_datatable, or a Datatable and its
+    keys) into a table. Repeated keys get a numeric suffix.
+
+    >>> list(table_columns(['a', 'b', 'a'], [[1, 2, 3]]).items())
+    [('a', [1]), ('b', [2]), ('a_2', [3])]
+    """
+    names = []
+    for k in keys:
+        name = k
+        i = 1
+        while name in names:
+            i += 1
+            name = '%s_%d' % (k, i)
+        names.append(name)
+    columns = [[] for k in keys]
+    for row in rows:
+        for column, v in zip(columns, row):
+            column.append(v)
+    return collections.OrderedDict(zip(names, columns))
+
+
+def gradebook_table(grading):
+    """
+    Table with a row for each visible student and each assignment,
+    with the score and the number of attempts.
+    """
+    columns = ('username student_number first_name last_name group ' +
+               'assignment assignment_id score attempts needs_grading')
+    table = collections.OrderedDict((k, []) for k in columns.split())
+    assignments = list(grading.gradebook.assignments.values())
+    students = filter(grading.get_student_visible,
+                      grading.gradebook.students.values())
+    for student in sorted(students, key=grading.get_student_ordering):
+        group = grading.get_student_group_display(student)
+        for assignment in assignments:
+            try:
+                student_assignment = student.assignments[assignment.id]
+            except KeyError:
+                score = attempts = needs_grading = None
+            else:
+                score = student_assignment.score
+                attempts = student_assignment.cached_attempts
+                if attempts is None:
+                    needs_grading = None
+                else:
+                    needs_grading = any(a.needs_grading for a in attempts)
+                    attempts = len(attempts)
+            row = (student.username, student.student_number,
+                   student.first_name, student.last_name, group,
+                   grading.get_assignment_name_display(assignment),
+                   assignment.id, score, attempts, needs_grading)
+            for values, v in zip(table.values(), row):
+                values.append(v)
+    return table
+
+
+def groups_table(grading):
+    """
+    Table with a row for each group membership from fetch_groups
+    (and a row without a group for users that are not in any group).
+    """
+    columns = 'username first_name last_name role group_name group_id'
+    table = collections.OrderedDict((k, []) for k in columns.split())
+    for username, user in sorted((grading.groups or {}).items()):
+        for name, group_id in (user['groups'] or [(None, None)]):
+            row = (username, user['first_name'], user['last_name'],
+                   user['role'], name, group_id)
+            for values, v in zip(table.values(), row):
+                values.append(v)
+    return table
@@ -1,9 +1,15 @@
+import io
 import re
 import csv
+import html
+import hashlib
 import html5lib
+import collections
 from requests.compat import urljoin
 
 import blackboard
+from blackboard.base import logger
+from blackboard.cache import DiskCache
 from blackboard.elementtext import element_text_content
 
 
@@ -27,47 +33,329 @@ def dump_iter_datatable(session, url, fp, **kwargs):
     for r in iter_datatable(session, url, **kwargs):
         if isinstance(r, list):
             c.writerow(r)
-            fp.flush()
         yield r
 
 
-def iter_datatable(session, url, **kwargs):
+def get_datatable_first_page(session, url, edit_mode=False, hedge=False):
     url += '&numResults=1000&startIndex=0'
-    l = blackboard.slowlog()
-    response = session.get(url)
-    if kwargs.pop('edit_mode', False):
+    response = session.get(url, hedge=hedge)
+    if edit_mode:
         response = session.ensure_edit_mode(response)
-    history = list(response.history) + [response]
-    document = html5lib.parse(response.content, transport_encoding=response.encoding)
-    keys, rows = parse_datatable(response, document, **kwargs)
-    yield keys
-    yield from rows
-    next_id = 'listContainer_nextpage_top'
-    next_o = document.find('.//h:a[@id="%s"]' % next_id, NS)
-    if next_o is None:
-        l("Fetching datatable took %.1f s")
-    else:
-        l("Fetching datatable page 1 took %.1f s")
-    page_number = 1
-    while next_o:
-        page_number += 1
-        url = urljoin(response.url, next_o.get('href'))
-        l = blackboard.slowlog()
-        response = session.get(url)
-        l("Fetching datatable page %d took %.4f s", page_number)
-        history += list(response.history) + [response]
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
-        keys_, rows = parse_datatable(response, document, **kwargs)
-        if keys != keys_:
-            raise ValueError(
-                "Page %d keys (%r) do not match page 1 keys (%r)" %
-                (page_number, keys_, keys))
-        next_o = document.find('.//h:a[@id="%s"]' % next_id, NS)
+    return response
+
+
+def datatable_fingerprint(response, table_id=None):
+    """
+    Cheap fingerprint of the datatable in a page, computed from the raw
+    response without parsing the HTML. Returns None if no table is found.
+
+    The fingerprint changes if the number of rows, the contents of the
+    table or the presence of a next page link changes.
+    """
+    if table_id is None:
+        table_id = 'listContainer_datatable'
+    pattern = br'<table[^>]*\bid="%s".*?</table>' % (
+        re.escape(table_id.encode('ascii')),)
+    mo = re.search(pattern, response.content, re.S)
+    if mo is None:
+        return None
+    # Links in the table may contain a nonce that changes on every request
+    table = re.sub(br'nonce=[^&"\']*', b'', mo.group(0))
+    next_page = b'listContainer_nextpage_top' in response.content
+    return '%d%s-%s' % (table.count(b'<tr'), '+' if next_page else '',
+                        hashlib.sha1(table).hexdigest()[:16])
+
+
+def get_datatable_pages(session, url, edit_mode=False, hedge=False,
+                        table_id=None):
+    """
+    Fetch every page of a datatable without parsing the HTML.
+    Returns (responses, fingerprint), where fingerprint combines the
+    datatable_fingerprint of all pages (and thereby the total number of
+    rows), or is None if a page has no table or its next link
+    could not be found.
+    """
+    response = get_datatable_first_page(session, url, edit_mode, hedge)
+    responses = [response]
+    fingerprints = []
+    while True:
+        page_fingerprint = datatable_fingerprint(response, table_id)
+        if page_fingerprint is None:
+            return responses, None
+        fingerprints.append(page_fingerprint)
+        if '+' not in page_fingerprint:
+            return responses, '/'.join(fingerprints)
+        href = next_page_href(response)
+        if href is None:
+            return responses, None
+        response = session.get(urljoin(response.url, href), hedge=hedge)
+        responses.append(response)
+
+
+def next_page_href(response):
+    """
+    The href of the link to the next page, found without parsing the HTML,
+    or None if there is no such link or it could not be found.
+    """
+    mo = re.search(br'<a\b[^>]*\bid="listContainer_nextpage_top"[^>]*>',
+                   response.content)
+    if mo is not None:
+        href = re.search(br'\bhref="([^"]*)"', mo.group(0))
+        if href is not None:
+            return html.unescape(href.group(1).decode('utf-8'))
+
+
+class DatatableCache:
+    """
+    Parsed rows of datatable pages, stored in a directory together with
+    the datatable_fingerprint of each page, so that Datatable only has to
+    parse the pages that changed since they were last fetched.
+
+    Pages are identified by URL (without nonces), table ID and the name
+    of the extract function. Rows that cannot be stored as JSON are not
+    cached; tuples in the rows are stored so that they come back as tuples.
+
+    >>> import json
+    >>> rows = [['a', [('x', '_1_1')], ('b', 2)]]
+    >>> decode_rows(json.loads(json.dumps(encode_rows(rows)))) == rows
+    True
+    """
+
+    # Increase when the stored rows change format
+    version = 1
+
+    def __init__(self, directory):
+        self.disk = DiskCache(directory)
+
+    def key(self, url, table_id, extract):
+        url = re.sub(r'nonce=[^&]*', '', url)
+        name = ''
+        if extract is not None:
+            name = '%s.%s' % (getattr(extract, '__module__', ''),
+                              getattr(extract, '__qualname__', extract))
+        s = '%s\n%s\n%s' % (url, table_id, name)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def get(self, key, fingerprint):
+        """Return (keys, rows) if the page had the given fingerprint."""
+        if fingerprint is None:
+            return
+        entry = self.disk.get(key)
+        if (entry is not None and entry.get('version') == self.version and
+                entry['fingerprint'] == fingerprint):
+            return entry['keys'], decode_rows(entry['rows'])
+
+    def set(self, key, fingerprint, keys, rows):
+        if fingerprint is None:
+            return
+        try:
+            self.disk.set(key, dict(version=self.version,
+                                    fingerprint=fingerprint,
+                                    keys=keys, rows=encode_rows(rows)))
+        except TypeError as exn:
+            logger.debug("Not caching datatable page: %s", exn)
+
+
+def encode_rows(v):
+    """Replace tuples in v by {'__tuple__': [...]} (see decode_rows)."""
+    if isinstance(v, tuple):
+        return {'__tuple__': [encode_rows(x) for x in v]}
+    if isinstance(v, list):
+        return [encode_rows(x) for x in v]
+    if isinstance(v, dict):
+        return {k: encode_rows(x) for k, x in v.items()}
+    return v
+
+
+def decode_rows(v):
+    if isinstance(v, dict):
+        if list(v.keys()) == ['__tuple__']:
+            return tuple(decode_rows(x) for x in v['__tuple__'])
+        return {k: decode_rows(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [decode_rows(x) for x in v]
+    return v
+
+
+def iter_datatable(session, url, first_page=None, **kwargs):
+    """
+    Yield the list of column keys, then each row, and finally the
+    response of the last page (with all pages in its history).
+
+    If first_page is given, it is used instead of fetching the first
+    page with get_datatable_first_page.
+    """
+    table = Datatable(session, url, first_page, **kwargs)
+    history = []
+    for rows in table.iter_pages():
+        if not history:
+            yield table.keys
+        history += list(table.response.history) + [table.response]
         yield from rows
+    response = table.response
     response.history = history[:-1]
     yield response
 
 
+class Datatable:
+    """
+    A datatable that is fetched and parsed one page at a time.
+
+    Iterating over it yields the rows of all pages as namedtuples of type
+    row_type, whose fields are the column keys (fields that are not
+    valid identifiers are renamed to _0, _1, ...). The column keys are
+    available as keys, which fetches the first page if necessary,
+    and the response of the last page fetched so far as response.
+
+    Only one page is kept in memory at a time, and unlike iter_datatable,
+    the responses of earlier pages are not added to response.history.
+    Each iteration fetches the table again.
+
+    If first_page is given, it is used instead of fetching the first
+    page with get_datatable_first_page, and if prefetched is a list of
+    responses (see get_datatable_pages), pages are taken from it
+    instead of being fetched. The other arguments are passed
+    to get_datatable_first_page and parse_datatable.
+
+    If session.datatable_cache is a DatatableCache, every page is still
+    fetched, but only pages that changed since the last time are parsed.
+    """
+
+    next_id = 'listContainer_nextpage_top'
+
+    def __init__(self, session, url, first_page=None, edit_mode=False,
+                 extract=None, table_id=None, prefetched=None):
+        self.session = session
+        self.url = url
+        self.first_page = first_page
+        # Responses that are used once instead of fetching their URL
+        self.prefetched = list(prefetched or ())
+        self.edit_mode = edit_mode
+        self.extract = extract
+        self.table_id = table_id
+        self.response = None
+        self.pages = 0
+        self._keys = None
+        self._row_type = None
+        # (rows, next_url) of the first page, if fetched but not yet iterated
+        self._page = None
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            self._fetch_first_page()
+        return self._keys
+
+    @property
+    def row_type(self):
+        if self._row_type is None:
+            self._row_type = collections.namedtuple(
+                'Row', self.keys, rename=True)
+        return self._row_type
+
+    def _fetch(self, response):
+        """
+        Parse a page, or take its rows from session.datatable_cache
+        if the page has not changed. Returns (keys, rows, next_url).
+        """
+        self.response = response
+        cache = self.session.datatable_cache
+        if cache is not None:
+            key = cache.key(response.url, self.table_id, self.extract)
+            fingerprint = datatable_fingerprint(response, self.table_id)
+            cached = cache.get(key, fingerprint)
+            next_page = fingerprint is not None and '+' in fingerprint
+            href = next_page_href(response) if next_page else None
+            if cached is not None and next_page == (href is not None):
+                self.session.metrics['datatable_pages_cached'] += 1
+                keys, rows = cached
+                return keys, rows, href and urljoin(response.url, href)
+        document = html5lib.parse(
+            response.content, transport_encoding=response.encoding)
+        keys, rows = parse_datatable(
+            response, document, extract=self.extract, table_id=self.table_id)
+        self.session.trace_parsed(response)
+        if cache is not None:
+            cache.set(key, fingerprint, keys, rows)
+        next_o = document.find('.//h:a[@id="%s"]' % self.next_id, NS)
+        if next_o is not None:
+            return keys, rows, urljoin(response.url, next_o.get('href'))
+        return keys, rows, None
+
+    def _fetch_first_page(self):
+        response = self.first_page
+        if response is None and self.prefetched:
+            response = self.prefetched.pop(0)
+        elif response is None:
+            response = get_datatable_first_page(
+                self.session, self.url, self.edit_mode)
+        else:
+            # Fetch the table again if it is iterated again
+            self.first_page = None
+        keys, rows, next_url = self._fetch(response)
+        if self._keys is not None and keys != self._keys:
+            self._row_type = None
+        self._keys = keys
+        self._page = (rows, next_url)
+
+    def _get(self, url):
+        for i, response in enumerate(self.prefetched):
+            if response.url == url:
+                return self.prefetched.pop(i)
+        return self.session.get(url)
+
+    def iter_pages(self):
+        """Yield the list of rows of each page, as lists."""
+        if self._page is None:
+            self._fetch_first_page()
+        rows, next_url = self._page
+        self._page = None
+        self.pages = 1
+        yield rows
+        while next_url is not None:
+            # Let the previous page be garbage collected while fetching
+            del rows
+            keys, rows, next_url = self._fetch(self._get(next_url))
+            self.pages += 1
+            if keys != self._keys:
+                raise ValueError(
+                    "Page %d keys (%r) do not match page 1 keys (%r)" %
+                    (self.pages, keys, self._keys))
+            yield rows
+
+    def __iter__(self):
+        for rows in self.iter_pages():
+            row_type = self.row_type
+            for r in rows:
+                yield row_type._make(r)
+
+    def iter_csv(self, fp, header=True):
+        """
+        Like iterating over the table, and write the rows to fp in the
+        format of dump_iter_datatable (tab-separated, with the keys in the
+        first row if header is True). Each page is written with one write.
+        """
+        buf = io.StringIO()
+        c = csv.writer(buf, dialect='excel-tab')
+        for rows in self.iter_pages():
+            if header and self.pages == 1:
+                c.writerow(self.keys)
+            c.writerows(rows)
+            fp.write(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
+            row_type = self.row_type
+            for r in rows:
+                yield row_type._make(r)
+
+    def write_csv(self, fp, header=True):
+        """Write the table to fp (see iter_csv). Returns the number of rows."""
+        n = 0
+        for n, row in enumerate(self.iter_csv(fp, header), 1):
+            pass
+        return n
+
+
 def parse_datatable(response, document, extract=None, table_id=None):
     if table_id is None:
         table_id = 'listContainer_datatable'
@@ -3,8 +3,6 @@ import ast
 import sys
 import collections
 
-import blackboard
-import blackboard.backend
 from blackboard import logger, ParserError, DOMAIN
 
 
@@ -77,8 +75,8 @@ def get_script_session_id(session):
     except AttributeError:
         pass
     url = 'https://%s/javascript/dwr/engine.js' % DOMAIN
-    # Bypass BlackboardSession.get and go straight to requests.Session instead
-    dwr_engine = session.session.get(url).text
+    # Bypass BlackboardSession.get, which would parse the script as HTML
+    dwr_engine = session.get_static(url).text
     mo = re.search('dwr.engine._origScriptSessionId = "(.*)";', dwr_engine)
     if mo:
         orig_id = mo.group(1)
@@ -260,6 +258,7 @@ def dwr_get_attempts_info_single_request(session, attempts):
         results = parse_js(response.text)
     except ValueError as exn:
         raise ParserError(exn.args[0], response)
+    session.trace_parsed(response)
     return [results[i] for i in range(len(attempts))]
 
 
@@ -267,10 +266,8 @@ def dwr_get_attempts_info(session, attempts, batch_size=20):
     results = []
     for i in range(0, len(attempts), batch_size):
         j = min(len(attempts), i + batch_size)
-        l = blackboard.slowlog()
         results.extend(
             dwr_get_attempts_info_single_request(session, attempts[i:j]))
-        l("Fetching %d attempt lists took %%.1f s" % (j - i))
     return results
 
 
@@ -1,15 +1,22 @@
 from xml.etree.ElementTree import ElementTree
 from six import BytesIO
-from html2text import html2text as html_to_markdown
+from html2text import html2text
+
+from blackboard.markdown import MarkdownWriter, UnsupportedMarkup
 
 
 def element_hidden(element):
-    class_list = element.get('class', '').split()
-    if 'hideoff' in class_list:
-        return True
-    if 'author_highlight' in class_list:
-        return True
-    if 'display: none' in element.get('style', ''):
+    class_attr = element.get('class')
+    # Only split the class attribute if it can contain a hidden class
+    if class_attr and ('hideoff' in class_attr or
+                       'author_highlight' in class_attr):
+        class_list = class_attr.split()
+        if 'hideoff' in class_list:
+            return True
+        if 'author_highlight' in class_list:
+            return True
+    style = element.get('style')
+    if style and 'display: none' in style:
         return True
 
 
@@ -29,16 +36,30 @@ def element_text_content(element, element_hidden=element_hidden):
     >>> from xml.etree.ElementTree import fromstring
     >>> element_text_content(fromstring(s))
     'au1234567'
-    """
 
-    def visit(e):
-        if not element_hidden(e):
-            yield e.text or ''
-            for c in e:
-                yield ''.join(visit(c))
-            yield e.tail or ''
+    The tail of a hidden element is hidden as well:
 
-    return ' '.join(''.join(visit(element)).split())
+    >>> element_text_content(fromstring('<p>a <b class="hideoff">b</b> c</p>'))
+    'a'
+    """
+
+    parts = []
+    # Stack of elements to visit and tails to append, in reverse order.
+    # The text, children and tail of a hidden element are all skipped.
+    stack = [element]
+    while stack:
+        e = stack.pop()
+        if isinstance(e, str):
+            parts.append(e)
+            continue
+        if element_hidden(e):
+            continue
+        if e.text:
+            parts.append(e.text)
+        if e.tail:
+            stack.append(e.tail)
+        stack.extend(reversed(e))
+    return ' '.join(''.join(parts).split())
 
 
 def element_to_html(element):
@@ -59,8 +80,38 @@ def element_to_html(element):
     return body
 
 
-def element_to_markdown(element):
-    return html_to_markdown(element_to_html(element))
+def html_to_markdown(html, cache=None):
+    """
+    Convert HTML to Markdown with html2text, using cache
+    (a blackboard.markdown.MarkdownCache) if it is not None.
+    """
+    if cache is None:
+        return html2text(html)
+    markdown = cache.get(html)
+    if markdown is None:
+        markdown = html2text(html)
+        cache.set(html, markdown)
+    return markdown
+
+
+def element_to_markdown(element, cache=None):
+    """
+    Convert an element to Markdown like html_to_markdown(element_to_html(e)).
+
+    Both functions give the same result for the same HTML,
+    so they share the entries of cache.
+    """
+    if cache is not None:
+        html = element_to_html(element)
+        markdown = cache.get(html)
+        if markdown is None:
+            markdown = element_to_markdown(element)
+            cache.set(html, markdown)
+        return markdown
+    try:
+        return MarkdownWriter().convert(element)
+    except UnsupportedMarkup:
+        return html2text(element_to_html(element))
 
 
 def form_field_value(element):
@@ -0,0 +1,45 @@
+import re
+
+
+# Pairs (endpoint class, regular expression matching the URL).
+# The first matching pattern decides the class of a URL.
+ENDPOINT_CLASSES = [
+    ('login', r'^https?://wayf\.au\.dk/|/webapps/login/|shibbolethLogin'),
+    ('overview', r'/webapps/gradebook/do/instructor/getJSONData\b'),
+    ('attempt_counts',
+     r'/webapps/gradebook/do/instructor/getJSONUniqueAttemptData\b'),
+    ('dwr', r'/dwr/call/'),
+    ('dwr_engine', r'/javascript/dwr/engine\.js'),
+    ('attempt', r'/webapps/assignment/gradeAssignmentRedirector\b'),
+    ('submit', r'/webapps/assignment//?grade(Group)?Assignment/submit\b'),
+    ('rubric', r'/webapps/rubric/do/course/gradeRubric\b'),
+    ('upload', r'/webapps/gradebook/do/instructor/uploadGradebook2\b'),
+    ('groups', r'/webapps/bb-group-mgmt-LEARN/execute/groupInventoryList\b'),
+    ('datatable', r'/webapps/blackboard/(execute/userManager|' +
+                  r'content/manageDashboard\.jsp)\b'),
+    ('download', r'/bbcswebdav/|/webapps/assignment/download\b|' +
+                 r'[?&]fileId=|/webapps/blackboard/execute/content/file\b'),
+]
+
+_patterns = [(name, re.compile(pattern))
+             for name, pattern in ENDPOINT_CLASSES]
+
+
+def endpoint_class(url):
+    """
+    Classify a Blackboard URL by which kind of endpoint it is for.
+
+    >>> endpoint_class('https://blackboard.au.dk/webapps/gradebook/do/' +
+    ...                'instructor/getJSONData?course_id=_1_1')
+    'overview'
+    >>> endpoint_class('https://blackboard.au.dk/webapps/gradebook/dwr/' +
+    ...                'call/plaincall/GradebookDWRFacade.getGroups.dwr')
+    'dwr'
+    >>> endpoint_class('https://blackboard.au.dk/webapps/blackboard/' +
+    ...                'execute/courseMain?course_id=_1_1')
+    'other'
+    """
+    for name, pattern in _patterns:
+        if pattern.search(url):
+            return name
+    return 'other'
@@ -1,6 +1,6 @@
 import blackboard
 
-from blackboard.datatable import fetch_datatable
+from blackboard.datatable import Datatable
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
@@ -13,13 +13,18 @@ def get_all_users(session):
         '&sortCol=userFirstName&sortDir=ASCENDING' +
         '&userInfoSearchKeyString=UserName' +
         '&userInfoSearchOperatorString=Contains&userInfoSearchText=a')
-    response, keys, rows = fetch_datatable(session, url, 'get_all_users.csv')
+    # The user picker lists every user at the university,
+    # so stream the rows to the CSV file instead of collecting them first.
+    table = Datatable(session, url)
+    with open('get_all_users.csv', 'w') as fp:
+        users = parse_all_users(table.keys, table.iter_csv(fp))
+    response = table.response
     with open('all_users.html', 'wb') as fp:
         fp.write(url.encode('ascii') + b'\n')
         for r in list(response.history) + [response]:
             fp.write(('%s %s\n' % (r.status_code, r.url)).encode('ascii'))
         fp.write(response.content)
-    return parse_all_users(keys, rows)
+    return users
 
 
 def parse_all_users(keys, rows):
@@ -46,10 +46,10 @@ def get_thread_posts(session, forum_id, nonce, threads):
         '&requestType=thread&course_id=%s' % session.course_id)
     r = session.get(url)
     document = html5lib.parse(r.content, transport_encoding=r.encoding)
-    return parse_thread_posts(document)
+    return parse_thread_posts(document, session.markdown_cache)
 
 
-def parse_thread_posts(document):
+def parse_thread_posts(document, markdown_cache=None):
     post_elements = document.findall('.//h:div[@class="dbThread"]', NS)
     h_dt = '{%s}dt' % NS['h']
     h_dd = '{%s}dd' % NS['h']
@@ -70,7 +70,7 @@ def parse_thread_posts(document):
                     data.append((key, text))
         body = post.find('.//h:div[@class="dbThreadBody"]', NS)
         if body is not None:
-            body = element_to_markdown(body)
+            body = element_to_markdown(body, markdown_cache)
         else:
             body = ''
         yield dict(
@@ -3,18 +3,24 @@ import textwrap
 import collections
 
 import blackboard
-from blackboard import BlackboardSession, logger, DOMAIN
+from blackboard import BlackboardSession, ParserError, logger, DOMAIN
 from blackboard.dwr import dwr_get_attempts_info
 from blackboard.backend import fetch_overview
+from blackboard.scores import ScoreMatrix
 
 
 def get_handin_attempt_counts(session, handin_id):
     url = ('https://%s/webapps/gradebook/do/instructor/' % DOMAIN +
            'getJSONUniqueAttemptData?course_id=%s' % session.course_id +
            '&itemId=%s' % handin_id)
-    o = session.get(url).json()
-    assert set(o.keys()) == {'totalStudentsOrGroups', 'needsGradingCount',
-                             'numberOfUniqueAttempts'}
+    response = session.get(url)
+    try:
+        o = response.json()
+    except ValueError:
+        raise ParserError("Couldn't decode JSON", response)
+    if set(o.keys()) != {'totalStudentsOrGroups', 'needsGradingCount',
+                         'numberOfUniqueAttempts'}:
+        raise ParserError("Unexpected keys %r" % sorted(o.keys()), response)
     return o
 
 
@@ -318,12 +324,23 @@ def truncate_name(name, n):
 class Gradebook(blackboard.Serializable):
     """Provides a view of what is accessible in the Blackboard gradebook."""
 
-    FIELDS = '_students fetch_time _assignments'.split()
+    FIELDS = '_students fetch_time _assignments attempt_counts'.split()
+
+    # Use getJSONUniqueAttemptData to skip getAttemptsInfo for assignments
+    # where nothing has been handed in or graded since the last refresh.
+    # This costs one extra (small) request per assignment on every refresh,
+    # which pays off as soon as a single attempt list can be skipped.
+    track_attempt_counts = True
 
     def __init__(self, session):
         assert isinstance(session, BlackboardSession)
         self.session = session
 
+    def deserialize_default(self, key):
+        if key == 'attempt_counts':
+            return {}
+        return super().deserialize_default(key)
+
     @property
     def students(self):
         return DictWrapper(Student, self._students,
@@ -333,8 +350,21 @@ class Gradebook(blackboard.Serializable):
     def assignments(self):
         return DictWrapper(Assignment, self._assignments)
 
-    def refresh(self, refresh_attempts=False, student_visible=None):
-        """Fetch gradebook information from Blackboard website."""
+    @property
+    def score_matrix(self):
+        """ScoreMatrix of all students, rebuilt after each refresh."""
+        m = getattr(self, '_score_matrix', None)
+        if m is None:
+            m = self._score_matrix = ScoreMatrix(self)
+        return m
+
+    def refresh(self, refresh_attempts=False, student_visible=None,
+                attempt_counts=None):
+        """Fetch gradebook information from Blackboard website.
+
+        If attempt_counts is given (as returned by fetch_attempt_counts),
+        it is used instead of fetching the attempt counts again.
+        """
         new_fetch_time = time.time()
         try:
             prev = self._students
@@ -344,15 +374,52 @@ class Gradebook(blackboard.Serializable):
         overview = fetch_overview(self.session)
         self._assignments = overview.assignments
         self._students = overview.students
+        if attempt_counts is not None:
+            counts = attempt_counts
+        elif self.track_attempt_counts:
+            counts = self.fetch_attempt_counts()
+        else:
+            counts = {}
+        prev_counts = getattr(self, 'attempt_counts', None) or {}
+        unchanged = set(assignment_id for assignment_id, c in counts.items()
+                        if prev_counts.get(assignment_id) == c)
+        if counts:
+            logger.debug("Attempt counts unchanged for %d of %d assignments",
+                         len(unchanged), len(counts))
         if prev is not None:
-            self.copy_student_data(prev)
+            self.copy_student_data(prev, unchanged)
         # No exception raised; store fetch_time
         self.fetch_time = new_fetch_time
-        self.refresh_attempts(refresh_all=refresh_attempts,
-                              student_visible=student_visible)
-
-    def copy_student_data(self, prev):
-        """After updating self._students, copy over old assignment data."""
+        with self.session.phase('dwr'):
+            self.refresh_attempts(refresh_all=refresh_attempts,
+                                  student_visible=student_visible)
+        # Only store the counts once the attempt lists they describe
+        # have been fetched.
+        self.attempt_counts = counts
+        self._score_matrix = None
+
+    def fetch_attempt_counts(self):
+        """
+        Fetch the number of attempts and attempts needing grading
+        for each assignment (one small JSON request per assignment).
+        """
+        counts = {}
+        for assignment_id in self._assignments.keys():
+            try:
+                counts[assignment_id] = get_handin_attempt_counts(
+                    self.session, assignment_id)
+            except ParserError as exn:
+                logger.debug("No attempt counts for %s: %s",
+                             assignment_id, exn)
+        return counts
+
+    def copy_student_data(self, prev, unchanged_assignments=None):
+        """After updating self._students, copy over old assignment data.
+
+        If unchanged_assignments is given, attempt lists of assignments
+        not in it are not copied for students with an attempt needing
+        grading, since that student may have handed in another attempt.
+        """
         for user_id, user in self._students.items():
             try:
                 prev_user = prev[user_id]
@@ -371,11 +438,21 @@ class Gradebook(blackboard.Serializable):
                 if a1['score'] != a2['score']:
                     # Score information changed -- don't copy this assignment.
                     continue
+                if (a1['needs_grading'] and
+                        unchanged_assignments is not None and
+                        assignment_id not in unchanged_assignments):
+                    # Attempt counts changed -- there may be a new attempt.
+                    continue
                 if a1['attempts'] is None:
                     a1['attempts'] = a2['attempts']
 
-    def refresh_attempts(self, attempts=None, student_visible=None, refresh_all=False):
-        """Bulk-refresh all missing assignment data."""
+    def refresh_attempts(self, attempts=None, student_visible=None,
+                         refresh_all=False):
+        """Bulk-refresh all missing assignment data.
+
+        With refresh_all, attempt lists are refetched even if they are
+        already known (regardless of the attempt counts).
+        """
         attempt_keys = []
         students = self.students.values()
         if attempts is None:
@@ -399,6 +476,7 @@ class Gradebook(blackboard.Serializable):
         attempt_data = dwr_get_attempts_info(self.session, attempt_keys)
         for (user_id, aid), attempts in zip(attempt_keys, attempt_data):
             self.students[user_id]['assignments'][aid]['attempts'] = attempts
+        self._score_matrix = None
 
 
 class Rubric(object):
@@ -1,37 +1,134 @@
 import os
 import re
 import json
+import time
 import decimal
 import numbers
 import argparse
 import requests
 import functools
 import blackboard
+import contextlib
 import collections
+import concurrent.futures
 from blackboard import logger, ParserError, BadAuth, BlackboardSession
 # from groups import get_groups
 from blackboard.gradebook import (
     Gradebook, Attempt, truncate_name, StudentAssignment, Rubric,
 )
 from blackboard.backend import (
-    fetch_attempt, submit_grade, fetch_groups, fetch_rubric,
-    is_course_id_valid, NotYetSubmitted,
+    fetch_attempt, submit_grade, fetch_groups_if_changed, fetch_rubric,
+    is_course_id_valid, NotYetSubmitted, rubric_fingerprint,
 )
+from blackboard.cache import (
+    DiskCache, default_cache_directory, fingerprint,
+)
+from blackboard.profiling import PhaseProfiler
+from blackboard.tracing import Tracer
+from blackboard.scheduler import RequestScheduler
+from blackboard.httpcache import ResponseCache, ValidatorStore
+from blackboard.markdown import MarkdownCache
+from blackboard.columnar import gradebook_table, groups_table, write_table
+from blackboard.datatable import DatatableCache
+from blackboard.scores import column_widths
+from blackboard.cellcache import CellCache
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
 
+Group = collections.namedtuple('Group', 'name id')
+
 
 class Grading(blackboard.Serializable):
-    FIELDS = ('attempt_state', 'gradebook', 'username', 'groups', 'rubrics')
+    FIELDS = ('attempt_state', 'gradebook', 'username', 'groups', 'rubrics',
+              'groups_fingerprint')
 
     session_class = BlackboardSession
     gradebook_class = Gradebook
 
+    # Directory for data about this course that is not in grading.json,
+    # such as validators of downloaded files; None to disable.
+    state_directory = '.bbfetch'
+
     def __init__(self, session):
         self.session = session
         self.gradebook = type(self).gradebook_class(self.session)
         self.username = session.username
+        # Set by refresh, so that main does not refresh a gradebook
+        # that was just fetched by load (when grading.json is missing).
+        self.refreshed = False
+        if self.state_directory is not None:
+            self.session.validators = ValidatorStore(
+                os.path.join(self.state_directory, 'http'))
+        if self.state_directory is not None and self.reuse_rendered:
+            self.session.markdown_cache = MarkdownCache(
+                os.path.join(self.state_directory, 'markdown.json'))
+            self.gradebook_cells = CellCache(
+                os.path.join(self.state_directory, 'cells.json'))
+        else:
+            self.gradebook_cells = CellCache()
+        if self.schedule_requests:
+            self.enable_scheduler()
+        if self.cache_datatables:
+            self.enable_datatable_cache()
+
+    # Reuse feedback converted to Markdown and rendered gradebook cells
+    # from earlier runs (stored in state_directory). Disabled by --no-reuse.
+    reuse_rendered = True
+
+    # Only parse the pages of datatables (such as the group list) that
+    # changed since the last run, reusing the rows stored in
+    # state_directory. Also enabled by --datatable-cache.
+    cache_datatables = False
+
+    def enable_datatable_cache(self):
+        if self.state_directory is None:
+            return
+        self.session.datatable_cache = DatatableCache(
+            os.path.join(self.state_directory, 'datatables'))
+
+    def disable_reuse(self):
+        """Forget the Markdown feedback and cells of earlier runs."""
+        self.session.markdown_cache = None
+        self.gradebook_cells = CellCache()
+
+    # Send requests through a RequestScheduler, which limits the rate and
+    # concurrency of requests per endpoint and records their latencies
+    # (see blackboard.scheduler). Also enabled by --schedule and --hedge.
+    schedule_requests = False
+
+    def enable_scheduler(self):
+        if self.session.scheduler is not None:
+            return
+        self.session.scheduler = RequestScheduler()
+        if self.state_directory is not None:
+            self.session.scheduler.load_latencies(
+                self.get_latencies_filename())
+
+    def get_latencies_filename(self):
+        return os.path.join(self.state_directory, 'latencies.json')
+
+    def save_markdown_cache(self):
+        """Save the feedback converted to Markdown for the next run."""
+        if self.session.markdown_cache is not None:
+            self.session.markdown_cache.save()
+
+    def save_validators(self):
+        """Save the validators of downloaded files for the next run."""
+        if self.session.validators is not None:
+            self.session.validators.save()
+
+    def save_gradebook_cells(self):
+        """Save the gradebook cells and the printed rows for the next run."""
+        if self.gradebook_cells is not None:
+            self.gradebook_cells.save()
+
+    def save_latencies(self):
+        """Save request latencies for the --hedge deadlines of the next run."""
+        if self.state_directory is None or self.session.scheduler is None:
+            return
+        os.makedirs(self.state_directory, exist_ok=True)
+        self.session.scheduler.save_latencies(self.get_latencies_filename())
 
     def initialize_fields(self):
         super().initialize_fields()
@@ -50,6 +147,7 @@ class Grading(blackboard.Serializable):
             self.attempt_state = {}
         if self.should_refresh_groups():
             self.refresh_groups()
+        self.refreshed = True
         self.autosave()
 
     def should_refresh_groups(self):
@@ -58,22 +156,70 @@ class Grading(blackboard.Serializable):
         if any(k.startswith('Access the profile') for k in self.groups.keys()):
             return True
 
-    def refresh_groups(self):
+    def refresh_groups(self, force=True):
+        """
+        Fetch student group memberships. All pages of the group list
+        are fetched, but unless force is True, they are only parsed if
+        their fingerprint has changed since they were last fetched.
+        """
         logger.info("Fetching student group memberships")
-        self.groups = fetch_groups(self.session)
-        if any(k.startswith('Access the profile') for k in self.groups.keys()):
+        if force or self.should_refresh_groups():
+            fingerprint = None
+        else:
+            fingerprint = getattr(self, 'groups_fingerprint', None)
+        fingerprint, groups = fetch_groups_if_changed(
+            self.session, fingerprint)
+        if groups is None:
+            logger.debug("Student group memberships are unchanged")
+            return
+        if any(k.startswith('Access the profile') for k in groups.keys()):
             raise Exception("fetch_groups returned bad usernames")
+        self.groups = groups
+        self.groups_fingerprint = fingerprint
+        self.groups_changed()
 
-    def get_rubric(self, attempt_rubric):
+    # Directory of rubric definitions shared between courses;
+    # None means ~/.cache/bbfetch/rubrics, False disables the cache.
+    rubric_cache_directory = None
+
+    def get_rubric_cache(self):
+        if self.rubric_cache_directory is False:
+            return
+        if self.rubric_cache_directory is None:
+            return DiskCache(os.path.join(default_cache_directory(), 'rubrics'))
+        return DiskCache(os.path.expanduser(self.rubric_cache_directory))
+
+    def get_rubric_definition(self, attempt_rubric):
+        """
+        Return the rubric definition (as returned by fetch_rubric)
+        for an entry in an attempt's rubric_data.
+
+        Definitions are looked up in self.rubrics and then in the shared
+        rubric cache, keyed by rubric ID and rubric_fingerprint, so that
+        a changed rubric is refetched even if its ID is unchanged.
+        """
         if not hasattr(self, 'rubrics') or self.rubrics is None:
             self.rubrics = {}
         rubric_id = attempt_rubric['id']
-        if rubric_id not in self.rubrics:
+        fp = rubric_fingerprint(attempt_rubric)
+        rubric = self.rubrics.get(rubric_id)
+        if rubric is not None and rubric_fingerprint(rubric) == fp:
+            return rubric
+        key = '%s-%s' % (rubric_id, fp)
+        cache = self.get_rubric_cache()
+        rubric = cache.get(key) if cache is not None else None
+        if rubric is None or rubric_fingerprint(rubric) != fp:
             assoc_id = attempt_rubric['assocEntityId']
-            self.rubrics[rubric_id] = fetch_rubric(
-                self.session, assoc_id, rubric)
+            rubric = fetch_rubric(self.session, assoc_id, attempt_rubric)
+            if cache is not None:
+                cache.set(key, rubric)
+        else:
+            logger.debug("Using cached rubric %s", key)
+        self.rubrics[rubric_id] = rubric
+        return rubric
 
-        rubric = self.rubrics[rubric_id]
+    def get_rubric(self, attempt_rubric):
+        rubric = self.get_rubric_definition(attempt_rubric)
         title = rubric['title']
         assert title == attempt_rubric['title']
         assert len(rubric['rows']) == len(attempt_rubric['rows'])
@@ -107,12 +253,13 @@ class Grading(blackboard.Serializable):
     def deserialize_default(self, key):
         if key in ('groups', 'rubrics'):
             return {}
+        if key == 'groups_fingerprint':
+            return None
         return super().deserialize_default(key)
 
     def get_student_groups(self, student):
         if self.groups is None:
             return []
-        Group = collections.namedtuple('Group', 'name id')
         try:
             groups = [Group(g[0], g[1])
                       for g in self.groups[student.username]['groups']]
@@ -120,7 +267,47 @@ class Grading(blackboard.Serializable):
             groups = []
         return groups
 
+    def groups_changed(self):
+        """
+        Forget the memoized group display, visibility and ordering of
+        students (see get_student_memo). Call this after changing
+        self.groups in place.
+        """
+        self.groups_version = getattr(self, 'groups_version', 0) + 1
+
+    def deserialize(self, o):
+        super().deserialize(o)
+        self.groups_changed()
+
+    def get_student_memo(self):
+        """
+        Return dicts that map usernames to the group display and the
+        visibility of students, and (username, name) to the ordering key.
+        They are emptied when the groups change (see groups_changed)
+        or the settings that the values depend on change.
+        """
+        classes = getattr(self, 'classes', None)
+        if isinstance(classes, list):
+            classes = tuple(classes)
+        settings = (getattr(self, 'student_group_display_regex', None),
+                    getattr(self, 'groups_regex', None), classes)
+        version = getattr(self, 'groups_version', 0)
+        memo = getattr(self, '_student_memo', None)
+        if memo is None or memo[0] != version or memo[1] != settings:
+            memo = self._student_memo = (version, settings, {}, {}, {})
+        return memo[2:]
+
     def get_student_group_display(self, student):
+        displays = self.get_student_memo()[0]
+        try:
+            return displays[student.username]
+        except KeyError:
+            pass
+        display = displays[student.username] = (
+            self.compute_student_group_display(student))
+        return display
+
+    def compute_student_group_display(self, student):
         groups = self.get_student_groups(student)
         if self.student_group_display_regex is None:
             if not groups:
@@ -129,10 +316,10 @@ class Grading(blackboard.Serializable):
                 return self.get_group_name_display(groups[0])
         else:
             pattern, repl = self.student_group_display_regex
+            pattern = re.compile(pattern)
             for g in groups:
-                mo = re.fullmatch(pattern, g.name)
-                if mo:
-                    return re.sub(pattern, repl, g.name)
+                if pattern.fullmatch(g.name):
+                    return pattern.sub(repl, g.name)
             return ''
 
     def get_assignment_name_display(self, assignment):
@@ -150,13 +337,23 @@ class Grading(blackboard.Serializable):
         raise NotImplementedError
 
     def get_student_visible(self, student):
+        visible = self.get_student_memo()[1]
+        try:
+            return visible[student.username]
+        except KeyError:
+            pass
+        v = visible[student.username] = self.compute_student_visible(student)
+        return v
+
+    def compute_student_visible(self, student):
         try:
             gr = self.groups_regex
         except AttributeError:
             gr = None
         if gr is not None:
+            gr = re.compile(gr)
             for g in self.get_student_groups(student):
-                if re.match(gr, g.name) is not None:
+                if gr.match(g.name) is not None:
                     return True
             return False
         if self.classes is None:
@@ -178,7 +375,18 @@ class Grading(blackboard.Serializable):
         Return a sorting key for the student
         indicating how students should be sorted when displayed.
         Typically you want to sort by group, then by name.
+        The key is computed by compute_student_ordering.
         """
+        orderings = self.get_student_memo()[2]
+        key = (student.username, student.name)
+        try:
+            return orderings[key]
+        except KeyError:
+            pass
+        ordering = orderings[key] = self.compute_student_ordering(student)
+        return ordering
+
+    def compute_student_ordering(self, student):
         return (self.get_student_group_display(student), student.name)
 
     def get_assignment_display(self, u, assignment):
@@ -204,6 +412,75 @@ class Grading(blackboard.Serializable):
                 cell.append('%g' % attempt.score)
         return ''.join(cell)
 
+    def cache_assignment_cells(self):
+        """
+        Whether get_assignment_cell may reuse cells from gradebook_cells.
+        Subclasses that override how cells or downloaded files are found
+        may depend on other files than those in the attempt directories,
+        so their cells are always computed.
+        """
+        if self.gradebook_cells is None:
+            return False
+        cls = type(self)
+        return all(getattr(cls, name) is getattr(Grading, name)
+                   for name in ('get_assignment_display', 'has_feedback',
+                                'has_downloaded', 'get_attempt_directory',
+                                'get_attempt_files', 'get_attempt_state'))
+
+    def get_assignment_cell_inputs(self, u, assignment):
+        """
+        Return what get_assignment_display(u, assignment) depends on:
+        the id, status and score of each attempt, and for attempts that
+        are not graded, their attempt state and the modification time of
+        their directory, which changes when files are added or removed.
+        Returns None if the attempts are not known.
+        """
+        try:
+            data = u['assignments'][assignment.id]
+        except KeyError:
+            return None
+        if data['attempts'] is None:
+            return None
+        if assignment.group_assignment:
+            keys = ('groupAttemptId', 'groupStatus', 'groupScore')
+        else:
+            keys = ('id', 'status', 'score')
+        inputs = []
+        for i, a in enumerate(data['attempts']):
+            values = [a.get(k) for k in keys]
+            if values[1]:
+                attempt = Attempt(a, assignment=u.assignments[assignment.id],
+                                  attempt_index=i)
+                st = self.get_attempt_state(attempt)
+                directory = st.get('directory')
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except (TypeError, OSError):
+                    mtime = None
+                values += [directory, mtime, fingerprint(st)]
+            inputs.append(values)
+        return inputs
+
+    def get_assignment_cell(self, u, assignment):
+        """
+        Return get_assignment_display(u, assignment), reusing the cell
+        from gradebook_cells if its inputs are unchanged.
+        """
+        inputs = None
+        if self.cache_assignment_cells():
+            inputs = self.get_assignment_cell_inputs(u, assignment)
+        if inputs is None:
+            return self.get_assignment_display(u, assignment)
+        key = '%s %s' % (u.id, assignment.id)
+        cell = self.gradebook_cells.get(key, inputs)
+        if cell is None:
+            cell = self.get_assignment_display(u, assignment)
+            if any(len(values) > 3 for values in inputs):
+                # get_assignment_display may have fetched the attempt state
+                inputs = self.get_assignment_cell_inputs(u, assignment)
+            self.gradebook_cells.set(key, inputs, cell)
+        return cell
+
     def get_gradebook_columns(self):
         columns = [
             ('Username', lambda u: u.username),
@@ -212,7 +489,7 @@ class Grading(blackboard.Serializable):
         ]
         for assignment in self.gradebook.assignments.values():
             name = self.get_assignment_name_display(assignment)
-            display = functools.partial(self.get_assignment_display,
+            display = functools.partial(self.get_assignment_cell,
                                         assignment=assignment)
             columns.append(('|', lambda u: '|'))
             columns.append((name, display))
@@ -235,23 +512,62 @@ class Grading(blackboard.Serializable):
             rows.append(cells)
         return rows
 
-    def print_gradebook(self):
-        """Print a representation of the gradebook state."""
+    def print_gradebook(self, changed_only=False):
+        """
+        Print a representation of the gradebook state. If changed_only,
+        only print the students whose row has changed since the gradebook
+        was last printed.
+        """
         columns = self.get_gradebook_columns()
         students = filter(self.get_student_visible,
                           self.gradebook.students.values())
         students = sorted(students, key=self.get_student_ordering)
         rows = self.get_gradebook_cells(columns, students)
-        col_widths = [0] * len(columns)
-        for row in rows:
-            for i, cell in enumerate(row):
-                col_widths[i] = max(col_widths[i], len(str(cell)))
+        rows = [[str(cell) for cell in row] for row in rows]
+        col_widths = column_widths(rows)
+        if self.gradebook_cells is not None:
+            changed = set(self.gradebook_cells.changed_rows(
+                dict(zip([s.id for s in students], rows[1:]))))
+            if changed_only:
+                if not changed:
+                    print("No changes since the gradebook was last printed")
+                    return
+                rows = rows[:1] + [row for s, row in zip(students, rows[1:])
+                                   if s.id in changed]
         for row in rows:
             row_fmt = []
             for i, cell in enumerate(row):
-                row_fmt.append(str(cell).ljust(col_widths[i]))
+                row_fmt.append(cell.ljust(col_widths[i]))
             print(' '.join(row_fmt).rstrip())
 
+    def print_stats(self):
+        """Print statistics of each assignment for the visible students."""
+        matrix = self.gradebook.score_matrix
+        students = list(filter(self.get_student_visible,
+                               self.gradebook.students.values()))
+        names = [self.get_assignment_name_display(a)
+                 for a in self.gradebook.assignments.values()]
+        rows = [['Assignment', 'Handed in', 'Passed', 'Pass rate',
+                 'Needs grading']]
+        for name, submitted, passed, rate, needs_grading in zip(
+                names, matrix.submitted_counts(students),
+                matrix.pass_counts(students), matrix.pass_rates(students),
+                matrix.needs_grading_counts(students)):
+            rows.append([name, str(submitted), str(passed),
+                         '-' if rate is None else '%.0f%%' % (100 * rate),
+                         str(needs_grading)])
+        col_widths = column_widths(rows)
+        for row in rows:
+            print('  '.join(cell.rjust(w) if i else cell.ljust(w)
+                            for i, (cell, w) in
+                            enumerate(zip(row, col_widths))).rstrip())
+        totals = sorted(s.score for s in students)
+        if totals:
+            print('')
+            print('Points of %d students: min %g, median %g, max %g' %
+                  (len(totals), totals[0], totals[len(totals) // 2],
+                   totals[-1]))
+
     def dump_gradebook(self, fp):
         columns = [
             ('Group', self.get_student_group_display),
@@ -262,16 +578,16 @@ class Grading(blackboard.Serializable):
             ('Score', lambda u: '%g' % u.score),
         ]
 
+        matrix = self.gradebook.score_matrix
+
         def display(u, assignment):
-            try:
-                student_assignment = u.assignments[assignment.id]
-            except KeyError:
+            if not matrix.cell(matrix.present, u, assignment.id):
                 return ''
-            score = sum(a.score or 0 for a in student_assignment.attempts)
-            if score:
-                return len(student_assignment.attempts)
+            attempts = matrix.cell(matrix.attempts, u, assignment.id)
+            if matrix.cell(matrix.attempt_scores, u, assignment.id):
+                return attempts
             else:
-                return -len(student_assignment.attempts)
+                return -attempts
 
         for assignment in self.gradebook.assignments.values():
             name = self.get_assignment_name_display(assignment)
@@ -285,6 +601,21 @@ class Grading(blackboard.Serializable):
         for row in rows:
             print('\t'.join(map(str, row)), file=fp)
 
+    # Format of the files written by export_tables: 'parquet', 'npz',
+    # or None to use Parquet if pyarrow is installed.
+    export_format = None
+
+    def export_tables(self, directory):
+        """Save the gradebook and group memberships as columnar files."""
+        os.makedirs(directory, exist_ok=True)
+        tables = [('gradebook', gradebook_table(self))]
+        if self.groups is not None:
+            tables.append(('groups', groups_table(self)))
+        for name, table in tables:
+            filename = write_table(os.path.join(directory, name), table,
+                                   self.export_format)
+            logger.info("Saved %s", filename)
+
     def get_attempt(self, group, assignment, attempt_index=-1):
         assert isinstance(group, str)
         if isinstance(assignment, int):
@@ -336,11 +667,37 @@ class Grading(blackboard.Serializable):
     def download_all_attempt_files(self, **kwargs):
         kwargs.setdefault('needs_grading', True)
         kwargs.setdefault('needs_download', True)
-        for attempt in self.get_attempts(**kwargs):
-            self.download_attempt_files(attempt)
+        with self.batch_autosave():
+            for attempt in self.get_attempts(**kwargs):
+                self.download_attempt_files(attempt)
             # print("Would download %s to %s" %
             #       (attempt, self.get_attempt_directory_name(attempt)))
 
+    # Number of batch_autosave blocks we are in
+    _autosave_batches = 0
+
+    @contextlib.contextmanager
+    def batch_autosave(self):
+        """
+        Postpone autosave until the end of the with block, so that
+        grading.json is written once instead of after every attempt.
+        """
+        if not self._autosave_batches:
+            self._autosave_pending = False
+        self._autosave_batches += 1
+        try:
+            yield
+        finally:
+            self._autosave_batches -= 1
+            if not self._autosave_batches and self._autosave_pending:
+                self.autosave()
+
+    def autosave(self):
+        if self._autosave_batches:
+            self._autosave_pending = True
+        else:
+            super().autosave()
+
     def get_attempt_directory(self, attempt, create):
         assert isinstance(attempt, Attempt)
         st = self.get_attempt_state(attempt, create=create)
@@ -413,13 +770,8 @@ class Grading(blackboard.Serializable):
                 logger.info("Storing %s %s (text content)", attempt, filename)
 
             else:
-                download_link = o['download_link']
-                response = self.session.session.get(download_link, stream=True)
                 logger.info("Download %s %s", attempt, outfile)
-                with open(outfile, 'wb') as fp:
-                    for chunk in response.iter_content(chunk_size=64*1024):
-                        if chunk:
-                            fp.write(chunk)
+                self.session.download(o['download_link'], outfile)
                 self.extract_archive(outfile)
 
     def extract_archive(self, filename):
@@ -582,14 +934,17 @@ class Grading(blackboard.Serializable):
     def get_attempt_score(self, attempt, comments):
         return self.get_feedback_score(comments)
 
-    def upload_all_feedback(self, dry_run=False):
+    # Number of attempts whose feedback is uploaded concurrently.
+    upload_jobs = 1
+
+    def upload_all_feedback(self, dry_run=False, jobs=None):
         return self.upload_attempts(self.get_attempts(needs_upload=True),
-                                    dry_run=dry_run)
+                                    dry_run=dry_run, jobs=jobs)
 
     def upload_attempt(self, attempt, dry_run=False):
         return self.upload_attempts([attempt], dry_run=dry_run)
 
-    def upload_attempts(self, attempts, dry_run):
+    def upload_attempts(self, attempts, dry_run, jobs=None):
         uploads = []
         for attempt in attempts:
             feedback = self.get_feedback(attempt)
@@ -624,20 +979,126 @@ class Grading(blackboard.Serializable):
                 print("rubrics: %s" % (rubrics,))
                 print(feedback)
         else:
-            for attempt, score, feedback, attachments, rubrics in uploads:
+            def submit(upload):
+                attempt, score, feedback, attachments, rubrics = upload
                 submit_grade(self.session, attempt.id,
                              attempt.assignment.group_assignment,
                              score, feedback, attachments, rubrics)
+
+            if jobs is None:
+                jobs = self.upload_jobs
+            if jobs > 1 and len(uploads) > 1:
+                with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                    # Consume the iterator to propagate any exception.
+                    list(executor.map(submit, uploads))
+            else:
+                for upload in uploads:
+                    submit(upload)
             self.gradebook.refresh_attempts(
                 attempts=[attempt for attempt, _s, _f, _a, _r in uploads])
             self.autosave()
 
+    # With --watch, the time between polls is doubled each time nothing
+    # has changed, up to watch_max_backoff times the given interval.
+    watch_max_backoff = 8
+    # Seconds between polls while a burst of handins is coming in,
+    # and the longest time to wait for it to end before refreshing.
+    watch_settle = 20
+    watch_settle_max = 120
+
+    def fetch_attempt_counts(self):
+        if not self.gradebook.track_attempt_counts:
+            return {}
+        self.session.metrics['watch_polls'] += 1
+        return self.gradebook.fetch_attempt_counts()
+
+    def wait_for_quiet_counts(self, counts):
+        """
+        Poll the attempt counts every watch_settle seconds until they
+        stop changing (for at most watch_settle_max seconds), so that
+        a burst of handins just before a deadline causes a single refresh.
+        Returns the last attempt counts.
+        """
+        waited = 0
+        while waited + self.watch_settle <= self.watch_settle_max:
+            time.sleep(self.watch_settle)
+            waited += self.watch_settle
+            new_counts = self.fetch_attempt_counts()
+            if new_counts == counts:
+                break
+            counts = new_counts
+        return counts
+
+    def refresh_new_attempts(self, attempt_counts=None):
+        """
+        Refresh the gradebook, download the attempts needing grading that
+        were not in the gradebook before, and print a line for each.
+        Returns the new attempts.
+
+        If attempt_counts is given, they are not fetched again
+        (see Gradebook.refresh).
+        """
+        known = set(a.id for a in self.get_attempts())
+        with self.session.phase('refresh'):
+            self.refresh(attempt_counts=attempt_counts)
+        attempts = [a for a in self.get_attempts(needs_grading=True)
+                    if a.id not in known]
+        for attempt in attempts:
+            with self.session.phase('download'):
+                self.download_attempt_files(attempt)
+            print("%s New handin for %s by %s: %s" %
+                  (time.strftime('%H:%M:%S'),
+                   self.get_assignment_name_display(attempt.assignment),
+                   self.get_student_group_display(attempt.student),
+                   attempt))
+        return attempts
+
+    def watch(self, interval):
+        """
+        Until interrupted, poll the attempt counts of all assignments
+        every interval seconds, and when they change, refresh the gradebook
+        and download the new attempts (see refresh_new_attempts).
+
+        The interval is doubled each time nothing changes (see
+        watch_max_backoff) and reset when something does. If attempt
+        counts are not tracked, the gradebook is refreshed on every poll.
+        Polls that fail are logged and count as polls without changes.
+        """
+        logger.info("Watching for new handins every %g seconds", interval)
+        delay = interval
+        try:
+            while True:
+                time.sleep(delay)
+                try:
+                    counts = self.fetch_attempt_counts()
+                    if counts and counts == self.gradebook.attempt_counts:
+                        changed = False
+                    else:
+                        if counts:
+                            counts = self.wait_for_quiet_counts(counts)
+                        attempts = self.refresh_new_attempts(counts or None)
+                        changed = bool(counts) or bool(attempts)
+                except (requests.RequestException, ParserError) as exn:
+                    logger.warning("Polling failed: %s", exn)
+                    changed = False
+                if changed:
+                    delay = interval
+                    self.session.save_cookies()
+                else:
+                    delay = min(2 * delay, self.watch_max_backoff * interval)
+                    logger.debug("No changes; next poll in %g seconds", delay)
+        except KeyboardInterrupt:
+            print('')
+
     def main(self, args, session, grading):
+        phase = self.session.phase
         if args.refresh_groups or args.download >= 1:
-            self.refresh_groups()
-        if args.refresh:
+            with phase('refresh_groups'):
+                self.refresh_groups(force=args.refresh_groups)
+        if args.refresh and not self.refreshed:
             try:
-                self.refresh(refresh_attempts=args.refresh_attempts)
+                with phase('refresh'):
+                    self.refresh(refresh_attempts=args.refresh_attempts)
             except requests.ConnectionError:
                 print("Connection failed; continuing in offline mode (-n)")
                 args.refresh = False
@@ -645,29 +1106,43 @@ class Grading(blackboard.Serializable):
             self.check()
         if args.download_attempt:
             group, assignment, attempt_index = args.download_attempt
-            self.download_attempt_files(
-                self.get_attempt(group, assignment, attempt_index))
-        if args.download >= 3:
-            self.download_all_attempt_files(
-                visible=None, needs_grading=None)
-        elif args.download >= 2:
-            self.download_all_attempt_files(
-                visible=True, needs_grading=None)
-        elif args.download >= 1:
-            self.download_all_attempt_files(
-                visible=True, needs_grading=True)
+            with phase('download'):
+                self.download_attempt_files(
+                    self.get_attempt(group, assignment, attempt_index))
+        if args.download >= 1:
+            with phase('download'):
+                if args.download >= 3:
+                    self.download_all_attempt_files(
+                        visible=None, needs_grading=None)
+                elif args.download >= 2:
+                    self.download_all_attempt_files(
+                        visible=True, needs_grading=None)
+                else:
+                    self.download_all_attempt_files(
+                        visible=True, needs_grading=True)
         if args.upload_check:
             self.upload_all_feedback(dry_run=True)
         if args.upload:
-            self.upload_all_feedback(dry_run=False)
+            with phase('upload'):
+                self.upload_all_feedback(dry_run=False,
+                                         jobs=args.upload_jobs)
             if args.refresh:
                 # Refresh after upload to show that feedback
                 # has been uploaded
-                self.refresh()
-        self.print_gradebook()
+                with phase('refresh'):
+                    self.refresh()
+        if args.watch is not None:
+            self.watch(args.watch)
+        with phase('print_gradebook'):
+            self.print_gradebook(changed_only=args.changed_only)
+            if args.stats:
+                print('')
+                self.print_stats()
         if args.save is not None:
             with open(args.save, 'w') as fp:
                 self.dump_gradebook(fp)
+        if args.export is not None:
+            self.export_tables(args.export)
 
     def check(self):
         print("Username: %r" % (self.session.username,))
@@ -729,6 +1204,9 @@ class Grading(blackboard.Serializable):
                             help='Upload handins that have been graded')
         parser.add_argument('--upload-check', '-U', action='store_true',
                             help='Display what would be uploaded with -u')
+        parser.add_argument('--upload-jobs', '-j', type=int, metavar='N',
+                            help='Upload feedback for up to N attempts ' +
+                                 'concurrently with -u')
         parser.add_argument('--no-refresh', '-n', action='store_false',
                             dest='refresh', help='Run in offline mode')
         parser.add_argument('--refresh-groups', '-g', action='store_true',
@@ -737,6 +1215,62 @@ class Grading(blackboard.Serializable):
                             help='Refresh list of student attempts')
         parser.add_argument('--save', '-o',
                             help='Output TSV file with gradebook info')
+        parser.add_argument('--watch', type=float, metavar='INTERVAL',
+                            help='Poll for new handins every INTERVAL ' +
+                                 'seconds (less often when nothing ' +
+                                 'changes) and download them, until ' +
+                                 'interrupted with Ctrl-C ' +
+                                 '(cannot be used with --http-cache)')
+        parser.add_argument('--changed-only', action='store_true',
+                            help='Only print the students whose row in ' +
+                                 'the gradebook changed since it was ' +
+                                 'last printed')
+        parser.add_argument('--stats', action='store_true',
+                            help='Print the number of handins, pass rate ' +
+                                 'and attempts needing grading ' +
+                                 'of each assignment')
+        parser.add_argument('--export', metavar='DIR',
+                            help='Save the gradebook and group memberships ' +
+                                 'in DIR as Parquet files (or .npz files ' +
+                                 'if pyarrow is not installed)')
+        parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                            help='Give up waiting for a response after ' +
+                                 'SECONDS (default: 120)')
+        parser.add_argument('--retries', type=int, metavar='N',
+                            help='Retry failed GET requests up to N times ' +
+                                 '(default: 3)')
+        parser.add_argument('--trace', nargs='?', const='', metavar='FILE',
+                            help='Print request latencies by endpoint, ' +
+                                 'and save a trace of all requests in FILE')
+        parser.add_argument('--profile', action='store_true',
+                            help='Print time, CPU time, requests and ' +
+                                 'memory usage of each phase of the run')
+        parser.add_argument('--profile-dir', metavar='DIR',
+                            help='Profile the run, and save cProfile ' +
+                                 'statistics of each phase in DIR')
+        parser.add_argument('--hedge', action='store_true',
+                            help='Repeat unusually slow requests for the ' +
+                                 'gradebook and group list (implies ' +
+                                 '--schedule)')
+        parser.add_argument('--schedule', action='store_true',
+                            help='Limit the rate and concurrency of ' +
+                                 'requests to each kind of endpoint, ' +
+                                 'backing off when Blackboard is slow')
+        parser.add_argument('--datatable-cache', action='store_true',
+                            help='Only parse the pages of the group list ' +
+                                 'that changed since the last run')
+        parser.add_argument('--no-reuse', action='store_true',
+                            help='Do not reuse Markdown feedback and ' +
+                                 'gradebook cells from earlier runs')
+        http_cache = parser.add_mutually_exclusive_group()
+        http_cache.add_argument('--http-cache', metavar='DIR',
+                                help='Reuse recent responses stored in DIR')
+        http_cache.add_argument('--record', metavar='DIR',
+                                help='Store all responses in DIR')
+        http_cache.add_argument('--replay', metavar='DIR',
+                                help='Serve all requests from responses ' +
+                                     'stored with --record, without ' +
+                                     'using the network')
 
         return parser
 
@@ -758,6 +1292,50 @@ class Grading(blackboard.Serializable):
     def get_password(cls, **kwargs):
         raise NotImplementedError
 
+    # Time to live in seconds of responses stored with --http-cache,
+    # by endpoint class; see blackboard.httpcache.DEFAULT_TTL.
+    http_cache_ttl = None
+
+    def configure_http_cache(self, args):
+        if args.http_cache:
+            directory, mode = args.http_cache, 'cache'
+        elif args.record:
+            directory, mode = args.record, 'record'
+        elif args.replay:
+            directory, mode = args.replay, 'replay'
+        else:
+            return
+        self.session.cache = ResponseCache(
+            directory, mode=mode, ttl=self.http_cache_ttl)
+
+    def configure_retries(self, args):
+        if args.timeout is not None:
+            connect_timeout = self.session.timeout[0]
+            self.session.timeout = (connect_timeout, args.timeout)
+        if args.retries is not None:
+            self.session.retries = args.retries
+        if args.schedule or args.hedge:
+            # --hedge uses the latencies recorded by the scheduler
+            self.enable_scheduler()
+        if args.hedge:
+            self.session.hedging = True
+
+    def configure_caches(self, args):
+        if args.datatable_cache:
+            self.enable_datatable_cache()
+        if args.no_reuse:
+            self.disable_reuse()
+
+    def report_trace(self, args):
+        tracer = self.session.tracer
+        if tracer is None or not tracer.totals:
+            return
+        summary = tracer.summary()
+        print('\n'.join(summary))
+        if args.trace:
+            tracer.save(args.trace)
+            print("Request trace saved to %s" % args.trace)
+
     def override_get_password(self, args):
         """
         Override the get_password method of BlackboardSession
@@ -786,6 +1364,8 @@ class Grading(blackboard.Serializable):
     def execute_from_command_line(cls):
         parser = cls.get_argument_parser()
         args = parser.parse_args()
+        if args.watch is not None and args.http_cache:
+            parser.error("--watch cannot be used with --http-cache")
         blackboard.configure_logging(quiet=args.quiet)
 
         not_implemented = []
@@ -807,6 +1387,13 @@ class Grading(blackboard.Serializable):
         session = cls.session_class('cookies.txt', username, course)
         grading = cls(session)
         grading.override_get_password(args)
+        grading.configure_http_cache(args)
+        grading.configure_retries(args)
+        grading.configure_caches(args)
+        if args.trace is not None:
+            session.tracer = Tracer()
+        if args.profile or args.profile_dir:
+            session.profiler = PhaseProfiler(session, args.profile_dir)
         try:
             grading.load('grading.json')
             grading.main(args, session, grading)
@@ -821,6 +1408,17 @@ class Grading(blackboard.Serializable):
             logger.exception("Uncaught exception")
         else:
             grading.save('grading.json')
+        grading.save_latencies()
+        grading.save_markdown_cache()
+        grading.save_gradebook_cells()
+        grading.save_validators()
+        if session.metrics:
+            logger.debug("Session metrics: %s",
+                         ', '.join('%s=%g' % kv
+                                   for kv in sorted(session.metrics.items())))
+        grading.report_trace(args)
+        if session.profiler is not None:
+            print('\n'.join(session.profiler.report()))
         session.save_cookies()
 
     @classmethod
@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import collections
+
+import requests
+import requests.structures
+from six.moves.urllib.parse import urlparse
+
+from blackboard.base import logger, DOMAIN
+from blackboard.cache import write_atomic
+from blackboard.endpoints import endpoint_class
+
+
+class CacheMiss(requests.ConnectionError):
+    """Raised in replay mode for a request that was not recorded."""
+
+
+# Seconds that a cached GET response is served in 'cache' mode,
+# by endpoint_class. Endpoints not listed here are not cached.
+# attempt_counts is never cached, since it is how refresh and --watch
+# notice new handins.
+DEFAULT_TTL = {
+    'overview': 600,
+    'attempt': 3600,
+    'rubric': 24 * 3600,
+    'groups': 3600,
+    'datatable': 3600,
+    'dwr_engine': 24 * 3600,
+}
+
+# POSTs to these endpoints change the data in the Grade Centre,
+# so they invalidate every response in the cache.
+INVALIDATING_ENDPOINTS = ('submit', 'upload')
+
+# POST fields that differ between runs without changing the response
+VOLATILE_FIELDS = ('httpSessionId',)
+
+
+class ResponseCache:
+    """
+    Disk-backed store of responses for BlackboardSession.request.
+
+    mode is one of:
+
+    'cache'
+        Serve GET responses that are younger than the TTL of their
+        endpoint class, and store new responses.
+    'record'
+        Send every request, and store every response (including POSTs).
+    'replay'
+        Serve every request from the stored responses without using
+        the network; a request that was not recorded raises CacheMiss.
+    """
+
+    MODES = ('cache', 'record', 'replay')
+
+    def __init__(self, directory, mode='cache', ttl=None):
+        if mode not in self.MODES:
+            raise ValueError("mode must be one of %r" % (self.MODES,))
+        self.directory = directory
+        self.mode = mode
+        self.ttl = dict(DEFAULT_TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+
+    def key(self, method, url, data=None):
+        h = hashlib.sha1()
+        h.update(('%s %s\n' % (method.upper(), url)).encode('utf-8'))
+        if data is not None:
+            h.update(body_fingerprint(data).encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def invalidated_time(self):
+        try:
+            return os.stat(os.path.join(self.directory, 'invalidated')).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def invalidate(self):
+        """Make every response stored until now stale in 'cache' mode."""
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomic(os.path.join(self.directory, 'invalidated'), b'')
+
+    def discard(self, method, url, data=None):
+        base = self.path(self.key(method, url, data))
+        for ext in ('.json', '.body'):
+            try:
+                os.unlink(base + ext)
+            except FileNotFoundError:
+                pass
+
+    def lookup(self, method, url, data=None, fresh=False):
+        """
+        Return the stored response to serve for this request, or None.
+        If fresh is True, nothing is served in 'cache' mode.
+        """
+        if self.mode == 'record':
+            return
+        if self.mode == 'cache':
+            if fresh or method.upper() != 'GET':
+                return
+            ttl = self.ttl.get(endpoint_class(url), 0)
+            if ttl <= 0:
+                return
+        response = self.load(self.key(method, url, data))
+        if response is None:
+            if self.mode == 'replay':
+                raise CacheMiss("%s %s was not recorded" % (method, url))
+            return
+        if self.mode == 'cache':
+            age = time.time() - response.cache_time
+            if age > ttl or response.cache_time < self.invalidated_time():
+                return
+        logger.debug("%s %s from cache", method, url)
+        return response
+
+    def store(self, method, url, response, data=None):
+        if self.mode == 'replay':
+            return
+        method = method.upper()
+        cls = endpoint_class(url)
+        if method == 'POST' and cls in INVALIDATING_ENDPOINTS:
+            self.invalidate()
+        if cls == 'login' or urlparse(response.url).netloc != DOMAIN:
+            # Never store login pages or the credentials posted to them.
+            # A request redirected to login is repeated after logging in,
+            # and that response is stored instead.
+            return
+        if self.mode == 'cache':
+            if method != 'GET' or self.ttl.get(cls, 0) <= 0:
+                return
+            if response.status_code != 200:
+                return
+        self.save(self.key(method, url, data), method, url, response)
+
+    def save(self, key, method, url, response):
+        meta = dict(
+            method=method,
+            request_url=url,
+            time=time.time(),
+            history=[response_meta(r) for r in response.history],
+        )
+        meta.update(response_meta(response))
+        base = self.path(key)
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        # Write the body first, so that a .json file always has a body
+        write_atomic(base + '.body', response.content)
+        write_atomic(base + '.json', json.dumps(meta).encode('utf-8'))
+
+    def load(self, key):
+        base = self.path(key)
+        try:
+            with open(base + '.json') as fp:
+                meta = json.load(fp)
+            with open(base + '.body', 'rb') as fp:
+                content = fp.read()
+        except (FileNotFoundError, ValueError):
+            return
+        response = build_response(meta, content)
+        response.history = [build_response(h, b'') for h in meta['history']]
+        response.cache_time = meta['time']
+        response.from_cache = True
+        return response
+
+
+def response_meta(response):
+    return dict(
+        url=response.url,
+        status_code=response.status_code,
+        reason=response.reason,
+        headers=dict(response.headers),
+        encoding=response.encoding,
+    )
+
+
+def build_response(meta, content):
+    response = requests.Response()
+    response.url = meta['url']
+    response.status_code = meta['status_code']
+    response.reason = meta['reason']
+    response.headers = requests.structures.CaseInsensitiveDict(
+        meta['headers'])
+    response.encoding = meta['encoding']
+    response._content = content
+    response._content_consumed = True
+    return response
+
+
+def body_fingerprint(data):
+    """
+    String that identifies a POST body for use in a cache key.
+
+    >>> body_fingerprint({'b': 1, 'a': 2, 'httpSessionId': 'x'})
+    '[["a", "2"], ["b", "1"]]'
+    """
+    if isinstance(data, dict):
+        data = list(data.items())
+    if isinstance(data, (list, tuple)):
+        return json.dumps(sorted(
+            [str(k), str(v)] for k, v in data
+            if k not in VOLATILE_FIELDS))
+    if isinstance(data, (str, bytes)):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+    # A streaming body such as MultipartEncoder; don't consume it
+    return type(data).__name__
+
+
+class ValidatorStore:
+    """
+    Remembers the validators (ETag and Last-Modified headers) of static
+    resources such as submission files and dwr/engine.js, together with
+    the name of a local copy of each, so that they can be fetched with
+    a conditional GET (see BlackboardSession.download).
+
+    A local copy is only used if its size and modification time are
+    the same as when it was downloaded.
+
+    If directory is None, validators are only remembered in memory,
+    and resources without a local copy (see blob_path) are not stored.
+    Otherwise call save at the end of the run to store them.
+    """
+
+    # Only the validators of the most recently downloaded resources are
+    # saved; None to keep all.
+    max_entries = 10000
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._modified = False
+        if directory is not None:
+            try:
+                with open(os.path.join(directory, 'validators.json')) as fp:
+                    self._entries = json.load(
+                        fp, object_pairs_hook=collections.OrderedDict)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def blob_path(self, url):
+        """Where to store a copy of a resource that is not saved elsewhere."""
+        if self.directory is not None:
+            key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+            return os.path.join(self.directory, 'static', key)
+
+    def local_copy(self, url):
+        """Return the entry for url if its local copy still exists."""
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is not None and file_stamp(entry['filename']) == [
+                entry['size'], entry.get('mtime')]:
+            return entry
+
+    def conditional_headers(self, url):
+        entry = self.local_copy(url)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def remember(self, url, response, filename):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        size, mtime = file_stamp(filename)
+        with self._lock:
+            if self._entries.pop(url, None) is not None:
+                self._modified = True
+            if not etag and not last_modified:
+                return
+            self._entries[url] = dict(
+                etag=etag, last_modified=last_modified,
+                encoding=response.encoding,
+                filename=os.path.abspath(filename),
+                size=size, mtime=mtime)
+            self._modified = True
+
+    def save(self):
+        """Save the validators of local copies that still exist
+        (at most max_entries)."""
+        if self.directory is None or not self._modified:
+            return
+        stale = [url for url in list(self._entries)
+                 if self.local_copy(url) is None]
+        with self._lock:
+            for url in stale:
+                self._entries.pop(url, None)
+            if self.max_entries is not None:
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            data = json.dumps(self._entries).encode('utf-8')
+            self._modified = False
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomic(os.path.join(self.directory, 'validators.json'), data)
+
+
+def file_stamp(filename):
+    """[size, mtime in nanoseconds] of a file, or None if it is missing."""
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return
+    return [st.st_size, st.st_mtime_ns]
@@ -0,0 +1,501 @@
+"""
+Convert ElementTree elements to Markdown without going through html2text.
+
+element_to_markdown in blackboard.elementtext used to serialize the
+element to XML and parse it again with html2text. MarkdownWriter walks
+the element directly and imitates what html2text does with the tags
+that Blackboard's text editor produces: paragraphs, line breaks,
+headings, emphasis, links and (non-nested) lists.
+
+The output must be the same as html2text's, and html2text versions
+differ in how they space emphasis, end lists and wrap lines. For markup
+where the versions in use (2016.1.8 in requirements.txt and later)
+would give different results, and for all other tags, MarkdownWriter
+raises UnsupportedMarkup and the caller falls back to html2text.
+"""
+
+import os
+import re
+import json
+import string
+import hashlib
+import textwrap
+import threading
+import collections
+
+from xml.etree.ElementTree import Comment
+
+import html2text
+from html2text.utils import escape_md, escape_md_section
+
+from blackboard.base import logger
+from blackboard.cache import write_atomic
+
+
+XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+
+# Tags that html2text ignores (their content is kept)
+INLINE_TAGS = frozenset(
+    'span font small big center cite ins mark sup sub o:p'.split())
+EMPHASIS_TAGS = frozenset('em i u'.split())
+STRONG_TAGS = frozenset('strong b'.split())
+HEADING_TAGS = {'h%d' % i: i for i in range(1, 7)}
+SUPPORTED_TAGS = (
+    INLINE_TAGS | EMPHASIS_TAGS | STRONG_TAGS | frozenset(HEADING_TAGS) |
+    frozenset('p div br a ul ol li'.split()))
+
+BODY_WIDTH = 78
+ABSOLUTE_URL = re.compile(r'^[a-zA-Z+]+://')
+# After emphasis, newer html2text versions insert a space before text
+# starting with one of these characters
+PRECEDING_STRESSED = re.compile(r'[^][(){}\s.!?]')
+ORDERED_LIST_ITEM = re.compile(r'\d+\.\s')
+UNORDERED_LIST_ITEM = re.compile(r'[-\*\+]\s')
+SPACE_PLUS = re.compile(r'\s\+')
+WHITESPACE = re.compile(r'\s+')
+# Text that escape_md_section can change contains one of these
+MARKDOWN_SECTION_CHARS = re.compile(r'\\|\d\.|[+-]')
+# In the XML that html2text used to parse, text was split at entities
+ENTITY_CHARS = re.compile(r'([&<>])')
+TRAILING_SPACE_AFTER_ENTITY = re.compile(r'[&<>]\s+$')
+
+
+class UnsupportedMarkup(Exception):
+    pass
+
+
+class MarkdownWriter:
+    r"""
+    Converts one element (including its tail, like ElementTree.write)
+    to the Markdown that html2text.html2text would return for it.
+
+    The attributes mirror the state of html2text.HTML2Text
+    with its default options.
+
+    >>> from xml.etree.ElementTree import fromstring
+    >>> e = fromstring('<div><p>Fine <b>work</b></p>'
+    ...                '<ul><li>one</li><li>two</li></ul></div>')
+    >>> MarkdownWriter().convert(e)
+    'Fine **work**\n\n  * one\n  * two\n\n'
+    >>> MarkdownWriter().convert(fromstring('<div><img src="x.png"/></div>'))
+    Traceback (most recent call last):
+      ...
+    blackboard.markdown.UnsupportedMarkup: img
+    """
+
+    def __init__(self):
+        self.outtext = []
+        self.last_was_nl = False
+        self.p_p = 0
+        self.space = False
+        self.start = True
+        self.astack = []
+        self.maybe_automatic_link = None
+        self.empty_link = False
+        self.lists = []
+        self.last_was_list = False
+        self.after_list = False
+        self.current_tag = None
+        # Only used by newer html2text versions
+        self.stressed = False
+        self.preceding_stressed = False
+        self.preceding_data = ''
+
+    def convert(self, element):
+        stack = [('element', element)]
+        while stack:
+            kind, value = stack.pop()
+            if kind == 'text':
+                self.handle_data(value)
+                continue
+            if kind == 'end':
+                self.handle_tag(value, {}, False)
+                continue
+            e = value
+            if e.tail:
+                stack.append(('text', e.tail))
+            if e.tag is Comment:
+                # html2text ignores comments
+                continue
+            if not isinstance(e.tag, str):
+                raise UnsupportedMarkup(e.tag)
+            tag = tag_name(e.tag)
+            self.handle_tag(tag, e.attrib, True)
+            stack.append(('end', tag))
+            stack.extend(('element', c) for c in reversed(e))
+            if e.text:
+                stack.append(('text', e.text))
+        self.pbr()
+        self.o('', force='end')
+        text = ''.join(self.outtext).replace('&nbsp_place_holder;', ' ')
+        return wrap_markdown(text)
+
+    def out(self, s):
+        self.outtext.append(s)
+        if s:
+            self.last_was_nl = s[-1] == '\n'
+
+    def o(self, data, puredata=False, force=False):
+        if puredata:
+            data = WHITESPACE.sub(' ', data)
+            if data and data[0] == ' ':
+                self.space = True
+                data = data[1:]
+        if not data and not force:
+            return
+        if self.after_list:
+            # Newer versions write an extra newline after a list,
+            # which only makes no difference before a paragraph.
+            if data and self.p_p < 2:
+                raise UnsupportedMarkup('text after list')
+            self.after_list = False
+        if self.start:
+            self.space = False
+            self.p_p = 0
+            self.start = False
+        if force == 'end':
+            self.p_p = 0
+            self.out('\n')
+            self.space = False
+        if self.p_p:
+            self.out('\n' * self.p_p)
+            self.space = False
+        if self.space:
+            if not self.last_was_nl:
+                self.out(' ')
+            self.space = False
+        self.p_p = 0
+        self.out(data)
+
+    def p(self):
+        self.p_p = 2
+
+    def pbr(self):
+        if self.p_p == 0:
+            self.p_p = 1
+
+    def handle_data(self, data):
+        if '\\/script>' in data:
+            raise UnsupportedMarkup('script')
+        if ENTITY_CHARS.search(data):
+            if (self.stressed or self.preceding_stressed or
+                    self.maybe_automatic_link is not None):
+                raise UnsupportedMarkup('entity')
+            # Newer versions escape each part between entities separately
+            parts = ENTITY_CHARS.split(data)
+            escaped = ''.join(
+                p if i % 2 else escape_md_section(p)
+                for i, p in enumerate(parts))
+            if escaped != escape_md_section(data):
+                raise UnsupportedMarkup('entity')
+            if TRAILING_SPACE_AFTER_ENTITY.search(data):
+                # Newer versions write no trailing space here
+                raise UnsupportedMarkup('entity')
+
+        if self.stressed:
+            if data != data.strip():
+                raise UnsupportedMarkup('space in emphasis')
+            self.stressed = False
+            self.preceding_stressed = True
+        elif self.preceding_stressed:
+            if (PRECEDING_STRESSED.match(data[0]) and
+                    self.current_tag not in HEADING_TAGS and
+                    self.current_tag != 'a'):
+                # Newer versions insert a space, which only makes
+                # a difference if it would be written.
+                space_written = not (self.start or self.p_p or self.space or
+                                     self.last_was_nl)
+                if space_written or self.maybe_automatic_link is not None:
+                    raise UnsupportedMarkup('text after emphasis')
+            self.preceding_stressed = False
+
+        if self.maybe_automatic_link is not None:
+            href = self.maybe_automatic_link
+            if href == data and ABSOLUTE_URL.match(href):
+                self.o('<' + data + '>')
+                self.empty_link = False
+                return
+            else:
+                self.o('[')
+                self.maybe_automatic_link = None
+                self.empty_link = False
+
+        if MARKDOWN_SECTION_CHARS.search(data):
+            data = escape_md_section(data)
+        self.preceding_data = data
+        self.o(data, puredata=True)
+
+    def handle_tag(self, tag, attrs, start):
+        self.current_tag = tag
+        if tag not in SUPPORTED_TAGS:
+            raise UnsupportedMarkup(tag)
+
+        if (start and self.maybe_automatic_link is not None and
+                tag not in ('p', 'div')):
+            self.o('[')
+            self.maybe_automatic_link = None
+            self.empty_link = False
+
+        if tag in HEADING_TAGS:
+            if self.astack:
+                raise UnsupportedMarkup('heading in link')
+            self.p()
+            if start:
+                self.o(HEADING_TAGS[tag] * '#' + ' ')
+                self.last_was_list = False
+            return
+
+        if tag in ('p', 'div'):
+            if self.astack:
+                raise UnsupportedMarkup('paragraph in link')
+            self.p()
+
+        if tag == 'br' and start:
+            self.o('  \n')
+
+        if tag in EMPHASIS_TAGS:
+            if (start and self.preceding_data and
+                    self.preceding_data[-1] not in string.whitespace and
+                    self.preceding_data[-1] not in string.punctuation):
+                raise UnsupportedMarkup('emphasis after text')
+            self.o('_')
+            if start:
+                self.stressed = True
+
+        if tag in STRONG_TAGS:
+            if start and self.preceding_data[-1:] == '*':
+                raise UnsupportedMarkup('strong after *')
+            self.o('**')
+            if start:
+                self.stressed = True
+
+        if tag == 'a':
+            if start:
+                href = attrs.get('href')
+                if 'title' in attrs:
+                    raise UnsupportedMarkup('link title')
+                if href is not None and not href.startswith('#'):
+                    self.astack.append(href)
+                    self.maybe_automatic_link = href
+                    self.empty_link = True
+                else:
+                    self.astack.append(None)
+            elif self.astack:
+                href = self.astack.pop()
+                if self.maybe_automatic_link and not self.empty_link:
+                    self.maybe_automatic_link = None
+                elif href is not None:
+                    if self.empty_link:
+                        self.o('[')
+                        self.empty_link = False
+                        self.maybe_automatic_link = None
+                    if self.p_p:
+                        raise UnsupportedMarkup('break in link')
+                    self.o('](' + escape_md(href) + ')')
+
+        if tag in ('ol', 'ul'):
+            if self.astack or (start and self.lists):
+                raise UnsupportedMarkup('nested list')
+            if not self.lists and not self.last_was_list:
+                self.p()
+            if start:
+                if 'start' in attrs:
+                    raise UnsupportedMarkup('list start')
+                self.lists.append([tag, 0])
+            elif self.lists:
+                if self.start:
+                    # Nothing written since the document or list item began
+                    raise UnsupportedMarkup('empty list')
+                self.lists.pop()
+                self.after_list = True
+            self.last_was_list = True
+        else:
+            self.last_was_list = False
+
+        if tag == 'li':
+            if self.astack:
+                raise UnsupportedMarkup('list item in link')
+            self.pbr()
+            if start:
+                li = self.lists[-1] if self.lists else ['ul', 0]
+                self.o('  ' * len(self.lists))
+                if li[0] == 'ul':
+                    self.o('* ')
+                else:
+                    li[1] += 1
+                    self.o('%d. ' % li[1])
+                self.start = True
+
+
+def tag_name(tag):
+    if tag.startswith('{'):
+        namespace, tag = tag[1:].split('}', 1)
+        if namespace != XHTML_NAMESPACE:
+            raise UnsupportedMarkup(namespace)
+    return tag.lower()
+
+
+def wrap_markdown(text):
+    """Wrap paragraphs like html2text.HTML2Text.optwrap."""
+    risky = False
+    for para in text.split('\n'):
+        stripped = para.lstrip()
+        if (stripped[:2] == '**' or ' | ' in para or para[:2] == '> ' or
+                (len(para) > BODY_WIDTH and
+                 max(map(len, para.split())) > BODY_WIDTH)):
+            risky = True
+            break
+    result = optwrap(text, new=False)
+    if risky and optwrap(text, new=True) != result:
+        raise UnsupportedMarkup('line wrapping')
+    return result
+
+
+def skipwrap(para, new):
+    if para[0:4] == '    ' or para[0] == '\t':
+        return True
+    stripped = para.lstrip()
+    if stripped[0:2] == '--' and len(stripped) > 2 and stripped[2] != '-':
+        return False
+    if stripped[0:1] in ('-', '*'):
+        if not new or stripped[0:2] != '**':
+            return True
+    if new and ' | ' in para:
+        return True
+    return bool(ORDERED_LIST_ITEM.match(stripped) or
+                UNORDERED_LIST_ITEM.match(stripped))
+
+
+def wrap_paragraph(para, new, indent):
+    """
+    Wrap a paragraph like textwrap.wrap. Words separated by single spaces
+    are wrapped greedily without going through textwrap.
+
+    >>> print(wrap_paragraph(' '.join(['word'] * 16), False, ''))
+    word word word word word word word word word word word word word word word
+    word
+    """
+    words = para.split()
+    if (indent or '-' in para or not words or
+            ' '.join(words) != para.rstrip(' ') or
+            max(map(len, words)) > BODY_WIDTH):
+        return '\n'.join(textwrap.wrap(
+            para, BODY_WIDTH, break_long_words=not new,
+            subsequent_indent=indent))
+    lines = []
+    line = words[0]
+    for w in words[1:]:
+        if len(line) + 1 + len(w) <= BODY_WIDTH:
+            line += ' ' + w
+        else:
+            lines.append(line)
+            line = w
+    lines.append(line)
+    return '\n'.join(lines)
+
+
+def optwrap(text, new):
+    """
+    html2text's optwrap. The 'new' versions do not break long words,
+    wrap paragraphs starting with **, and do not wrap tables.
+    """
+    result = []
+    newlines = 0
+    for para in text.split('\n'):
+        if para:
+            if not skipwrap(para, new):
+                indent = ''
+                if new and para.startswith('> '):
+                    indent = '> '
+                result.append(wrap_paragraph(para, new, indent))
+                if para.endswith('  '):
+                    result.append('  \n')
+                    newlines = 1
+                elif indent:
+                    result.append('\n')
+                    newlines = 1
+                else:
+                    result.append('\n\n')
+                    newlines = 2
+            elif not SPACE_PLUS.match(para):
+                result.append(para + '\n')
+                newlines = 1
+        elif newlines < 2:
+            result.append('\n')
+            newlines += 1
+    return ''.join(result)
+
+
+class MarkdownCache:
+    """
+    Bounded LRU cache of Markdown conversions, keyed by a hash of the HTML.
+
+    Feedback comments often repeat the same text across attempts, and
+    the cache is saved in filename (if not None) so that each of them is
+    only converted once per course. The saved conversions are discarded
+    if the installed version of html2text changes.
+
+    >>> cache = MarkdownCache(maxsize=2)
+    >>> cache.set('<p>a</p>', 'a')
+    >>> cache.set('<p>b</p>', 'b')
+    >>> cache.get('<p>a</p>')
+    'a'
+    >>> cache.set('<p>c</p>', 'c')
+    >>> cache.get('<p>b</p>') is None
+    True
+    """
+
+    version = '.'.join(map(str, html2text.__version__))
+
+    def __init__(self, filename=None, maxsize=2000):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._modified = False
+        if filename is not None:
+            try:
+                with open(filename) as fp:
+                    data = json.load(fp)
+            except (FileNotFoundError, ValueError):
+                data = None
+            if data and data.get('html2text') == self.version:
+                self._entries.update(data['entries'][-maxsize:])
+
+    def key(self, html):
+        return hashlib.sha1(html.encode('utf-8')).hexdigest()
+
+    def get(self, html):
+        key = self.key(html)
+        with self._lock:
+            markdown = self._entries.get(key)
+            if markdown is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return markdown
+
+    def set(self, html, markdown):
+        key = self.key(html)
+        with self._lock:
+            self._entries[key] = markdown
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._modified = True
+
+    def save(self):
+        if self.filename is None or not self._modified:
+            return
+        with self._lock:
+            data = dict(html2text=self.version,
+                        entries=list(self._entries.items()))
+            self._modified = False
+        logger.debug("Markdown cache: %d hits, %d misses, %d entries",
+                     self.hits, self.misses, len(data['entries']))
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_atomic(self.filename, json.dumps(data).encode('utf-8'))
@@ -0,0 +1,129 @@
+import io
+import os
+import uuid
+
+
+class MultipartEncoder:
+    """
+    File-like multipart/form-data request body.
+
+    Unlike the files argument to requests.post, file parts are not read
+    into memory up front; they are read in chunks while the body is sent.
+    The total length is known in advance, so requests sends a
+    Content-Length header instead of using chunked transfer encoding.
+
+    >>> body = MultipartEncoder([('grade', '1')],
+    ...                         [('f', ('a.txt', io.BytesIO(b'hello')))],
+    ...                         boundary='xyz')
+    >>> body.content_type
+    'multipart/form-data; boundary=xyz'
+    >>> length = len(body)
+    >>> data = body.read()
+    >>> len(data) == length
+    True
+    >>> print(data.decode().replace('\\r\\n', '\\n'), end='')
+    --xyz
+    Content-Disposition: form-data; name="grade"
+    <BLANKLINE>
+    1
+    --xyz
+    Content-Disposition: form-data; name="f"; filename="a.txt"
+    Content-Type: application/octet-stream
+    <BLANKLINE>
+    hello
+    --xyz--
+    """
+
+    def __init__(self, fields, files=(), boundary=None):
+        if boundary is None:
+            boundary = uuid.uuid4().hex
+        self.boundary = boundary
+        self._parts = []
+        for name, value in fields:
+            if value is None:
+                continue
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            self._add_bytes(self._part_header(name))
+            self._add_bytes(str(value).encode('utf-8'))
+            self._add_bytes(b'\r\n')
+        for name, value in files:
+            if isinstance(value, tuple):
+                filename, fp = value[:2]
+            else:
+                fp = value
+                filename = os.path.basename(getattr(fp, 'name', '') or name)
+            self._add_bytes(self._part_header(name, filename))
+            self._add_file(fp)
+            self._add_bytes(b'\r\n')
+        self._add_bytes(('--%s--\r\n' % self.boundary).encode('ascii'))
+        self._remaining = sum(length for fp, length in self._parts)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def _part_header(self, name, filename=None):
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (
+            self.boundary, quote_param(name))
+        if filename is not None:
+            header += '; filename="%s"' % quote_param(filename)
+            header += '\r\nContent-Type: application/octet-stream'
+        return (header + '\r\n\r\n').encode('utf-8')
+
+    def _add_bytes(self, data):
+        if data:
+            self._parts.append((io.BytesIO(data), len(data)))
+
+    def _add_file(self, fp):
+        if isinstance(fp, str):
+            fp = fp.encode('utf-8')
+        if isinstance(fp, bytes):
+            self._add_bytes(fp)
+            return
+        if isinstance(fp, io.TextIOBase):
+            # Text file objects (such as the dummy io.StringIO('') that
+            # Form.submit uses) are small; encode them up front.
+            self._add_bytes(fp.read().encode('utf-8'))
+            return
+        try:
+            size = os.fstat(fp.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            position = fp.tell()
+            size = fp.seek(0, io.SEEK_END)
+            fp.seek(position)
+        if size > fp.tell():
+            self._parts.append((fp, size - fp.tell()))
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._remaining
+        chunks = []
+        while size > 0 and self._parts:
+            fp, length = self._parts[0]
+            chunk = fp.read(min(size, length))
+            if not chunk:
+                raise ValueError("File part was truncated while uploading")
+            chunks.append(chunk)
+            size -= len(chunk)
+            length -= len(chunk)
+            if length:
+                self._parts[0] = (fp, length)
+            else:
+                self._parts.pop(0)
+        data = b''.join(chunks)
+        self._remaining -= len(data)
+        return data
+
+
+def quote_param(value):
+    """Escape a Content-Disposition parameter the way browsers do.
+
+    >>> quote_param('my "pretty" handin.pdf')
+    'my %22pretty%22 handin.pdf'
+    """
+    return (value.replace('"', '%22')
+            .replace('\r', '%0D').replace('\n', '%0A'))
@@ -0,0 +1,118 @@
+import os
+import re
+import sys
+import time
+import cProfile
+import threading
+import contextlib
+import collections
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from blackboard.base import logger
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB (or None)."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return maxrss / 2 ** 20
+    return maxrss / 2 ** 10
+
+
+class PhaseProfiler:
+    """
+    Measures the phases of a run (see BlackboardSession.phase):
+    wall time, CPU time, number of requests, how much the peak RSS of the
+    process grew during the phase, and the peak RSS of the process so far
+    when the phase ended. The peak RSS is a lifetime maximum, so a phase
+    that uses less memory than an earlier one shows no growth.
+
+    Phases may be nested, in which case the time of the inner phase is
+    also counted in the outer phase. If profile_dir is given, each
+    outermost phase is also profiled with cProfile, and the statistics
+    are saved in profile_dir/<phase>.prof (see the pstats module).
+    cProfile only sees the main thread.
+    """
+
+    def __init__(self, session=None, profile_dir=None):
+        self.session = session
+        self.profile_dir = profile_dir
+        # Map phase name to a Counter of measurements
+        self.phases = collections.OrderedDict()
+        self._stack = []
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def request_count(self):
+        if self.session is None:
+            return 0
+        return self.session.metrics['requests']
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if threading.current_thread() is not threading.main_thread():
+            # Phases are measured for the whole process; inside a worker
+            # thread, the enclosing phase of the main thread is enough.
+            yield
+            return
+        if self._stack:
+            name = '%s/%s' % (self._stack[-1], name)
+        self._stack.append(name)
+        with self._lock:
+            # Report phases in the order they start
+            self.phases.setdefault(name, collections.Counter())
+        profile = None
+        if self.profile_dir is not None and len(self._stack) == 1:
+            # Accumulate statistics if the phase is run again
+            profile = self._profiles.setdefault(name, cProfile.Profile())
+        wall, cpu, requests = (
+            time.time(), time.process_time(), self.request_count())
+        rss_start = peak_rss()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self._stack.pop()
+            with self._lock:
+                m = self.phases[name]
+                m['count'] += 1
+                m['wall'] += time.time() - wall
+                m['cpu'] += time.process_time() - cpu
+                m['requests'] += self.request_count() - requests
+                rss = peak_rss()
+                if rss is not None:
+                    m['rss_growth'] += rss - rss_start
+                    m['peak_rss'] = max(m['peak_rss'], rss)
+            if profile is not None:
+                self.dump_profile(name, profile)
+
+    def dump_profile(self, name, profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        filename = os.path.join(
+            self.profile_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.prof')
+        profile.dump_stats(filename)
+        logger.debug("Profile of %s saved to %s", name, filename)
+
+    def report(self):
+        """Return the measurements of each phase as a list of lines."""
+        lines = ['%-30s %5s %8s %8s %8s %11s %15s' % (
+            'phase', 'count', 'wall', 'cpu', 'requests', 'peak growth',
+            'max RSS so far')]
+        with self._lock:
+            phases = list(self.phases.items())
+        for name, m in phases:
+            lines.append('%-30s %5d %8.2f %8.2f %8d %8.0f MB %12.0f MB' % (
+                name, m['count'], m['wall'], m['cpu'], m['requests'],
+                m['rss_growth'], m['peak_rss']))
+        return lines
@@ -0,0 +1,283 @@
+import json
+import time
+import random
+import threading
+import collections
+
+import requests
+
+from blackboard.base import logger
+from blackboard.cache import write_atomic
+from blackboard.endpoints import endpoint_class
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: on average at most `rate` acquisitions
+    per second, with bursts of up to `burst` acquisitions.
+
+    >>> bucket = TokenBucket(rate=1000, burst=2)
+    >>> bucket.acquire(); bucket.acquire()  # The burst needs no waiting
+    0.0
+    0.0
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Don't hand out tokens for the given number of seconds."""
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     time.monotonic() + seconds)
+
+    def acquire(self):
+        """Take a token, sleeping until one is available.
+        Return the number of seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = max(self._paused_until - now,
+                            (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit controlled by additive increase/multiplicative
+    decrease (like TCP congestion control).
+
+    Each successful request increases the limit by increase/limit,
+    i.e. by about `increase` per round of requests, and a congestion
+    signal (an error, or a latency much higher than usual) multiplies
+    the limit by `decrease`, at most once per `cooldown` seconds.
+
+    >>> limiter = AIMDLimiter(initial=4, maximum=8)
+    >>> limiter.acquire()
+    >>> limiter.release(ok=False)
+    >>> limiter.limit
+    2.0
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=8,
+                 increase=1, decrease=0.5, cooldown=2,
+                 latency_factor=4, latency_floor=2):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.latency_factor = latency_factor
+        self.latency_floor = latency_floor
+        self.in_flight = 0
+        # Exponentially weighted moving average of successful latencies
+        self.baseline = None
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, ok=True, latency=None):
+        with self._cond:
+            self.in_flight -= 1
+            if ok and latency is not None and self.is_slow(latency):
+                ok = False
+            if ok:
+                self.limit = min(self.maximum,
+                                 self.limit + self.increase / self.limit)
+                if latency is not None:
+                    if self.baseline is None:
+                        self.baseline = latency
+                    else:
+                        self.baseline = 0.9 * self.baseline + 0.1 * latency
+            else:
+                self._decrease()
+            self._cond.notify_all()
+
+    def congestion(self):
+        """Signal congestion outside of acquire/release."""
+        with self._cond:
+            self._decrease()
+
+    def _decrease(self):
+        if time.monotonic() - self._last_decrease > self.cooldown:
+            self._last_decrease = time.monotonic()
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+    def is_slow(self, latency):
+        if self.baseline is None or latency < self.latency_floor:
+            return False
+        return latency > self.latency_factor * self.baseline
+
+
+class EndpointController:
+    def __init__(self, name, rate, burst, **limiter_kwargs):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AIMDLimiter(**limiter_kwargs)
+
+
+# Settings of each scheduler class; see EndpointController.
+DEFAULT_LIMITS = {
+    'json': dict(rate=2, burst=4, initial=2, maximum=4),
+    'dwr': dict(rate=2, burst=2, initial=1, maximum=2),
+    'page': dict(rate=4, burst=4, initial=2, maximum=6),
+    'download': dict(rate=8, burst=8, initial=2, maximum=8),
+}
+
+# Map from blackboard.endpoints.endpoint_class to scheduler class.
+# Endpoints not listed here are in the 'page' class.
+SCHEDULER_CLASSES = {
+    'overview': 'json',
+    'attempt_counts': 'json',
+    'dwr': 'dwr',
+    'dwr_engine': 'dwr',
+    'download': 'download',
+}
+
+
+def is_congestion_response(response):
+    """True if the response indicates that the server is overloaded."""
+    return response.status_code == 429 or response.status_code >= 500
+
+
+class RequestScheduler:
+    """
+    Shared scheduler for the requests of a BlackboardSession,
+    which may be made from several threads.
+
+    Each request belongs to a class (see SCHEDULER_CLASSES) with its own
+    token bucket rate limit and AIMD concurrency limit. Error responses,
+    connection errors and unusually slow responses reduce the
+    concurrency limit; a Retry-After header pauses the class.
+
+    The latencies of recent successful requests are kept for each
+    endpoint class, and may be saved between runs (see save_latencies),
+    since some endpoints are only requested once per run.
+    """
+
+    # Number of latencies to keep for each endpoint class
+    latency_history = 200
+
+    def __init__(self, limits=None):
+        settings = {k: dict(v) for k, v in DEFAULT_LIMITS.items()}
+        for k, v in (limits or {}).items():
+            settings.setdefault(k, {}).update(v)
+        self.controllers = {
+            name: EndpointController(name, **kwargs)
+            for name, kwargs in settings.items()}
+        self.latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.latency_history))
+
+    def controller(self, url):
+        name = SCHEDULER_CLASSES.get(endpoint_class(url), 'page')
+        return self.controllers[name]
+
+    def request(self, url, send):
+        """Call send() to send the request for url when the limits allow it,
+        and update the limits from the outcome."""
+        c = self.controller(url)
+        c.bucket.acquire()
+        c.limiter.acquire()
+        t1 = time.monotonic()
+        try:
+            response = send()
+        except (requests.ConnectionError, requests.Timeout):
+            c.limiter.release(ok=False)
+            raise
+        except BaseException:
+            c.limiter.release(ok=True)
+            raise
+        latency = time.monotonic() - t1
+        ok = not is_congestion_response(response)
+        c.limiter.release(ok=ok, latency=latency)
+        if ok:
+            self.latencies[endpoint_class(url)].append(latency)
+        else:
+            logger.debug("%s %s: reducing %s concurrency to %d",
+                         response.status_code, url, c.name,
+                         int(c.limiter.limit))
+            retry_after = parse_retry_after(response)
+            if retry_after:
+                c.bucket.pause(retry_after)
+        return response
+
+    def report_error(self, url):
+        """Report an error page that was served with status 200."""
+        self.controller(url).limiter.congestion()
+
+    def latency_percentile(self, url, q, min_samples=5):
+        """The q'th percentile of recent latencies of the endpoint class
+        of url, or None if fewer than min_samples are known."""
+        latencies = self.latencies.get(endpoint_class(url), ())
+        if len(latencies) < min_samples:
+            return None
+        return percentile(latencies, q)
+
+    def load_latencies(self, filename):
+        try:
+            with open(filename) as fp:
+                o = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return
+        for k, v in o.items():
+            self.latencies[k].extend(v)
+
+    def save_latencies(self, filename):
+        o = {k: list(v) for k, v in self.latencies.items()}
+        write_atomic(filename, json.dumps(o).encode('utf-8'))
+
+
+def percentile(values, q):
+    """
+    The q'th percentile (0 <= q <= 100) of values,
+    interpolating between the closest values.
+
+    >>> percentile([4, 1, 3, 2], 50)
+    2.5
+    >>> percentile([4, 1, 3, 2], 100)
+    4
+    """
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    i = int(k)
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (values[i + 1] - values[i]) * (k - i)
+
+
+def parse_retry_after(response):
+    """
+    Return the number of seconds in a Retry-After header (or None).
+
+    >>> r = requests.Response()
+    >>> r.headers['Retry-After'] = '7'
+    >>> parse_retry_after(r)
+    7.0
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return
+    try:
+        return float(value)
+    except ValueError:
+        # An HTTP-date; just wait a bit
+        return 5 + random.random()
@@ -0,0 +1,158 @@
+"""
+Scores of all students in all assignments as a matrix.
+
+ScoreMatrix is built from the gradebook in one pass (see
+Gradebook.score_matrix), after which totals, pass rates and
+needs-grading counts are computed for whole rows and columns at once.
+If NumPy is installed, the matrices are NumPy arrays; otherwise they
+are lists of lists and the same results are computed in pure Python.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ScoreMatrix:
+    """
+    Matrices with a row for each student and a column for each assignment:
+
+    scores
+        StudentAssignment.score (0 if the student has no such assignment)
+    present
+        Whether the student has the assignment in the gradebook
+    attempts
+        Number of attempts (0 if the attempt list is not known)
+    attempt_scores
+        Sum of the scores of graded attempts
+    needs_grading
+        Number of attempts that need grading
+
+    Rows are in the order of student_ids, columns in the order of
+    assignment_ids. Methods that take students only consider the rows of
+    those students (all students if None).
+    """
+
+    def __init__(self, gradebook):
+        students = list(gradebook.students.values())
+        self.student_ids = [s.id for s in students]
+        self.student_index = {i: k for k, i in enumerate(self.student_ids)}
+        self.assignment_ids = [a.id for a in gradebook.assignments.values()]
+        self.assignment_index = {
+            a: j for j, a in enumerate(self.assignment_ids)}
+        shape = (len(students), len(self.assignment_ids))
+        scores = zeros(shape, float)
+        present = zeros(shape, bool)
+        attempts = zeros(shape, int)
+        attempt_scores = zeros(shape, float)
+        needs_grading = zeros(shape, int)
+        for i, student in enumerate(students):
+            for assignment_id, a in student.assignments.items():
+                j = self.assignment_index.get(assignment_id)
+                if j is None:
+                    continue
+                present[i][j] = True
+                scores[i][j] = a.score
+                for attempt in a.cached_attempts or ():
+                    attempts[i][j] += 1
+                    attempt_scores[i][j] += attempt.score or 0
+                    needs_grading[i][j] += attempt.needs_grading
+        self.scores = array(scores, float, shape)
+        self.present = array(present, bool, shape)
+        self.attempts = array(attempts, int, shape)
+        self.attempt_scores = array(attempt_scores, float, shape)
+        self.needs_grading = array(needs_grading, int, shape)
+        self._totals = self.row_sums(self.scores)
+
+    def __len__(self):
+        return len(self.student_ids)
+
+    def rows(self, students=None):
+        if students is None:
+            return list(range(len(self.student_ids)))
+        return [self.student_index[s.id] for s in students]
+
+    def cell(self, matrix, student, assignment_id):
+        v = matrix[self.student_index[student.id]][
+            self.assignment_index[assignment_id]]
+        # Python number instead of a NumPy scalar
+        return v.item() if numpy is not None else v
+
+    def total(self, student):
+        """Sum of the assignment scores of student, which is
+        student.score unless a subclass of Student overrides it."""
+        return self._totals[self.student_index[student.id]]
+
+    def row_sums(self, matrix, students=None):
+        rows = self.rows(students)
+        if numpy is not None:
+            return matrix[rows].sum(axis=1).tolist()
+        return [sum(matrix[i]) for i in rows]
+
+    def column_sums(self, matrix, students=None):
+        rows = self.rows(students)
+        if numpy is not None:
+            return matrix[rows].sum(axis=0).tolist()
+        return [sum(matrix[i][j] for i in rows)
+                for j in range(len(self.assignment_ids))]
+
+    def totals(self, students=None):
+        return [self._totals[i] for i in self.rows(students)]
+
+    def submitted_counts(self, students=None):
+        """Number of students with at least one attempt, by assignment."""
+        if numpy is not None:
+            return self.column_sums(self.attempts > 0, students)
+        return self.column_sums(
+            [[n > 0 for n in row] for row in self.attempts], students)
+
+    def needs_grading_counts(self, students=None):
+        """Number of attempts that need grading, by assignment."""
+        return self.column_sums(self.needs_grading, students)
+
+    def pass_counts(self, students=None):
+        """
+        Number of students with at least one attempt and a positive score,
+        by assignment.
+        """
+        if numpy is not None:
+            return self.column_sums(
+                (self.scores > 0) & (self.attempts > 0), students)
+        return self.column_sums(
+            [[s > 0 and n > 0 for s, n in zip(*row)]
+             for row in zip(self.scores, self.attempts)], students)
+
+    def pass_rates(self, students=None):
+        """
+        Fraction of the students with at least one attempt that have
+        a positive score, by assignment (None if nobody handed in).
+        """
+        return [p / n if n else None
+                for p, n in zip(self.pass_counts(students),
+                                self.submitted_counts(students))]
+
+
+def zeros(shape, dtype):
+    return [[dtype()] * shape[1] for i in range(shape[0])]
+
+
+def array(rows, dtype, shape):
+    if numpy is None:
+        return rows
+    return numpy.array(rows, dtype).reshape(shape)
+
+
+def column_widths(rows):
+    """
+    Width of the longest cell in each column of a table of strings.
+
+    >>> column_widths([['a', 'bcd'], ['ef', '']])
+    [2, 3]
+    """
+    if not rows:
+        return []
+    if numpy is not None:
+        lengths = numpy.char.str_len(numpy.array(rows, dtype=str))
+        return lengths.max(axis=0).tolist()
+    return [max(map(len, column)) for column in zip(*rows)]
@@ -1,5 +1,13 @@
+import os
 import re
+import time
+import random
+import shutil
 import getpass
+import threading
+import contextlib
+import collections
+import concurrent.futures
 import keyring
 import html5lib
 import requests
@@ -8,11 +16,21 @@ import requests.cookies
 from six.moves.http_cookiejar import LWPCookieJar
 from six.moves.urllib.parse import urlparse, parse_qs, urlencode
 
-from blackboard.base import BadAuth, ParserError, logger, DOMAIN
+from blackboard.base import BadAuth, ParserError, logger, DOMAIN, slowlog
+from blackboard.httpcache import ValidatorStore
+from blackboard.scheduler import parse_retry_after
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
 
+# Requests that request() may send again after a connection error.
+# Other requests (POSTs) may have been received by Blackboard even if
+# the response was lost, so they are never retried blindly.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Status codes of transient failures that are retried like connection errors
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
 
 class BlackboardSession:
     def __init__(self, cookiejar, username, course_id):
@@ -21,10 +39,48 @@ class BlackboardSession:
         self.course_id = course_id
 
         self.password = None
+        # True once the course is known to be in edit mode in this session
+        self.edit_mode = None
         self.cookies = LWPCookieJar(cookiejar)
         self.session = requests.Session()
         self.load_cookies()
 
+        # Counters such as the number of logins and the time spent on them
+        self.metrics = collections.Counter()
+        # Optional blackboard.httpcache.ResponseCache used by request()
+        self.cache = None
+        # (connect, read) timeout in seconds of each request
+        self.timeout = (10, 120)
+        # Number of times request() retries an idempotent request
+        self.retries = 3
+        # Initial and maximum delay in seconds between retries
+        self.retry_backoff = (1, 30)
+        # If True, slow requests for which request() is given hedge=True
+        # are sent a second time; see send_hedged
+        self.hedging = False
+        # Percentile of previous latencies after which to hedge
+        self.hedge_percentile = 95
+        # Seconds after which to hedge if there are too few latencies
+        self.hedge_default_deadline = 15
+        # Optional blackboard.tracing.Tracer that records requests
+        self.tracer = None
+        # Optional blackboard.profiling.PhaseProfiler used by phase()
+        self.profiler = None
+        # Optional blackboard.scheduler.RequestScheduler that limits the
+        # rate and concurrency of request() (see Grading.enable_scheduler)
+        self.scheduler = None
+        # Validators of static resources, used by download()
+        self.validators = ValidatorStore()
+        # Optional blackboard.markdown.MarkdownCache of the feedback
+        # converted by fetch_attempt
+        self.markdown_cache = None
+        # Optional blackboard.datatable.DatatableCache of parsed pages
+        self.datatable_cache = None
+        # Incremented after each login; see login_once
+        self.login_generation = 0
+        self._login_lock = threading.Lock()
+        self._login_thread = None
+
     def load_cookies(self):
         try:
             self.cookies.load(ignore_discard=True)
@@ -40,6 +96,10 @@ class BlackboardSession:
         try:
             return self.session.cookies._cookies[DOMAIN][path][key].value
         except KeyError:
+            if self.cache is not None and self.cache.mode == 'replay':
+                # The cookie is only used in request bodies,
+                # which is not important when replaying.
+                return ''
             print(self.session.cookies._cookies)
             raise
 
@@ -78,7 +138,7 @@ class BlackboardSession:
 
         history = list(response.history) + [response]
         logger.info("Sending login details to WAYF")
-        response = self.session.post(response.url, self.get_auth())
+        response = self.request('POST', response.url, data=self.get_auth())
         history += list(response.history) + [response]
         if 'Forkert brugernavn eller kodeord' in response.text:
             raise BadAuth()
@@ -90,7 +150,42 @@ class BlackboardSession:
         response.history = history[:-1]
         return response
 
+    def logging_in(self):
+        """True if the current thread is inside login_once."""
+        return self._login_thread == threading.get_ident()
+
+    def login_once(self, generation, login):
+        """Single-flight login shared by concurrent requests.
+
+        Call login() and return its result, unless another thread has
+        completed a login since the caller observed login_generation
+        to be the given generation. In that case, wait for that login
+        to finish and return None, and the caller should replay its request.
+        """
+        if self.logging_in():
+            # Nested login, e.g. relogin() being redirected to WAYF
+            return login()
+        t1 = time.time()
+        with self._login_lock:
+            if self.login_generation != generation:
+                t = time.time() - t1
+                self.metrics['login_waits'] += 1
+                self.metrics['login_wait_seconds'] += t
+                logger.debug("Waited %.1f s for concurrent login", t)
+                return None
+            self._login_thread = threading.get_ident()
+            t2 = time.time()
+            try:
+                return login()
+            finally:
+                self._login_thread = None
+                self.login_generation += 1
+                self.metrics['logins'] += 1
+                self.metrics['login_seconds'] += time.time() - t2
+
     def relogin(self):
+        # Edit mode is stored in the server-side session
+        self.edit_mode = None
         url = (
             'https://%s/webapps/bb-auth-provider-shibboleth-BBLEARN' % DOMAIN +
             '/execute/shibbolethLogin?authProviderId=_102_1')
@@ -131,7 +226,7 @@ class BlackboardSession:
             i.get('name'): i.get('value')
             for i in inputs
         }
-        response = self.session.post(url, post_data)
+        response = self.request('POST', url, data=post_data)
 
         return response
 
@@ -185,25 +280,38 @@ class BlackboardSession:
                         dict(returnUrl=return_url,
                              authProviderId='_102_1'))
                     next_url = '%s?%s' % (real_login_url, new_qs)
-                response = self.session.get(next_url)
+                response = self.request('GET', next_url)
                 history += list(response.history) + [response]
                 continue
             break
         response.history = history[:-1]
         return response
 
-    def autologin(self, response):
+    def autologin(self, response, generation=None):
         """Automatically log in if necessary.
 
         If the given response is not for a login form,
         just follow HTML redirects and return the response.
         Otherwise, log in using wayf_login and get_auth.
+
+        generation is the login_generation observed before the request
+        was sent; if another request has logged in since then,
+        the request is replayed instead of logging in again.
         """
 
+        if generation is None:
+            generation = self.login_generation
         response = self.follow_html_redirect(response)
         o = urlparse(response.url)
         if o.netloc == 'wayf.au.dk':
-            response = self.wayf_login(response)
+            login_page = response
+            response = self.login_once(
+                generation, lambda: self.wayf_login(login_page))
+            if response is None:
+                history = list(login_page.history) + [login_page]
+                response = self.follow_html_redirect(
+                    self.request('GET', history[0].url))
+                response.history = history + list(response.history)
         return response
 
     def get_edit_mode(self, response):
@@ -213,7 +321,14 @@ class BlackboardSession:
             return 'read-on' in (mode_switch.get('class') or '').split()
 
     def ensure_edit_mode(self, response):
-        if self.get_edit_mode(response) is False:
+        if self.edit_mode:
+            # Already switched to edit mode in this session;
+            # don't parse the page to check again.
+            return response
+        edit_mode = self.get_edit_mode(response)
+        if edit_mode is True:
+            self.edit_mode = True
+        elif edit_mode is False:
             url = ('https://%s/webapps/blackboard/execute/' % DOMAIN +
                    'doCourseMenuAction?cmd=setDesignerParticipantViewMode' +
                    '&courseId=' + self.course_id +
@@ -224,19 +339,31 @@ class BlackboardSession:
                        list(r.history) + [r])
             response = self.get(history[0].url)
             response.history = history + list(response.history)
+            self.edit_mode = True
         return response
 
-    def get(self, url):
-        response = self.autologin(self.session.get(url))
-        if self.detect_login(response) is False:
+    def get(self, url, hedge=False, fresh=False):
+        """
+        GET url, logging in if necessary. If fresh is True, the response
+        is never served from a ResponseCache in 'cache' mode; use this for
+        pages whose content is posted back, such as forms with a nonce.
+        """
+        generation = self.login_generation
+        response = self.autologin(
+            self.request('GET', url, hedge=hedge, fresh=fresh), generation)
+        if self.detect_login(response) is False and not self.logging_in():
+            if self.cache is not None:
+                self.cache.discard('GET', url)
             history = response.history + [response]
-            relogin_response = self.relogin()
-            history += relogin_response.history + [relogin_response]
-            response = self.autologin(self.session.get(url))
+            relogin_response = self.login_once(generation, self.relogin)
+            if relogin_response is not None:
+                history += relogin_response.history + [relogin_response]
+            response = self.autologin(
+                self.request('GET', url, hedge=hedge, fresh=fresh))
             response.history = history + list(response.history)
         if response.url != url:
             history = list(response.history) + [response]
-            response = self.session.get(url)
+            response = self.request('GET', url, hedge=hedge, fresh=fresh)
             response.history = history + list(response.history)
         self.log_error(response)
         return response
@@ -248,11 +375,218 @@ class BlackboardSession:
             class_list = (content.get('class') or '').split()
             if 'error' in class_list:
                 logger.info("contentPanel indicates an error has occurred")
+                if self.scheduler is not None:
+                    # Blackboard serves error pages when it is overloaded
+                    self.scheduler.report_error(response.url)
                 # raise ParserError("Error", response)
 
+    def request(self, method, url, hedge=False, fresh=False, **kwargs):
+        """Send an HTTP request without any login handling.
+
+        All requests made by BlackboardSession go through this method.
+        If self.cache is a ResponseCache, responses are served from
+        and stored in the cache (but see ResponseCache.lookup for fresh).
+
+        Idempotent requests (GETs) that fail with a connection error,
+        a timeout or a status code in RETRY_STATUS_CODES are retried
+        up to self.retries times with exponential backoff.
+
+        If hedge is True and self.hedging is enabled, the request is
+        sent with send_hedged. Only use this for read-only requests.
+
+        If self.tracer is a Tracer, the request is recorded in it.
+        Requests taking more than two seconds are logged in any case.
+        """
+        started = time.time()
+        report = slowlog()
+        self.metrics['requests'] += 1
+        cache = self.cache
+        data = kwargs.get('data')
+        try:
+            response = None
+            if cache is not None:
+                response = cache.lookup(method, url, data, fresh=fresh)
+            if response is None:
+                response = self.send_with_retries(method, url, hedge, **kwargs)
+                if cache is not None:
+                    cache.store(method, url, response, data)
+        except Exception as exn:
+            self.trace(method, url, started, error=exn)
+            raise
+        self.trace(method, url, started, response=response,
+                   stream=kwargs.get('stream', False))
+        report("%s %s took %.1f s", method, url)
+        return response
+
+    def send_with_retries(self, method, url, hedge=False, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if method.upper() in IDEMPOTENT_METHODS:
+            retries = self.retries
+        else:
+            retries = 0
+        send = self.send_hedged if hedge and self.hedging else self.send
+        attempt = 0
+        while True:
+            try:
+                response = send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exn:
+                if attempt >= retries:
+                    raise
+                delay = self.retry_delay(attempt)
+                logger.warning("%s %s failed (%s); retrying in %.1f s",
+                               method, url, exn.__class__.__name__, delay)
+            else:
+                if (response.status_code not in RETRY_STATUS_CODES or
+                        attempt >= retries):
+                    break
+                delay = max(self.retry_delay(attempt),
+                            parse_retry_after(response) or 0)
+                logger.warning("%s %s returned %s; retrying in %.1f s",
+                               method, url, response.status_code, delay)
+                response.close()
+            self.metrics['retries'] += 1
+            time.sleep(delay)
+            attempt += 1
+        return response
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager around a phase of a run, such as a refresh,
+        to be measured by self.profiler."""
+        if self.profiler is None:
+            yield
+        else:
+            with self.profiler.phase(name):
+                yield
+
+    def trace(self, method, url, started, **kwargs):
+        if self.tracer is not None:
+            self.tracer.record(method, url, started, time.time() - started,
+                               **kwargs)
+
+    def trace_parsed(self, response):
+        """Called when a response has been parsed; see Tracer.parsed."""
+        if self.tracer is not None:
+            self.tracer.parsed(response)
+
+    def send(self, method, url, **kwargs):
+        """Send a single request through the scheduler."""
+        if self.scheduler is None:
+            return self.session.request(method, url, **kwargs)
+        return self.scheduler.request(
+            url, lambda: self.session.request(method, url, **kwargs))
+
+    def hedge_deadline(self, url):
+        deadline = None
+        if self.scheduler is not None:
+            deadline = self.scheduler.latency_percentile(
+                url, self.hedge_percentile)
+        if deadline is None:
+            return self.hedge_default_deadline
+        # Don't hedge requests that are fast anyway
+        return max(1, deadline)
+
+    def send_hedged(self, method, url, **kwargs):
+        """Send a request, and if there is no response within
+        hedge_deadline(url) seconds, send it again and return
+        whichever response arrives first.
+
+        Blackboard sometimes takes much longer than usual to answer a
+        request, and a second identical request is often answered sooner.
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        try:
+            first = executor.submit(self.send, method, url, **kwargs)
+            deadline = self.hedge_deadline(url)
+            try:
+                return first.result(timeout=deadline)
+            except concurrent.futures.TimeoutError:
+                pass
+            logger.debug("No response after %.1f s; hedging %s %s",
+                         deadline, method, url)
+            self.metrics['hedged'] += 1
+            second = executor.submit(self.send, method, url, **kwargs)
+            pending = {first, second}
+            while True:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                future = done.pop()
+                if future.exception() is None or not pending:
+                    break
+                # Wait for the other request if this one failed
+            for f in pending | done:
+                f.add_done_callback(close_response)
+            if future is second:
+                self.metrics['hedge_wins'] += 1
+            return future.result()
+        finally:
+            # Don't wait for the slower request
+            executor.shutdown(wait=False)
+
+    def retry_delay(self, attempt):
+        """Seconds to wait before retry number attempt+1:
+        exponential backoff with jitter, so that concurrent requests
+        that failed together don't retry together."""
+        initial, maximum = self.retry_backoff
+        delay = min(maximum, initial * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def download(self, url, filename, chunk_size=64*1024):
+        """Download a static resource (such as a submitted file) to filename.
+
+        If the resource was downloaded before and the local copy still
+        exists, a conditional GET is sent, and if the server responds
+        304 Not Modified, the local copy is copied to filename instead.
+
+        Raises requests.HTTPError for any other status than 200 (or 304),
+        in which case filename is left untouched.
+        """
+        entry = self.validators.local_copy(url)
+        headers = self.validators.conditional_headers(url)
+        response = self.request('GET', url, stream=True, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.metrics['not_modified'] += 1
+            if os.path.abspath(filename) != entry['filename']:
+                os.makedirs(os.path.dirname(os.path.abspath(filename)),
+                            exist_ok=True)
+                shutil.copyfile(entry['filename'], filename)
+            response.encoding = entry['encoding']
+            return response
+        if response.status_code != 200:
+            response.close()
+            raise requests.HTTPError(
+                "%s %s when downloading %s" %
+                (response.status_code, response.reason, url),
+                response=response)
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        tmp = filename + '.part'
+        with open(tmp, 'wb') as fp:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    fp.write(chunk)
+        os.replace(tmp, filename)
+        self.validators.remember(url, response, filename)
+        return response
+
+    def get_static(self, url):
+        """GET a static resource using download() to a stored copy.
+
+        The response content is always the full resource,
+        even if the server responded 304 Not Modified.
+        """
+        filename = self.validators.blob_path(url)
+        if filename is None:
+            return self.request('GET', url)
+        response = self.download(url, filename)
+        with open(filename, 'rb') as fp:
+            response._content = fp.read()
+        response._content_consumed = True
+        return response
+
     def post(self, url, data, files=None, headers=None):
-        response = self.session.post(
-            url, data=data, files=files, headers=headers)
+        response = self.request(
+            'POST', url, data=data, files=files, headers=headers)
         # if response.history:
         #     logger.warning('POST %r redirected', url)
         #     for r in response.history:
@@ -268,6 +602,12 @@ class BlackboardSession:
         self.get(url)
 
 
+def close_response(future):
+    """Done callback that closes the response of a discarded request."""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
 class PassBlackboardSession(BlackboardSession):
     def get_password(self):
         # Use https://www.passwordstore.org/ to get password
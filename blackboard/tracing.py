@@ -0,0 +1,152 @@
+import json
+import time
+import datetime
+import threading
+import collections
+
+from blackboard.endpoints import endpoint_class
+from blackboard.scheduler import percentile
+
+
+class Tracer:
+    """
+    Record of the requests made by a BlackboardSession
+    (see BlackboardSession.request and BlackboardSession.trace_parsed).
+
+    Each entry is a dict with the keys method, url, endpoint (see
+    blackboard.endpoints.endpoint_class), started (a Unix time),
+    elapsed and parse (seconds), status, bytes, redirects, from_cache
+    and error. Only the last maxlen entries are kept (all if maxlen is
+    None), but totals counts and sums the measurements of all requests
+    by endpoint.
+    """
+
+    def __init__(self, maxlen=10000):
+        self.entries = collections.deque(maxlen=maxlen)
+        # Map endpoint to a Counter of n, elapsed, parse, bytes,
+        # cached and errors
+        self.totals = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def record(self, method, url, started, elapsed, response=None,
+               error=None, stream=False):
+        entry = dict(
+            method=method.upper(),
+            url=url,
+            endpoint=endpoint_class(url),
+            started=started,
+            elapsed=elapsed,
+            parse=None,
+            status=None,
+            bytes=None,
+            redirects=0,
+            from_cache=False,
+            error=None if error is None else error.__class__.__name__,
+        )
+        if response is not None:
+            entry.update(
+                status=response.status_code,
+                bytes=response_size(response, stream),
+                redirects=len(response.history),
+                from_cache=getattr(response, 'from_cache', False))
+            response.trace_entry = entry
+        with self._lock:
+            self.entries.append(entry)
+            totals = self.totals[entry['endpoint']]
+            totals['n'] += 1
+            totals['elapsed'] += elapsed
+            totals['bytes'] += entry['bytes'] or 0
+            totals['cached'] += bool(entry['from_cache'])
+            totals['errors'] += error is not None
+        return entry
+
+    def parsed(self, response):
+        """Record the time from the response arriving until now
+        as the time spent parsing it."""
+        entry = getattr(response, 'trace_entry', None)
+        if entry is not None:
+            parse = time.time() - entry['started'] - entry['elapsed']
+            with self._lock:
+                self.totals[entry['endpoint']]['parse'] += (
+                    parse - (entry['parse'] or 0))
+                entry['parse'] = parse
+
+    def summary(self):
+        """
+        Return per-endpoint statistics as a list of lines.
+        The percentiles are computed from the entries that are kept.
+        """
+        with self._lock:
+            entries = list(self.entries)
+            totals = {k: collections.Counter(v)
+                      for k, v in self.totals.items()}
+        by_endpoint = collections.defaultdict(list)
+        for e in entries:
+            by_endpoint[e['endpoint']].append(e['elapsed'])
+        header = '%-15s %5s %7s %7s %7s %8s %8s %10s %6s' % (
+            'endpoint', 'n', 'p50', 'p95', 'p99', 'total', 'parse',
+            'bytes', 'cached')
+        lines = [header]
+
+        def row(name, elapsed, t):
+            p = [percentile(elapsed, q) if elapsed else float('nan')
+                 for q in (50, 95, 99)]
+            return '%-15s %5d %7.2f %7.2f %7.2f %8.1f %8.1f %10d %6d' % (
+                name, t['n'], p[0], p[1], p[2], t['elapsed'], t['parse'],
+                t['bytes'], t['cached'])
+
+        for name in sorted(totals):
+            lines.append(row(name, by_endpoint[name], totals[name]))
+        total = sum(totals.values(), collections.Counter())
+        if totals:
+            lines.append(row('total', [e['elapsed'] for e in entries],
+                             total))
+        if total['n'] > len(entries):
+            lines.append('Percentiles of the last %d requests' %
+                         len(entries))
+        if total['errors']:
+            lines.append('%d request(s) failed' % total['errors'])
+        return lines
+
+    def to_har(self):
+        """Return the trace as a dict in a format similar to HAR 1.2.
+        Fields that are not in HAR start with an underscore."""
+        with self._lock:
+            entries = list(self.entries)
+        return dict(log=dict(
+            version='1.2',
+            creator=dict(name='bbfetch', version=''),
+            entries=[har_entry(e) for e in entries],
+        ))
+
+    def save(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(self.to_har(), fp, indent=1)
+
+
+def response_size(response, stream=False):
+    if stream:
+        # Don't consume a streamed body
+        try:
+            return int(response.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return None
+    return len(response.content)
+
+
+def har_entry(e):
+    started = datetime.datetime.fromtimestamp(e['started'])
+    ms = 1000 * e['elapsed']
+    return {
+        'startedDateTime': started.isoformat(),
+        'time': ms,
+        'request': dict(method=e['method'], url=e['url']),
+        'response': dict(status=e['status'] or 0,
+                         bodySize=-1 if e['bytes'] is None else e['bytes']),
+        'timings': dict(send=0, wait=ms, receive=0),
+        '_endpoint': e['endpoint'],
+        '_parseTime': None if e['parse'] is None else 1000 * e['parse'],
+        '_redirects': e['redirects'],
+        '_fromCache': e['from_cache'],
+        '_error': e['error'],
+    }